@@ -0,0 +1,21 @@
+"""
+Asynchronous Server Gateway Interface (ASGI) entry point
+
+Serves the hot reads with async handlers and everything else with the Flask
+application, e.g. uvicorn --workers 4 asgi:app
+"""
+
+import os
+from service import config, create_app
+from service.asgi import AsyncOrderApp, split_pool
+
+PORT = int(os.getenv("PORT", "8080"))
+
+# the Flask application and the async handlers share the pool of the worker
+sync_options, async_options = split_pool(config.SQLALCHEMY_ENGINE_OPTIONS)
+app = AsyncOrderApp(create_app(sync_options), async_options)
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=PORT)
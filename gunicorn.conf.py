@@ -0,0 +1,91 @@
+"""
+Gunicorn configuration
+
+Sizes the workers from the CPU quota of the container and loads the
+application once in the master before forking the workers. Every setting
+can be overridden from the environment:
+
+    GUNICORN_WORKERS            - worker processes (default 2 x CPUs + 1)
+    GUNICORN_WORKER_CLASS       - gthread or gevent (default gthread)
+    GUNICORN_THREADS            - threads of each gthread worker (default 4)
+    GUNICORN_WORKER_CONNECTIONS - concurrent requests of each gevent worker (default 100)
+    GUNICORN_BIND               - address to listen on (default 0.0.0.0:$PORT)
+    GUNICORN_LOG_LEVEL          - log level (default info)
+    GUNICORN_TIMEOUT            - seconds before a silent worker is restarted (default 30)
+"""
+
+import math
+import os
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+WORKER_CLASSES = ("gthread", "gevent")
+
+
+def cpu_limit(cgroup_root: str = CGROUP_ROOT) -> int:
+    """Returns the CPUs this container may use, rounded up"""
+    cpus = os.cpu_count() or 1
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open(os.path.join(cgroup_root, "cpu.max"), encoding="utf-8") as cpu_max:
+            quota, period = cpu_max.read().split()[:2]
+    except OSError:
+        # cgroup v1: a quota of -1 means no limit
+        try:
+            with open(os.path.join(cgroup_root, "cpu", "cpu.cfs_quota_us"), encoding="utf-8") as file:
+                quota = file.read().strip()
+            with open(os.path.join(cgroup_root, "cpu", "cpu.cfs_period_us"), encoding="utf-8") as file:
+                period = file.read().strip()
+        except OSError:
+            return cpus
+    if quota in ("max", "-1"):
+        return cpus
+    return max(1, min(cpus, math.ceil(int(quota) / int(period))))
+
+
+######################################################################
+#  S E T T I N G S
+######################################################################
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '8080')}")
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+
+workers = int(os.getenv("GUNICORN_WORKERS", str(2 * cpu_limit() + 1)))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+if worker_class not in WORKER_CLASSES:
+    raise ValueError(f"GUNICORN_WORKER_CLASS must be one of {', '.join(WORKER_CLASSES)}")
+# the lru cache is invalidated only in the worker that made the change
+if workers > 1 and os.getenv("CACHE_BACKEND", "none").lower() == "lru":
+    raise ValueError("CACHE_BACKEND lru needs GUNICORN_WORKERS=1, use redis or none with more workers")
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+
+# create_app() and its schema check run once in the master, and the workers
+# share its memory. gevent must patch the standard library before the
+# application imports it, so the gevent workers each load their own copy.
+preload_app = worker_class != "gevent"
+
+
+######################################################################
+#  S E R V E R   H O O K S
+######################################################################
+def _dispose_engines(server, close: bool) -> None:
+    """Drops the pooled connections of the preloaded application"""
+    if not server.cfg.preload_app:
+        return
+    # pylint: disable=import-outside-toplevel
+    from service.models import db
+
+    with server.app.wsgi().app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=close)
+
+
+def when_ready(server):
+    """Closes the connections the master opened before it forks any worker"""
+    _dispose_engines(server, close=True)
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Gives each worker its own pool instead of the connections of the master"""
+    # close=False leaves the sockets of the parent alone
+    _dispose_engines(server, close=False)
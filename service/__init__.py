@@ -19,30 +19,43 @@ This module creates and configures the Flask app and sets up the logging
 and SQL database
 """
 import sys
+import click
 from flask import Flask
 from flask_restx import Api
 from service import config
 from service.common import log_handlers
+from service.common.cache import cache
+from service.common.idempotency import idempotency_keys
+from service.common.outbox import outbox
 
 
 ############################################################
 # Initialize the Flask instance
 ############################################################
-def create_app():
-    """Initialize the core application."""
+def create_app(engine_options: dict = None):
+    """Initialize the core application.
+
+    engine_options replace SQLALCHEMY_ENGINE_OPTIONS, e.g. with the share of
+    the connection pool asgi.py leaves to the Flask application
+    """
 
     # Create Flask application
     app = Flask(__name__)
     app.config.from_object(config)
+    if engine_options is not None:
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
 
     # Turn off strict slashes because it violates best practices
     app.url_map.strict_slashes = False
 
     # Initialize Plugins
     # pylint: disable=import-outside-toplevel
-    from service.models import db
+    from service.models import db, migrations
 
     db.init_app(app)
+    cache.init_app(app)
+    idempotency_keys.init_app(app)
+    outbox.init_app(app)
 
     with app.app_context():
         # Dependencies require we import the routes AFTER the Flask app is created
@@ -51,12 +64,20 @@ def create_app():
         from service.models import Order, Item, OrderStatus
         from service.common import error_handlers, cli_commands  # noqa: F401, E402
 
+        # the tables are created by flask db-upgrade: only check their version
         try:
-            db.create_all()
+            if app.config["SCHEMA_AUTO_UPGRADE"]:
+                migrations.upgrade(db.engine)
+            migrations.verify(db.engine)
         except Exception as error:  # pylint: disable=broad-except
-            app.logger.critical("%s: Cannot continue", error)
-            # gunicorn requires exit code 4 to stop spawning workers when they die
-            sys.exit(4)
+            if click.get_current_context(silent=True) is not None:
+                # loaded by the flask commands, which must run on any schema
+                # for flask db-upgrade to bring it to the current version
+                app.logger.warning("%s", error)
+            else:
+                app.logger.critical("%s: Cannot continue", error)
+                # gunicorn requires exit code 4 to stop spawning workers when they die
+                sys.exit(4)
 
         # Set up logging for production
         log_handlers.init_logging(app, "gunicorn.error")
@@ -0,0 +1,273 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Async Order Service
+
+This module serves the hot read paths of the REST API with async handlers
+and async SQLAlchemy sessions, so a worker keeps serving other requests
+while one waits on the database:
+
+    GET /api/orders
+    GET /api/orders/<order_id>
+    GET /api/orders/<order_id>/items
+
+Every other request, and any read the async handlers cannot answer exactly
+like the Flask routes (errors, projections, unknown arguments), is passed on
+to the Flask application running in a thread pool.
+"""
+import json
+import re
+from urllib.parse import parse_qsl, urlencode
+
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import selectinload
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from service.common.cache import cache, cache_key
+from service.common.pagination import decode_cursor, encode_cursor
+from service.models import DataValidationError, Item, Order
+
+# the async driver of each sync driver of the DATABASE_URI
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+psycopg",
+    "postgresql+psycopg": "postgresql+psycopg",
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+}
+
+# the arguments of GET /api/orders the async listing answers
+LIST_ARGS = {
+    "name",
+    "order_status",
+    "product_name",
+    "min_total",
+    "max_total",
+    "sort",
+    "limit",
+    "cursor",
+}
+
+
+def async_database_uri(uri: str) -> str:
+    """Returns the database URI with the async driver of its sync driver"""
+    scheme, rest = uri.split("://", 1)
+    if scheme not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver for '{scheme}'")
+    return f"{ASYNC_DRIVERS[scheme]}://{rest}"
+
+
+def split_pool(options: dict) -> tuple:
+    """Splits the connection pool of a worker between its two engines
+    Returns the engine options of the Flask application and of the async
+    handlers, whose pool_size and max_overflow add up to the configured
+    ones, with at least one connection each
+    """
+    sync_options, async_options = dict(options), dict(options)
+    for name, least in (("pool_size", 1), ("max_overflow", 0)):
+        if name in options:
+            # the async handlers serve the hot reads, they get the larger half
+            sync_options[name] = max(least, options[name] // 2)
+            async_options[name] = max(least, options[name] - sync_options[name])
+    return sync_options, async_options
+
+
+class JSONResponse:  # pylint: disable=too-few-public-methods
+    """A JSON response sent through the ASGI interface"""
+
+    def __init__(self, body, status: int = 200, headers: dict = None):
+        self.body = b"" if body is None else json.dumps(body).encode("utf-8") + b"\n"
+        self.status = status
+        self.headers = headers or {}
+
+    async def send(self, send) -> None:
+        """Sends the response"""
+        headers = [(b"content-type", b"application/json")]
+        headers.append((b"content-length", str(len(self.body)).encode("latin-1")))
+        headers += [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in self.headers.items()
+        ]
+        await send({"type": "http.response.start", "status": self.status, "headers": headers})
+        await send({"type": "http.response.body", "body": self.body})
+
+
+class AsyncOrderApp:
+    """ASGI application serving the hot reads asynchronously around the Flask application"""
+
+    def __init__(self, flask_app, engine_options: dict = None):
+        # the routes are only importable once the Flask app is created
+        # pylint: disable=import-outside-toplevel
+        from service import routes
+
+        self.flask_app = flask_app
+        self.routes = routes
+        self.wsgi = WsgiToAsgi(flask_app)
+        if engine_options is None:
+            engine_options = flask_app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+        options = dict(engine_options)
+        # the same pool settings, on the queue pool that async drivers need
+        if options.pop("poolclass", None):
+            options["poolclass"] = AsyncAdaptedQueuePool
+        self.engine = create_async_engine(
+            async_database_uri(flask_app.config["SQLALCHEMY_DATABASE_URI"]), **options
+        )
+        self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.handlers = [
+            (re.compile(r"/api/orders/?"), self.list_orders),
+            (re.compile(r"/api/orders/(\d+)"), self.get_order),
+            (re.compile(r"/api/orders/(\d+)/items"), self.list_items),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] == "http" and scope["method"] == "GET":
+            for pattern, handler in self.handlers:
+                match = pattern.fullmatch(scope["path"])
+                if match:
+                    response = await handler(scope, *map(int, match.groups()))
+                    if response is not None:
+                        await response.send(send)
+                        return
+                    break
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send) -> None:
+        """Disposes of the async connection pool when the server shuts down"""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    ######################################################################
+    #  H A N D L E R S
+    ######################################################################
+    # Each handler returns a JSONResponse, or None to let Flask answer
+
+    async def get_order(self, scope, order_id):
+        """Returns an Order like GET /api/orders/<order_id>"""
+        if scope["query_string"]:
+            return None
+        # answer a conditional request without loading the order, like Flask
+        if_none_match = _header(scope, b"if-none-match")
+        if if_none_match:
+            async with self.sessions() as session:
+                row = (await session.execute(Order.etag_statement(order_id))).first()
+            if row is not None:
+                etag = Order.etag_of_row(row)
+                if _etag_matches(if_none_match, etag):
+                    return JSONResponse(None, 304, self.routes.etag_header(etag))
+        key = cache_key(Order.__name__, order_id)
+        data = cache.get(key)
+        if data is None:
+            version = cache.version(key)
+            async with self.sessions() as session:
+                order = await session.get(
+                    Order, order_id, options=[selectinload(Order.items)]
+                )
+                if order is None:
+                    return None
+                data = order.serialize()
+            cache.set(key, data, version)
+        headers = self.routes.etag_header(Order.etag_of(data))
+        return JSONResponse(self.routes.marshal_orders(data), 200, headers)
+
+    async def list_orders(self, scope):
+        """Returns a page of Orders like GET /api/orders"""
+        args = dict(parse_qsl(scope["query_string"].decode("latin-1")))
+        if not set(args) <= LIST_ARGS:
+            return None
+        try:
+            sort, limit, filters = self._list_filters(args)
+            statement = Order.page_statement(sort=sort, limit=limit + 1, **filters)
+        except (ValueError, DataValidationError):
+            return None
+        async with self.sessions() as session:
+            orders = (await session.scalars(statement)).all()
+            headers = {}
+            if len(orders) > limit:
+                orders = orders[:limit]
+                last = orders[-1]
+                args["cursor"] = encode_cursor(getattr(last, sort.lstrip("-")), last.id)
+                headers["Link"] = f'<{_url(scope, args)}>; rel="next"'
+            results = [order.serialize() for order in orders]
+        return JSONResponse(self.routes.marshal_orders(results), 200, headers)
+
+    async def list_items(self, scope, order_id):
+        """Returns the Items of an Order like GET /api/orders/<order_id>/items"""
+        if scope["query_string"]:
+            return None
+        async with self.sessions() as session:
+            items = (
+                await session.scalars(
+                    select(Item).where(Item.order_id == order_id).order_by(Item.id)
+                )
+            ).all()
+            if not items and await session.get(Order, order_id) is None:
+                return None
+            results = [item.serialize() for item in items]
+        return JSONResponse(self.routes.marshal(results, self.routes.item_model))
+
+    def _list_filters(self, args):
+        """Validates the arguments of the listing like the Flask route does"""
+        config = self.flask_app.config
+        sort = args.get("sort", "created_at")
+        if sort.lstrip("-") not in Order.SORT_KEYS:
+            raise ValueError(f"Invalid sort '{sort}'")
+        limit = int(args.get("limit", config["DEFAULT_PAGE_SIZE"]))
+        if limit < 1:
+            raise ValueError("limit must be a positive integer")
+        filters = {
+            "customer_name": args.get("name"),
+            "order_status": args.get("order_status"),
+            "product_name": args.get("product_name"),
+            "min_total": float(args["min_total"]) if "min_total" in args else None,
+            "max_total": float(args["max_total"]) if "max_total" in args else None,
+            "after": decode_cursor(args["cursor"]) if args.get("cursor") else None,
+        }
+        return sort, min(limit, config["MAX_PAGE_SIZE"]), filters
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+def _header(scope, name: bytes):
+    """Returns the value of a request header or None"""
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """Compares an If-None-Match header with an entity tag like werkzeug does"""
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == f'"{etag}"' for tag in tags)
+
+
+def _url(scope, args: dict) -> str:
+    """Returns the external URL of the request path with other arguments"""
+    server_host, server_port = scope["server"]
+    host = _header(scope, b"host") or f"{server_host}:{server_port}"
+    return f"{scope['scheme']}://{host}{scope['path']}?{urlencode(args)}"
@@ -0,0 +1,287 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Cache
+
+This module contains the read-through cache of serialized records. The
+backend is chosen with CACHE_BACKEND:
+
+    none  - caching is turned off (the default)
+    lru   - a bounded in-process LRU cache with a TTL, for a single worker
+    redis - a cache shared by all workers in the Redis at CACHE_URL
+
+A reader takes the version of a key before it loads the record, and its
+set is dropped when the key was invalidated since, so a copy read before
+a write cannot be cached after the write invalidated it.
+"""
+import json
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+logger = logging.getLogger("flask.app")
+
+
+def cache_key(kind: str, by_id) -> str:
+    """Returns the cache key of the record of a kind with an id"""
+    return f"{kind}:{by_id}"
+
+
+######################################################################
+#  C A C H E   B A C K E N D S
+######################################################################
+class CacheBackend(ABC):
+    """Interface of the stores the cache can keep its values in"""
+
+    @abstractmethod
+    def get(self, key: str):
+        """Returns the value of a key or None when it is not cached"""
+
+    @abstractmethod
+    def version(self, key: str) -> int:
+        """Returns a version to pass to set, taken before the value is loaded"""
+
+    @abstractmethod
+    def set(self, key: str, value, version: int = None) -> None:
+        """Stores the value of a key unless it was invalidated after the version"""
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        """Removes a key and invalidates the versions taken before"""
+
+    @abstractmethod
+    def clear(self) -> None:
+        """Removes every key"""
+
+
+class NullCache(CacheBackend):
+    """A backend that never caches anything"""
+
+    def get(self, key: str):
+        return None
+
+    def version(self, key: str) -> int:
+        return 0
+
+    def set(self, key: str, value, version: int = None) -> None:
+        pass
+
+    def delete(self, key: str) -> None:
+        pass
+
+    def clear(self) -> None:
+        pass
+
+
+class LRUCache(CacheBackend):
+    """A thread safe in-process cache bounded in size and age
+
+    Its entries are only invalidated in the process that made the change,
+    so it is only consistent when a single worker serves the orders.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # the clock counts the deletes, and each recently deleted key keeps
+        # the clock of its delete; the keys dropped from that bounded map
+        # leave their clock in the floor
+        self._clock = 0
+        self._deleted = OrderedDict()
+        self._floor = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def version(self, key: str) -> int:
+        with self._lock:
+            return self._clock
+
+    def set(self, key: str, value, version: int = None) -> None:
+        with self._lock:
+            if version is not None and self._deleted.get(key, self._floor) > version:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+            self._clock += 1
+            self._deleted[key] = self._clock
+            self._deleted.move_to_end(key)
+            while len(self._deleted) > self.max_size:
+                _, clock = self._deleted.popitem(last=False)
+                self._floor = max(self._floor, clock)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            # every version taken before is stale
+            self._clock += 1
+            self._deleted.clear()
+            self._floor = self._clock
+
+
+class RedisCache(CacheBackend):
+    """A cache shared by every worker, kept as JSON in a Redis compatible client"""
+
+    # sets the value in KEYS[1] unless the delete marker in KEYS[2] is newer
+    # than the version in ARGV[2], in one step so no delete can come between
+    SET_UNLESS_DELETED = """
+local deleted = tonumber(redis.call('GET', KEYS[2]) or '0')
+if deleted > tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[3])
+return 1
+"""
+
+    def __init__(self, client, ttl: float = 60, prefix: str = "orders:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key: str):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def version(self, key: str) -> int:
+        return int(self.client.get(self.prefix + "clock") or 0)
+
+    def set(self, key: str, value, version: int = None) -> None:
+        value = json.dumps(value, default=str)
+        if version is None:
+            self.client.set(self.prefix + key, value, px=int(self.ttl * 1000))
+            return
+        self.client.eval(
+            self.SET_UNLESS_DELETED,
+            2,
+            self.prefix + key,
+            self.prefix + "deleted:" + key,
+            value,
+            version,
+            int(self.ttl * 1000),
+        )
+
+    def delete(self, key: str) -> None:
+        clock = self.client.incr(self.prefix + "clock")
+        # Cache.set drops the versions older than the ttl, so the marker
+        # only has to outlive them
+        self.client.set(self.prefix + "deleted:" + key, clock, px=int(self.ttl * 1000))
+        self.client.delete(self.prefix + key)
+
+    def clear(self) -> None:
+        for key in self.client.scan_iter(match=self.prefix + "*"):
+            if key != self.prefix + "clock":
+                self.client.delete(key)
+
+
+######################################################################
+#  C A C H E
+######################################################################
+class Cache:
+    """Counts the hits and misses of the configured backend"""
+
+    def __init__(self, backend: CacheBackend = None):
+        self.backend = NullCache() if backend is None else backend
+        self.ttl = getattr(self.backend, "ttl", 60)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app) -> None:
+        """Creates the backend selected by the app configuration"""
+        name = app.config.get("CACHE_BACKEND", "none").lower()
+        ttl = self.ttl = app.config.get("CACHE_TTL", 60)
+        if name == "lru":
+            self.backend = LRUCache(app.config.get("CACHE_MAX_SIZE", 1024), ttl)
+        elif name == "redis":
+            import redis  # pylint: disable=import-outside-toplevel, import-error
+
+            self.backend = RedisCache(redis.Redis.from_url(app.config["CACHE_URL"]), ttl)
+        elif name == "none":
+            self.backend = NullCache()
+        else:
+            raise ValueError(f"Unknown CACHE_BACKEND '{name}'")
+        self.hits = self.misses = 0
+        logger.info("Caching with %s", type(self.backend).__name__)
+
+    def get(self, key: str):
+        """Returns the cached value of a key or None"""
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def version(self, key: str) -> tuple:
+        """Returns the version of a key to take before loading its value"""
+        return self.backend.version(key), time.monotonic()
+
+    def set(self, key: str, value, version: tuple = None) -> None:
+        """Caches the value of a key, unless it was invalidated after the version"""
+        if version is None:
+            self.backend.set(key, value)
+            return
+        backend_version, taken = version
+        # the delete markers of the shared backend last one ttl, so an older
+        # read cannot know whether it missed one
+        if time.monotonic() - taken < self.ttl:
+            self.backend.set(key, value, backend_version)
+
+    def delete(self, *keys: str) -> None:
+        """Invalidates keys"""
+        for key in keys:
+            self.backend.delete(key)
+
+    def clear(self) -> None:
+        """Invalidates every key"""
+        self.backend.clear()
+
+    def stats(self) -> dict:
+        """Returns the hit and miss counters"""
+        with self._lock:
+            return {
+                "backend": type(self.backend).__name__,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+# The cache used by the models, configured by create_app
+cache = Cache()
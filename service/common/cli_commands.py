@@ -16,8 +16,11 @@
 """
 Flask CLI Command Extensions
 """
+import click
 from flask import current_app as app  # Import Flask application
-from service.models import db
+from service.common.idempotency import idempotency_keys
+from service.common.outbox import outbox
+from service.models import Order, OrderChange, db, migrations
 
 
 ######################################################################
@@ -32,5 +35,87 @@ def db_create():
     production. ;-)
     """
     db.drop_all()
-    db.create_all()
     db.session.commit()
+    migrations.upgrade(db.engine)
+
+
+######################################################################
+# Command to apply the schema migrations
+# Usage:
+#   flask db-upgrade
+######################################################################
+@app.cli.command("db-upgrade")
+def db_upgrade():
+    """
+    Brings the database schema to the version this code expects. Run it
+    once per release, before the new workers start.
+    """
+    for migration in migrations.upgrade(db.engine):
+        click.echo(f"Applied migration {migration.version}: {migration.description}")
+    click.echo(f"Schema version {migrations.HEAD}")
+
+
+######################################################################
+# Command to rebuild the denormalized totals of the orders
+# Usage:
+#   flask db-rebuild-totals
+######################################################################
+@app.cli.command("db-rebuild-totals")
+def db_rebuild_totals():
+    """
+    Recomputes the total_amount and item_count of every order from its
+    items, e.g. after loading data that bypassed the models
+    """
+    refreshed = Order.refresh_totals()
+    click.echo(f"Rebuilt the totals of {refreshed} orders")
+
+
+######################################################################
+# Command to remove the expired Idempotency-Keys
+# Usage:
+#   flask idempotency-sweep
+######################################################################
+@app.cli.command("idempotency-sweep")
+def idempotency_sweep():
+    """
+    Removes the stored responses of the Idempotency-Keys older than
+    IDEMPOTENCY_TTL. Run it periodically, e.g. from a CronJob.
+    """
+    removed = idempotency_keys.sweep()
+    click.echo(f"Removed {removed} expired idempotency keys")
+
+
+######################################################################
+# Command to remove the old changes of the change log
+# Usage:
+#   flask changes-prune
+######################################################################
+@app.cli.command("changes-prune")
+def changes_prune():
+    """
+    Removes the changes older than CHANGE_RETENTION_DAYS from the change
+    log. Run it periodically, e.g. from a CronJob.
+    """
+    removed = OrderChange.prune(app.config["CHANGE_RETENTION_DAYS"])
+    click.echo(f"Removed {removed} old changes")
+
+
+######################################################################
+# Command to deliver the Order events of the outbox
+# Usage:
+#   flask outbox-dispatch [--once]
+######################################################################
+@app.cli.command("outbox-dispatch")
+@click.option("--once", is_flag=True, help="Exit once the outbox is empty instead of polling it")
+def outbox_dispatch(once):
+    """
+    Delivers the Order events of the outbox to OUTBOX_SINK in batches of
+    OUTBOX_BATCH_SIZE, then polls it every OUTBOX_POLL_INTERVAL seconds.
+    Run as many workers as needed: they never deliver the same events.
+    """
+    if once:
+        delivered = outbox.drain()
+        click.echo(f"Delivered {delivered} order events")
+        return
+    click.echo(f"Delivering the order events to {type(outbox.sink).__name__}")
+    outbox.run()
@@ -0,0 +1,100 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Database Pool
+
+This module contains the connection pool used by the service and the
+statistics it keeps so the pool can be sized per pod
+"""
+import threading
+import time
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+class CheckoutStats:
+    """Thread safe counters of the connection checkouts of a pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float, timed_out: bool = False) -> None:
+        """Records how long one checkout waited for a connection"""
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def serialize(self) -> dict:
+        """Converts the counters into a dictionary"""
+        with self._lock:
+            attempts = self.checkouts + self.timeouts
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "checkout_wait_ms": {
+                    "total": round(self.total_wait * 1000, 3),
+                    "max": round(self.max_wait * 1000, 3),
+                    "avg": round(self.total_wait * 1000 / attempts, 3) if attempts else 0.0,
+                },
+            }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool that measures how long each checkout waits for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkout_stats = CheckoutStats()
+
+    def connect(self):
+        """Checks out a connection and records the time it took"""
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            self.checkout_stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.checkout_stats.record(time.perf_counter() - start)
+        return connection
+
+
+def pool_status(pool) -> dict:
+    """Returns the occupancy of a pool and its checkout statistics"""
+    stats = {"pool_class": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            {
+                "size": pool.size(),
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                "overflow": pool.overflow(),
+                "max_overflow": pool._max_overflow,
+                "timeout": pool.timeout(),
+            }
+        )
+    if isinstance(pool, InstrumentedQueuePool):
+        stats.update(pool.checkout_stats.serialize())
+    return stats
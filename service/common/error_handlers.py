@@ -18,7 +18,7 @@ Module: error_handlers
 """
 
 from flask import current_app as app  # Import Flask application
-from service.models import DataValidationError
+from service.models import ConflictError, DataValidationError
 from . import status
 from service.routes import api
 
@@ -36,3 +36,15 @@ def request_validation_error(error):
         "error": "Bad Request",
         "message": message,
     }, status.HTTP_400_BAD_REQUEST
+
+
+@api.errorhandler(ConflictError)
+def request_conflict(error):
+    """Handles updates that lost the race against another request"""
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        "status_code": status.HTTP_409_CONFLICT,
+        "error": "Conflict",
+        "message": message,
+    }, status.HTTP_409_CONFLICT
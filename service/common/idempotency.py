@@ -0,0 +1,196 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Idempotency Keys
+
+This module keeps the responses of the requests sent with an
+Idempotency-Key header, so a retried request is answered with the
+original response instead of being run again. A request reserves its
+key before it creates anything, and only runs when the reservation
+succeeded. The store is chosen with IDEMPOTENCY_BACKEND:
+
+    sql    - the idempotency_key table shared by all workers (the default)
+    memory - a bounded in-process store, for a single worker
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+logger = logging.getLogger("flask.app")
+
+MAX_KEY_LENGTH = 255
+
+
+def fingerprint(payload) -> str:
+    """Returns the digest of a JSON request body, whatever the order of its keys"""
+    body = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+
+######################################################################
+#  S T O R E S
+######################################################################
+class IdempotencyStore(ABC):
+    """Interface of the stores of the responses of Idempotency-Keys"""
+
+    @abstractmethod
+    def get(self, key: str):
+        """Returns the (fingerprint, response) of a key or None when it is not stored,
+        the response being None while the request of the key is running"""
+
+    @abstractmethod
+    def reserve(self, key: str, digest: str) -> bool:
+        """Stores a key without its response unless it is already stored, then returns False"""
+
+    @abstractmethod
+    def complete(self, key: str, response: dict) -> None:
+        """Stores the response of a reserved key"""
+
+    @abstractmethod
+    def release(self, key: str) -> None:
+        """Forgets a reserved key whose request failed"""
+
+    @abstractmethod
+    def sweep(self) -> int:
+        """Removes the expired keys and returns how many there were"""
+
+
+class MemoryStore(IdempotencyStore):
+    """A thread safe in-process store bounded in size and age"""
+
+    def __init__(self, max_size: int = 10000, ttl: float = 86400):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            return entry[1:]
+
+    def reserve(self, key: str, digest: str) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= time.monotonic():
+                return False
+            self._entries[key] = (time.monotonic() + self.ttl, digest, None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return True
+
+    def complete(self, key: str, response: dict) -> None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (entry[0], entry[1], response)
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is None:
+                del self._entries[key]
+
+    def sweep(self) -> int:
+        with self._lock:
+            now = time.monotonic()
+            expired = [key for key, entry in self._entries.items() if entry[0] < now]
+            for key in expired:
+                del self._entries[key]
+            return len(expired)
+
+
+class SQLStore(IdempotencyStore):
+    """A store shared by every worker, kept in the table of a model like IdempotencyKey"""
+
+    def __init__(self, model, ttl: float = 86400):
+        self.model = model
+        self.ttl = ttl
+
+    def get(self, key: str):
+        return self.model.find_response(key)
+
+    def reserve(self, key: str, digest: str) -> bool:
+        return self.model.reserve(key, digest, self.ttl)
+
+    def complete(self, key: str, response: dict) -> None:
+        self.model.complete(key, response)
+
+    def release(self, key: str) -> None:
+        # the key was in the transaction the failed request rolled back
+        pass
+
+    def sweep(self) -> int:
+        return self.model.sweep()
+
+
+######################################################################
+#  I D E M P O T E N C Y   K E Y S
+######################################################################
+class IdempotencyKeys:
+    """Gives access to the configured store"""
+
+    def __init__(self, store: IdempotencyStore = None):
+        self.store = MemoryStore() if store is None else store
+
+    def init_app(self, app) -> None:
+        """Creates the store selected by the app configuration"""
+        name = app.config.get("IDEMPOTENCY_BACKEND", "sql").lower()
+        ttl = app.config.get("IDEMPOTENCY_TTL", 86400)
+        if name == "sql":
+            from service.models import IdempotencyKey  # pylint: disable=import-outside-toplevel
+
+            self.store = SQLStore(IdempotencyKey, ttl)
+        elif name == "memory":
+            self.store = MemoryStore(app.config.get("IDEMPOTENCY_MAX_SIZE", 10000), ttl)
+        else:
+            raise ValueError(f"Unknown IDEMPOTENCY_BACKEND '{name}'")
+        logger.info("Storing Idempotency-Keys with %s", type(self.store).__name__)
+
+    def get(self, key: str):
+        """Returns the (fingerprint, response) of a key or None"""
+        return self.store.get(key)
+
+    def reserve(self, key: str, digest: str) -> bool:
+        """Reserves a key for a request, returns False when another request reserved it first"""
+        return self.store.reserve(key, digest)
+
+    def complete(self, key: str, response: dict) -> None:
+        """Stores the response of the request that reserved a key"""
+        self.store.complete(key, response)
+
+    def release(self, key: str) -> None:
+        """Frees the key of a request that failed, so it can be retried"""
+        self.store.release(key)
+
+    def sweep(self) -> int:
+        """Removes the expired keys"""
+        return self.store.sweep()
+
+
+# The Idempotency-Keys of the routes, configured by create_app
+idempotency_keys = IdempotencyKeys()
@@ -0,0 +1,134 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Outbox Dispatcher
+
+This module delivers the Order events the requests write to the outbox
+table in their own transaction. The dispatcher runs apart from the
+requests, with flask outbox-dispatch, and hands each batch of events to
+the sink chosen with OUTBOX_SINK:
+
+    file   - appends the events as newline delimited JSON to OUTBOX_FILE (the default)
+    memory - keeps the events in the process, for the tests
+
+Another transport only needs an EventSink passed to the Outbox.
+"""
+import json
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+
+logger = logging.getLogger("flask.app")
+
+
+######################################################################
+#  S I N K S
+######################################################################
+class EventSink(ABC):
+    """Interface of the destinations of the Order events"""
+
+    @abstractmethod
+    def send(self, events: list) -> None:
+        """Delivers a batch of serialized events, raises when they were not all delivered"""
+
+
+class MemorySink(EventSink):
+    """A thread safe in-process list of the delivered events"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.events = []
+
+    def __len__(self):
+        return len(self.events)
+
+    def send(self, events: list) -> None:
+        with self._lock:
+            self.events.extend(events)
+
+    def clear(self) -> None:
+        """Forgets the delivered events"""
+        with self._lock:
+            self.events.clear()
+
+
+class FileSink(EventSink):
+    """Appends the events to a file as newline delimited JSON"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def send(self, events: list) -> None:
+        lines = "".join(json.dumps(event, separators=(",", ":")) + "\n" for event in events)
+        # one write per batch, flushed before the events leave the outbox
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(lines)
+
+
+######################################################################
+#  O U T B O X
+######################################################################
+class Outbox:
+    """Drains the outbox of the Order events into the configured sink"""
+
+    def __init__(self, sink: EventSink = None, batch_size: int = 100, poll_interval: float = 1.0):
+        self.sink = MemorySink() if sink is None else sink
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+
+    def init_app(self, app) -> None:
+        """Creates the sink selected by the app configuration"""
+        name = app.config.get("OUTBOX_SINK", "file").lower()
+        if name == "file":
+            self.sink = FileSink(app.config.get("OUTBOX_FILE", "order_events.ndjson"))
+        elif name == "memory":
+            self.sink = MemorySink()
+        else:
+            raise ValueError(f"Unknown OUTBOX_SINK '{name}'")
+        self.batch_size = app.config.get("OUTBOX_BATCH_SIZE", 100)
+        self.poll_interval = app.config.get("OUTBOX_POLL_INTERVAL", 1.0)
+        logger.info("Delivering the Order events to %s", type(self.sink).__name__)
+
+    def dispatch(self) -> int:
+        """Delivers one batch of events and returns how many there were"""
+        from service.models import OrderEvent  # pylint: disable=import-outside-toplevel
+
+        return OrderEvent.dispatch(self.sink.send, self.batch_size)
+
+    def drain(self) -> int:
+        """Delivers the events until the outbox is empty and returns how many there were"""
+        delivered = 0
+        while True:
+            count = self.dispatch()
+            delivered += count
+            if count < self.batch_size:
+                return delivered
+
+    def run(self, should_stop=lambda: False) -> None:
+        """Drains the outbox, then polls it every poll_interval seconds until should_stop()"""
+        while not should_stop():
+            try:
+                self.drain()
+            except Exception as error:  # pylint: disable=broad-except
+                # the events stay in the outbox and are retried at the next poll
+                logger.error("Cannot deliver the Order events: %s", error)
+            time.sleep(self.poll_interval)
+
+
+# The outbox of the dispatcher, configured by create_app
+outbox = Outbox()
@@ -0,0 +1,53 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Pagination
+
+This module contains utility functions to encode and decode the opaque
+cursors used for keyset pagination of list endpoints
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+from decimal import Decimal
+
+from service.models import DataValidationError
+
+
+def encode_cursor(*values) -> str:
+    """Encodes the keyset values of the last row of a page into a cursor"""
+    keys = [
+        value.isoformat() if isinstance(value, datetime)
+        else str(value) if isinstance(value, Decimal)
+        else value
+        for value in values
+    ]
+    payload = json.dumps(keys, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> list:
+    """Decodes a cursor back into the list of keyset values it was made from"""
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        keys = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    except (binascii.Error, UnicodeDecodeError, ValueError) as error:
+        raise DataValidationError(f"Invalid cursor '{cursor}'") from error
+    if not isinstance(keys, list):
+        raise DataValidationError(f"Invalid cursor '{cursor}'")
+    return keys
@@ -3,6 +3,7 @@ Global Configuration for Application
 """
 import os
 import logging
+from service.common.db_pool import InstrumentedQueuePool
 
 # Get configuration from environment
 DATABASE_URI = os.getenv(
@@ -13,7 +14,59 @@ DATABASE_URI = os.getenv(
 # Configure SQLAlchemy
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
-# SQLALCHEMY_POOL_SIZE = 2
+
+# Connection pool of each worker process
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() in ["true", "yes", "1"],
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+}
+# an in-memory SQLite database only exists on its single connection
+if DATABASE_URI not in ["sqlite://", "sqlite:///:memory:"]:
+    SQLALCHEMY_ENGINE_OPTIONS.update(
+        {
+            "poolclass": InstrumentedQueuePool,
+            "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+            "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+            "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        }
+    )
+
+# Apply the schema migrations at startup, for development: deployments run
+# flask db-upgrade once per release so the workers only check the version
+SCHEMA_AUTO_UPGRADE = os.getenv("SCHEMA_AUTO_UPGRADE", "false").lower() in ["true", "yes", "1"]
+
+# Keyset pagination of list endpoints
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+
+# Number of orders fetched at a time by the streaming export
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+# Batch endpoints: the most elements accepted in one request and how many
+# are inserted per transaction (0 inserts the whole batch in one transaction)
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "1000"))
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "0"))
+
+# Read-through cache of serialized orders: none, redis or lru. The lru cache
+# is kept in each worker and only suits a single worker
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "none")
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "1024"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "60"))
+CACHE_URL = os.getenv("CACHE_URL", "redis://localhost:6379/0")
+
+# Responses kept for the Idempotency-Key header of POST /orders: sql or memory
+IDEMPOTENCY_BACKEND = os.getenv("IDEMPOTENCY_BACKEND", "sql")
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_MAX_SIZE = int(os.getenv("IDEMPOTENCY_MAX_SIZE", "10000"))
+
+# Days the change log of GET /orders/changes keeps the changes
+CHANGE_RETENTION_DAYS = float(os.getenv("CHANGE_RETENTION_DAYS", "7"))
+
+# Delivery of the Order events of the outbox by flask outbox-dispatch: file or memory
+OUTBOX_SINK = os.getenv("OUTBOX_SINK", "file")
+OUTBOX_FILE = os.getenv("OUTBOX_FILE", "order_events.ndjson")
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
@@ -2,6 +2,10 @@
 Defined model information
 """
 
-from .persistent_base import db, DataValidationError, PersistentBase
+from .persistent_base import db, ConflictError, DataValidationError, PersistentBase, keeping_values, make_etag
 from .item import Item
 from .order import Order, OrderStatus
+from .order_change import OrderChange
+from .order_event import OrderEvent
+from .idempotency_key import IdempotencyKey
+from . import migrations
@@ -0,0 +1,88 @@
+"""
+Properties and functions for the Idempotency Keys of requests
+"""
+
+import logging
+from datetime import timedelta
+from sqlalchemy import JSON, bindparam, delete, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from .persistent_base import db, utcnow
+
+logger = logging.getLogger("flask.app")
+
+
+class IdempotencyKey(db.Model):
+    """Class that represents the stored response of a request with an Idempotency-Key"""
+
+    __tablename__ = "idempotency_key"
+    __table_args__ = (db.Index("ix_idempotency_key_expires_at", "expires_at"),)
+
+    key = db.Column(db.String(255), primary_key=True)
+    # digest of the request body, so a key cannot be replayed for another request
+    fingerprint = db.Column(db.String(40), nullable=False)
+    # the JSON null while the request of a reserved key is running
+    response = db.Column(db.JSON, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<IdempotencyKey key=[{self.key}] expires_at={self.expires_at}>"
+
+    @classmethod
+    def find_response(cls, key: str):
+        """Returns the (fingerprint, response) of a key that has not expired, or None"""
+        # a Core execution of the prebuilt SELECT: building the statement and
+        # the ORM result would cost several times the round trip
+        row = db.session.connection().execute(_FIND_RESPONSE, {"key": key, "now": utcnow()}).first()
+        return None if row is None else tuple(row)
+
+    @classmethod
+    def reserve(cls, key: str, fingerprint: str, ttl: float) -> bool:
+        """Adds a pending key to the transaction of the session
+        Returns False, and adds nothing, when a key that has not expired is
+        stored. The key is committed with the record the request creates, so
+        a concurrent request with the same key waits for that transaction and
+        never creates its own record.
+        """
+        logger.info("Reserving Idempotency-Key %s", key)
+        now = utcnow()
+        insert = (postgresql.insert if db.engine.dialect.name == "postgresql" else sqlite.insert)(cls)
+        statement = (
+            insert.values(
+                key=key,
+                fingerprint=fingerprint,
+                response=JSON.NULL,
+                expires_at=now + timedelta(seconds=ttl),
+            )
+            # an expired key that was not swept yet is taken over
+            .on_conflict_do_update(
+                index_elements=[cls.key],
+                set_={
+                    "fingerprint": insert.excluded.fingerprint,
+                    "response": insert.excluded.response,
+                    "expires_at": insert.excluded.expires_at,
+                },
+                where=cls.expires_at <= now,
+            )
+            .returning(cls.key)
+        )
+        return db.session.execute(statement).first() is not None
+
+    @classmethod
+    def complete(cls, key: str, response: dict) -> None:
+        """Stores the response of a reserved key"""
+        logger.info("Storing the response of Idempotency-Key %s", key)
+        db.session.execute(update(cls).where(cls.key == key).values(response=response))
+        db.session.commit()
+
+    @classmethod
+    def sweep(cls) -> int:
+        """Removes the expired keys and returns how many there were"""
+        removed = db.session.execute(delete(cls).where(cls.expires_at <= utcnow())).rowcount
+        db.session.commit()
+        logger.info("Removed %d expired Idempotency-Keys", removed)
+        return removed
+
+
+_FIND_RESPONSE = select(IdempotencyKey.fingerprint, IdempotencyKey.response).where(
+    IdempotencyKey.key == bindparam("key"), IdempotencyKey.expires_at > bindparam("now")
+)
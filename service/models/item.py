@@ -3,25 +3,66 @@ Properties and functions for Item
 """
 
 import logging
-from .persistent_base import db, PersistentBase, DataValidationError
+from decimal import ROUND_HALF_UP, Decimal
+from sqlalchemy import select
+from service.common.cache import cache_key
+from .persistent_base import db, PersistentBase, DataValidationError, make_etag
 
 logger = logging.getLogger("flask.app")
 
+CENT = Decimal("0.01")
+
+
+def to_cents(price) -> Decimal:
+    """Returns a price as the price column stores it, rounded half up to the cent"""
+    return Decimal(str(price)).quantize(CENT, rounding=ROUND_HALF_UP)
+
 
 class Item(db.Model, PersistentBase):
     """Class that represents an Item"""
 
+    __table_args__ = (
+        # every lookup of an Item is scoped by its Order, and the items of an
+        # Order are read in id order, so both are served by this index
+        db.Index("ix_item_order_id_id", "order_id", "id"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(
-        db.Integer, db.ForeignKey("order.id", ondelete="CASCADE"), nullable=False
+        db.Integer,
+        db.ForeignKey("order.id", ondelete="CASCADE"),
+        nullable=False,
     )
-    product_name = db.Column(db.String(64), nullable=False)
+    product_name = db.Column(db.String(64), nullable=False, index=True)
     quantity = db.Column(db.Integer, nullable=False)
     price = db.Column(db.Numeric(10, 2), nullable=False)
 
     def __repr__(self):
         return f"<Item id={self.id} product_name=[{self.product_name}] order_id={self.order_id} price={self.price}>"
 
+    @property
+    def etag(self) -> str:
+        """Returns the entity tag of the current version of the Item"""
+        return make_etag(self.id, self.updated_at.isoformat())
+
+    @staticmethod
+    def etag_of(data: dict) -> str:
+        """Returns the entity tag of a serialized Item"""
+        return make_etag(data["id"], data["updated_at"])
+
+    @classmethod
+    def find_in_order(cls, order_id, item_id):
+        """Finds an Item by its id, only when it belongs to the Order"""
+        logger.info("Processing lookup for Item %s of Order %s ...", item_id, order_id)
+        return db.session.scalars(
+            select(cls).where(cls.order_id == order_id, cls.id == item_id)
+        ).one_or_none()
+
+    def cache_keys(self) -> list:
+        """Returns the keys of the Item and of its Order, which embeds the Item"""
+        order_id = self.order_id if self.order_id is not None else self.order.id
+        return super().cache_keys() + [cache_key("Order", order_id)]
+
     def serialize(self):
         """Converts an Item into a dictionary"""
         return {
@@ -32,18 +73,29 @@ class Item(db.Model, PersistentBase):
             "price": self.price,
             "created_at": self.created_at.isoformat(),
             "updated_at": self.updated_at.isoformat(),
+            "version": self.version,
         }
 
     def deserialize(self, data):
         """Populates an Item from a dictionary"""
         try:
             self.product_name = data["product_name"]
-            self.quantity = data["quantity"]
-            self.price = data["price"]
+            quantity = data["quantity"]
+            # a float would be truncated by the column, and a bool is an int
+            if isinstance(quantity, bool) or not isinstance(quantity, int):
+                raise DataValidationError(f"Invalid Item: quantity must be an integer, not {quantity!r}")
+            self.quantity = quantity
+            # rounded like the column, so the amounts computed in Python and in
+            # SQL from the stored price are the same on every database
+            self.price = to_cents(data["price"])
         except KeyError as error:
             raise DataValidationError(
                 "Invalid Item: missing " + error.args[0]
             ) from error
+        except ArithmeticError as error:
+            raise DataValidationError(
+                f"Invalid Item: price must be a number, not {data['price']!r}"
+            ) from error
         except TypeError as error:
             raise DataValidationError(
                 "Invalid Item: body of request contained bad or no data " + str(error)
@@ -0,0 +1,343 @@
+"""
+Versioned schema migrations
+
+Each migration brings the database from the version before it to its own
+version. The applied versions are recorded in the schema_version table, so
+the service only reads that table at startup instead of creating the
+tables. Run the migrations with:
+
+    flask db-upgrade
+
+A migration describes the schema as it was when it was written, not the
+current models, so its result never changes. Every step checks what is
+already there, which lets a database created by db.create_all() before
+the migrations existed be upgraded in place.
+"""
+
+import logging
+from datetime import datetime, timezone
+from typing import Callable, NamedTuple
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Enum,
+    ForeignKey,
+    Index,
+    Integer,
+    JSON,
+    MetaData,
+    Numeric,
+    String,
+    Table,
+    func,
+    insert,
+    inspect,
+    select,
+    update,
+)
+from sqlalchemy.exc import DBAPIError, OperationalError, ProgrammingError
+from sqlalchemy.schema import CreateColumn
+
+from .persistent_base import db
+
+logger = logging.getLogger("flask.app")
+
+# serializes concurrent upgrades on PostgreSQL, e.g. from several pods
+ADVISORY_LOCK_KEY = 2820
+
+schema_version = db.Table(
+    "schema_version",
+    db.Column("version", db.Integer, primary_key=True),
+    db.Column("description", db.String(128), nullable=False),
+    db.Column("applied_at", db.DateTime, nullable=False),
+)
+
+
+class SchemaVersionError(Exception):
+    """Used when the schema of the database is behind the code"""
+
+
+class Migration(NamedTuple):
+    """A numbered change to the schema"""
+
+    version: int
+    description: str
+    apply: Callable
+
+
+######################################################################
+#  M I G R A T I O N S
+######################################################################
+def _order_table(*columns):
+    """Returns the order table with only the columns a migration needs"""
+    return Table("order", MetaData(), Column("id", Integer, primary_key=True), *columns)
+
+
+def _item_table(*columns):
+    """Returns the item table with only the columns a migration needs"""
+    return Table("item", MetaData(), Column("id", Integer, primary_key=True), *columns)
+
+
+def _add_column(connection, column) -> None:
+    """Adds a column to its table unless it is already there"""
+    table = column.table
+    if column.name in {col["name"] for col in inspect(connection).get_columns(table.name)}:
+        return
+    name = connection.dialect.identifier_preparer.format_table(table)
+    spec = CreateColumn(column).compile(dialect=connection.dialect)
+    connection.exec_driver_sql(f"ALTER TABLE {name} ADD COLUMN {spec}")
+
+
+def _create_indexes(connection, *indexes) -> None:
+    """Creates the indexes that do not exist yet"""
+    for index in indexes:
+        index.create(connection, checkfirst=True)
+
+
+def create_tables(connection) -> None:
+    """Version 1: the order and item tables"""
+    metadata = MetaData()
+    timestamps = ("created_at", "updated_at")
+    Table(
+        "order",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("customer_name", String(64), nullable=False),
+        Column(
+            "status",
+            Enum("CREATED", "IN_PROGRESS", "SHIPPED", "COMPLETED", "CANCELLED", name="orderstatus"),
+            nullable=False,
+        ),
+        *(Column(name, DateTime, nullable=False) for name in timestamps),
+    )
+    Table(
+        "item",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("order_id", Integer, ForeignKey("order.id", ondelete="CASCADE"), nullable=False),
+        Column("product_name", String(64), nullable=False),
+        Column("quantity", Integer, nullable=False),
+        Column("price", Numeric(10, 2), nullable=False),
+        *(Column(name, DateTime, nullable=False) for name in timestamps),
+    )
+    metadata.create_all(connection, checkfirst=True)
+
+
+def index_filters(connection) -> None:
+    """Version 2: the indexes of the listing filters and the item lookups"""
+    order = _order_table(Column("customer_name"), Column("status"), Column("created_at"))
+    item = _item_table(Column("order_id"), Column("product_name"))
+    _create_indexes(
+        connection,
+        Index("ix_order_customer_name", order.c.customer_name),
+        Index("ix_order_status_created_at", order.c.status, order.c.created_at, order.c.id),
+        Index("ix_order_created_at_id", order.c.created_at, order.c.id),
+        Index("ix_item_order_id", item.c.order_id),
+        Index("ix_item_product_name", item.c.product_name),
+    )
+
+
+def add_order_totals(connection) -> None:
+    """Version 3: the denormalized total_amount and item_count of the orders"""
+    order = _order_table(
+        Column("total_amount", Numeric(12, 2), server_default="0", nullable=False),
+        Column("item_count", Integer, server_default="0", nullable=False),
+    )
+    item = _item_table(Column("order_id"), Column("quantity"), Column("price"))
+    _add_column(connection, order.c.total_amount)
+    _add_column(connection, order.c.item_count)
+    # pylint: disable=not-callable
+    of_order = item.c.order_id == order.c.id
+    connection.execute(
+        update(order).values(
+            # rounded to the cent like the totals the service maintains
+            total_amount=func.round(
+                select(func.coalesce(func.sum(item.c.quantity * item.c.price), 0))
+                .where(of_order)
+                .scalar_subquery(),
+                2,
+            ),
+            item_count=select(func.count(item.c.id)).where(of_order).scalar_subquery(),
+        )
+    )
+    _create_indexes(connection, Index("ix_order_total_amount_id", order.c.total_amount, order.c.id))
+
+
+def add_versions(connection) -> None:
+    """Version 4: the optimistic concurrency counters of the orders and items"""
+    for table in (_order_table, _item_table):
+        _add_column(connection, table(Column("version", Integer, server_default="1", nullable=False)).c.version)
+
+
+def scope_item_lookups(connection) -> None:
+    """Version 5: index the items by their order and id instead of their order"""
+    item = _item_table(Column("order_id"))
+    _create_indexes(connection, Index("ix_item_order_id_id", item.c.order_id, item.c.id))
+    Index("ix_item_order_id", item.c.order_id).drop(connection, checkfirst=True)
+
+
+def create_idempotency_keys(connection) -> None:
+    """Version 6: the stored responses of the requests with an Idempotency-Key"""
+    metadata = MetaData()
+    table = Table(
+        "idempotency_key",
+        metadata,
+        Column("key", String(255), primary_key=True),
+        Column("fingerprint", String(40), nullable=False),
+        Column("response", JSON, nullable=False),
+        Column("expires_at", DateTime, nullable=False),
+    )
+    Index("ix_idempotency_key_expires_at", table.c.expires_at)
+    metadata.create_all(connection, checkfirst=True)
+
+
+def create_search_indexes(connection) -> None:
+    """Version 7: the trigram indexes of the substring searches, on PostgreSQL"""
+    if connection.dialect.name != "postgresql":
+        return
+    try:
+        # in a savepoint, so a database without pg_trgm carries on upgrading
+        with connection.begin_nested():
+            connection.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except DBAPIError as error:
+        logger.warning("pg_trgm is not available, the searches scan the tables: %s", error.orig)
+        return
+    order = _order_table(Column("customer_name"))
+    item = _item_table(Column("product_name"))
+    _create_indexes(
+        connection,
+        Index(
+            "ix_order_customer_name_trgm",
+            order.c.customer_name,
+            postgresql_using="gin",
+            postgresql_ops={"customer_name": "gin_trgm_ops"},
+        ),
+        Index(
+            "ix_item_product_name_trgm",
+            item.c.product_name,
+            postgresql_using="gin",
+            postgresql_ops={"product_name": "gin_trgm_ops"},
+        ),
+    )
+
+
+def index_sorts(connection) -> None:
+    """Version 8: an index for each sort order of the listing, and a BRIN of the creation times"""
+    order = _order_table(Column("customer_name"), Column("created_at"), Column("updated_at"))
+    _create_indexes(
+        connection,
+        Index("ix_order_customer_name_id", order.c.customer_name, order.c.id),
+        Index("ix_order_updated_at_id", order.c.updated_at, order.c.id),
+    )
+    # the new index starts with the customer name, so it serves its filter too
+    Index("ix_order_customer_name", order.c.customer_name).drop(connection, checkfirst=True)
+    if connection.dialect.name == "postgresql":
+        # orders are appended in creation order, so a few blocks summarize
+        # the time window of many rows for the scans of large windows
+        _create_indexes(
+            connection, Index("ix_order_created_at_brin", order.c.created_at, postgresql_using="brin")
+        )
+
+
+def create_change_log(connection) -> None:
+    """Version 9: the change log of the orders and items"""
+    metadata = MetaData()
+    table = Table(
+        "order_change",
+        metadata,
+        Column("seq", BigInteger().with_variant(Integer, "sqlite"), primary_key=True),
+        Column("txid", BigInteger, nullable=False),
+        Column("entity", String(8), nullable=False),
+        Column("entity_id", Integer, nullable=False),
+        Column("order_id", Integer, nullable=False),
+        Column("operation", String(8), nullable=False),
+        Column("changed_at", DateTime, nullable=False),
+    )
+    Index("ix_order_change_txid_seq", table.c.txid, table.c.seq)
+    Index("ix_order_change_changed_at", table.c.changed_at)
+    metadata.create_all(connection, checkfirst=True)
+
+
+def create_outbox(connection) -> None:
+    """Version 10: the outbox of the order events"""
+    Table(
+        "order_event",
+        MetaData(),
+        Column("id", BigInteger().with_variant(Integer, "sqlite"), primary_key=True),
+        Column("event_type", String(32), nullable=False),
+        Column("order_id", Integer, nullable=False),
+        Column("payload", JSON, nullable=False),
+        Column("created_at", DateTime, nullable=False),
+    ).create(connection, checkfirst=True)
+
+
+MIGRATIONS = [
+    Migration(1, "Create the order and item tables", create_tables),
+    Migration(2, "Index the listing filters and item lookups", index_filters),
+    Migration(3, "Store the totals of the orders", add_order_totals),
+    Migration(4, "Add the version counters of the orders and items", add_versions),
+    Migration(5, "Index the items by order and id", scope_item_lookups),
+    Migration(6, "Create the idempotency key table", create_idempotency_keys),
+    Migration(7, "Index the searched names by trigrams", create_search_indexes),
+    Migration(8, "Index the sort orders of the listing", index_sorts),
+    Migration(9, "Create the change log", create_change_log),
+    Migration(10, "Create the outbox of the order events", create_outbox),
+]
+
+# the indexes only a migration creates, where the database supports them,
+# which the models do not declare
+SEARCH_INDEXES = ("ix_order_customer_name_trgm", "ix_item_product_name_trgm")
+POSTGRESQL_INDEXES = SEARCH_INDEXES + ("ix_order_created_at_brin",)
+
+# the version the models of this code expect
+HEAD = MIGRATIONS[-1].version
+
+
+######################################################################
+#  U P G R A D E   A N D   V E R I F I C A T I O N
+######################################################################
+def current_version(connection) -> int:
+    """Returns the schema version of the database, 0 when it has none"""
+    try:
+        return connection.execute(select(func.max(schema_version.c.version))).scalar() or 0
+    except (OperationalError, ProgrammingError):
+        # no schema_version table yet
+        connection.rollback()
+        return 0
+
+
+def upgrade(engine) -> list:
+    """Applies the migrations the database is missing and returns them"""
+    applied = []
+    with engine.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            connection.execute(select(func.pg_advisory_xact_lock(ADVISORY_LOCK_KEY)))
+        schema_version.create(connection, checkfirst=True)
+        version = connection.execute(select(func.max(schema_version.c.version))).scalar() or 0
+        for migration in MIGRATIONS[version:]:
+            logger.info("Applying migration %d: %s", migration.version, migration.description)
+            migration.apply(connection)
+            connection.execute(
+                insert(schema_version).values(
+                    version=migration.version,
+                    description=migration.description,
+                    applied_at=datetime.now(timezone.utc),
+                )
+            )
+            applied.append(migration)
+    return applied
+
+
+def verify(engine) -> int:
+    """Returns the schema version of the database
+    Raises a SchemaVersionError when it is behind the code, which would fail
+    on the tables and columns it is missing. A newer schema is accepted, so
+    the workers of the previous release keep serving during a rollout.
+    """
+    with engine.connect() as connection:
+        version = current_version(connection)
+    if version < HEAD:
+        raise SchemaVersionError(f"Schema version {version} is behind version {HEAD}: run flask db-upgrade")
+    return version
@@ -3,9 +3,17 @@ Defined properties and methods of the order model
 """
 
 import logging
+from datetime import datetime, timezone
+from decimal import Decimal
 from enum import Enum
-from .persistent_base import db, PersistentBase, DataValidationError
-from .item import Item
+from sqlalchemy import and_, case, desc, event, false, func, inspect, or_, select, tuple_, update
+from sqlalchemy.orm import load_only, query_expression, selectinload, with_expression
+from sqlalchemy.orm.attributes import set_committed_value
+from service.common.cache import cache, cache_key
+from .persistent_base import db, PersistentBase, ConflictError, DataValidationError, make_etag
+from .item import Item, to_cents
+from .order_change import OrderChange
+from .order_event import OrderEvent
 
 logger = logging.getLogger("flask.app")
 
@@ -24,37 +32,97 @@ class OrderStatus(Enum):
         """Lists different order statuses"""
         return list(map(lambda s: s.value, OrderStatus))
 
+    def sources(self) -> list:
+        """Lists the statuses an order may change to this one from"""
+        return [status for status, targets in TRANSITIONS.items() if self in targets]
+
+
+# the statuses each status may change to: any other one, except from
+# CANCELLED, which is terminal
+TRANSITIONS = {
+    source: set() if source == OrderStatus.CANCELLED else {target for target in OrderStatus if target != source}
+    for source in OrderStatus
+}
+
 
 class Order(db.Model, PersistentBase):
     """Class that represents an Order"""
 
     # Table Schema
+    __table_args__ = (
+        # status filter in the (created_at, id) order of the listing
+        db.Index("ix_order_status_created_at", "status", "created_at", "id"),
+        # unfiltered listing, created_after / created_before and keyset pagination
+        db.Index("ix_order_created_at_id", "created_at", "id"),
+        # min_total / max_total filters and the listing sorted by value
+        db.Index("ix_order_total_amount_id", "total_amount", "id"),
+        # customer name filter and the listing sorted by customer name
+        db.Index("ix_order_customer_name_id", "customer_name", "id"),
+        # updated_since filter and the listing sorted by last update
+        db.Index("ix_order_updated_at_id", "updated_at", "id"),
+    )
+
+    # the fields of an Order without its items, as the change feed returns it
+    CHANGE_FIELDS = ("customer_name", "status", "total_amount", "item_count", "version")
+
+    # the fields of the payload of the events of the outbox, with the id
+    EVENT_FIELDS = ("customer_name", "status", "version")
+
+    # the sort orders of the listing, with the parser of their keyset value,
+    # each served by an index on (key, id) of __table_args__
+    SORT_KEYS = {
+        "created_at": datetime.fromisoformat,
+        "updated_at": datetime.fromisoformat,
+        "total_amount": Decimal,
+        "customer_name": str,
+    }
 
     id = db.Column(db.Integer, primary_key=True)
     customer_name = db.Column(db.String(64), nullable=False)
     status = db.Column(
         db.Enum(OrderStatus), default=OrderStatus.CREATED, nullable=False
     )
-    items = db.relationship("Item", backref="order", passive_deletes=True)
+    # sum of quantity * price and number of the items, kept up to date on
+    # every flush by maintain_totals so reads never aggregate the items
+    total_amount = db.Column(
+        db.Numeric(12, 2), default=Decimal("0.00"), server_default="0", nullable=False
+    )
+    item_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)
+    items = db.relationship("Item", backref="order", passive_deletes=True, order_by="Item.id")
+    # how well the customer_name matches the q of a search, 0 being the best,
+    # only loaded by the searches of page_statement
+    search_rank = query_expression()
 
     def __repr__(self):
         return f"<Order id={self.id} by {self.customer_name}>"
 
-    def serialize(self):
-        """Converts an Order into a dictionary"""
-        if not isinstance(self.status, OrderStatus):
+    def serialize(self, fields=None):
+        """Converts an Order into a dictionary
+        Args:
+            fields (list): only serialize the id and these fields, so the
+                columns and items that are not asked for are never loaded
+        """
+        if (fields is None or "status" in fields) and not isinstance(
+            self.status, OrderStatus
+        ):
             raise DataValidationError(
                 f"Invalid status value '{self.status}' not in OrderStatus Enum"
             )
 
-        return {
-            "id": self.id,
-            "customer_name": self.customer_name,
-            "status": self.status.value,
-            "created_at": self.created_at.isoformat(),
-            "updated_at": self.updated_at.isoformat(),
-            "items": [item.serialize() for item in self.items],
+        # the lambdas only read, and so load, the fields that are asked for
+        # pylint: disable=unnecessary-lambda
+        serializers = {
+            "customer_name": lambda: self.customer_name,
+            "status": lambda: self.status.value,
+            "created_at": lambda: self.created_at.isoformat(),
+            "updated_at": lambda: self.updated_at.isoformat(),
+            "version": lambda: self.version,
+            "total_amount": lambda: self.total_amount,
+            "item_count": lambda: self.item_count,
+            "items": lambda: [item.serialize() for item in self.items],
         }
+        names = serializers if fields is None else fields
+        return {"id": self.id, **{name: serializers[name]() for name in names}}
 
     def deserialize(self, data):
         """Populates an Order from a dictionary"""
@@ -86,23 +154,805 @@ class Order(db.Model, PersistentBase):
 
         return self
 
+    @staticmethod
+    def etag_of(data: dict) -> str:
+        """Returns the entity tag of a serialized Order"""
+        items_updated_at = max((item["updated_at"] for item in data["items"]), default=None)
+        return make_etag(data["updated_at"], len(data["items"]), items_updated_at)
+
+    @classmethod
+    def etag_statement(cls, order_id):
+        """Returns the SELECT of the parts of the entity tag of an Order, so
+        the sync and async lookups share it"""
+        return (
+            select(
+                cls.updated_at,
+                func.count(Item.id),  # pylint: disable=not-callable
+                func.max(Item.updated_at),
+            )
+            .outerjoin(Item, Item.order_id == cls.id)
+            .where(cls.id == order_id)
+            .group_by(cls.id, cls.updated_at)
+        )
+
+    @staticmethod
+    def etag_of_row(row) -> str:
+        """Returns the entity tag of a row of etag_statement()"""
+        updated_at, item_count, items_updated_at = row
+        return make_etag(
+            updated_at.isoformat(),
+            item_count,
+            items_updated_at.isoformat() if items_updated_at else None,
+        )
+
+    @classmethod
+    def find_etag(cls, order_id):
+        """Returns the entity tag of an Order without loading it or its items"""
+        logger.info("Processing entity tag lookup for id %s ...", order_id)
+        row = db.session.execute(cls.etag_statement(order_id)).first()
+        if row is None:
+            return None
+        return cls.etag_of_row(row)
+
+    @classmethod
+    def find_projected(cls, order_id, fields):
+        """Finds an Order by its id, loading only the given fields"""
+        logger.info("Processing lookup of %s for id %s ...", fields, order_id)
+        return (
+            cls.query.options(*cls._load_options(fields))
+            .filter(cls.id == order_id)
+            .first()
+        )
+
+    @classmethod
+    def find_status(cls, order_id):
+        """Returns the status of an Order with a single column query"""
+        logger.info("Processing status lookup for id %s ...", order_id)
+        return db.session.execute(
+            select(cls.status).where(cls.id == order_id)
+        ).scalar_one_or_none()
+
+    @classmethod
+    def find_statuses(cls, order_ids) -> dict:
+        """Returns the status of each existing Order of the ids with one query"""
+        if not order_ids:
+            return {}
+        rows = db.session.execute(select(cls.id, cls.status).where(cls.id.in_(order_ids)))
+        return dict(rows.all())
+
     @classmethod
-    def find_by_filters(cls, customer_name=None, order_status=None, product_name=None):
-        """Returns all Orders with the given filters
+    def find_ids(cls, limit=None, **filters) -> list:
+        """Returns the ids of the Orders with the given filters in id order
+        Args:
+            limit (int): the maximum number of ids to return
+            filters: customer_name, order_status, product_name, min_total and max_total
+        """
+        statement = (
+            cls._filter_statement(
+                filters.pop("customer_name", None),
+                filters.pop("order_status", None),
+                filters.pop("product_name", None),
+                fields=(),
+                **filters,
+            )
+            .with_only_columns(cls.id)
+            .order_by(cls.id)
+            .limit(limit)
+        )
+        return db.session.scalars(statement).all()
+
+    @classmethod
+    def all(cls):
+        """Returns all of the Orders with their items loaded in one batch"""
+        logger.info("Processing all Orders")
+        return cls.query.options(selectinload(cls.items)).all()
+
+    @classmethod
+    def find_by_filters(cls, **filters):
+        """Returns all Orders with the given filters in the given sort order
+        Args:
+            filters: the keyword arguments of page_statement
+        """
+        return db.session.scalars(cls.page_statement(**filters)).all()
+
+    @classmethod
+    def page_statement(
+        cls,
+        customer_name=None,
+        order_status=None,
+        product_name=None,
+        limit=None,
+        after=None,
+        fields=None,
+        min_total=None,
+        max_total=None,
+        sort="created_at",
+        **criteria,
+    ):  # pylint: disable=too-many-arguments, too-many-positional-arguments
+        """Builds the SELECT of a page of Orders, run by find_by_filters and the async reads
         Args:
             customer_name (string): the name of the customer whose orders you want
             order_status (string): the status of orders you want
             product_name (string): the product_name of orders you want
+            limit (int): the maximum number of orders to return
+            after (list): the [sort key, id] keyset of the last order of the
+                previous page; only orders sorted after it are returned
+            fields (list): only load these fields of the orders
+            min_total (Decimal): the smallest total_amount of orders you want
+            max_total (Decimal): the largest total_amount of orders you want
+            sort (string): a key of SORT_KEYS, prefixed with - to sort descending
+            criteria: the time windows and searches of _criteria; a q ranks
+                the orders by search_rank before the sort order, and its after
+                keyset starts with the search_rank of the last order
         """
-        query = cls.query
+        if sort.lstrip("-") not in cls.SORT_KEYS:
+            raise DataValidationError(f"Invalid sort '{sort}'")
+        column = getattr(cls, sort.lstrip("-"))
+        statement = cls._filter_statement(
+            customer_name,
+            order_status,
+            product_name,
+            fields=fields,
+            loaded=(column,),
+            min_total=min_total,
+            max_total=max_total,
+            **criteria,
+        )
+        rank = cls._search_rank(criteria.get("q"))
+        if after:
+            statement = statement.where(cls._after(sort, after, rank))
+        if rank is not None:
+            # populate_existing loads the rank of the orders the session holds
+            statement = statement.options(with_expression(cls.search_rank, rank))
+            statement = statement.order_by(rank).execution_options(populate_existing=True)
+        if sort.startswith("-"):
+            statement = statement.order_by(column.desc(), cls.id.desc())
+        else:
+            statement = statement.order_by(column, cls.id)
+        if limit:
+            statement = statement.limit(limit)
+        return statement
+
+    @classmethod
+    def export_by_filters(
+        cls,
+        customer_name=None,
+        order_status=None,
+        product_name=None,
+        batch_size=1000,
+        min_total=None,
+        max_total=None,
+        **criteria,
+    ):  # pylint: disable=too-many-arguments, too-many-positional-arguments
+        """Iterates over all Orders with the given filters one batch at a time
+        Args:
+            customer_name (string): the name of the customer whose orders you want
+            order_status (string): the status of orders you want
+            product_name (string): the product_name of orders you want
+            batch_size (int): the number of orders fetched from the server-side cursor at once
+            min_total (Decimal): the smallest total_amount of orders you want
+            max_total (Decimal): the largest total_amount of orders you want
+            criteria: the time windows and searches of _criteria
+        """
+        statement = cls._filter_statement(
+            customer_name,
+            order_status,
+            product_name,
+            min_total=min_total,
+            max_total=max_total,
+            **criteria,
+        ).order_by(cls.created_at, cls.id)
+        # yield_per streams the rows through a server-side cursor and the
+        # selectinload fetches the items of each batch with one extra SELECT
+        yield from db.session.scalars(statement.execution_options(yield_per=batch_size))
+
+    @classmethod
+    def stats(cls, created_after=None, created_before=None, top=10):
+        """Returns order counts and revenues aggregated in the database
+        Args:
+            created_after (datetime): only count orders created at or after it
+            created_before (datetime): only count orders created before it
+            top (int): the number of products and customers to rank
+        """
+        logger.info("Processing stats of Orders from %s to %s", created_after, created_before)
+        window = cls._window_criteria(created_after, created_before)
+        # pylint: disable=assignment-from-no-return
+        revenue = func.coalesce(func.sum(Item.quantity * Item.price), 0)
+        orders = func.count(cls.id.distinct())  # pylint: disable=not-callable
+        # cancelled orders are counted by status but are not revenue
+        kept = window + [cls.status != OrderStatus.CANCELLED]
+
+        by_status = db.session.execute(
+            select(cls.status, orders, revenue)
+            .outerjoin(Item, Item.order_id == cls.id)
+            .where(*window)
+            .group_by(cls.status)
+            .order_by(cls.status)
+        ).all()
+        by_product = db.session.execute(
+            select(Item.product_name, func.sum(Item.quantity), revenue.label("revenue"))
+            .join(cls, Item.order_id == cls.id)
+            .where(*kept)
+            .group_by(Item.product_name)
+            .order_by(desc("revenue"), Item.product_name)
+            .limit(top)
+        ).all()
+        top_customers = db.session.execute(
+            select(cls.customer_name, orders, revenue.label("revenue"))
+            .outerjoin(Item, Item.order_id == cls.id)
+            .where(*kept)
+            .group_by(cls.customer_name)
+            .order_by(desc("revenue"), cls.customer_name)
+            .limit(top)
+        ).all()
+
+        return {
+            "orders": sum(count for _, count, _ in by_status),
+            "revenue": float(
+                sum(total for name, _, total in by_status if name != OrderStatus.CANCELLED)
+            ),
+            "by_status": [
+                {"status": name.value, "orders": count, "revenue": float(total)}
+                for name, count, total in by_status
+            ],
+            "by_product": [
+                {"product_name": name, "quantity": int(quantity), "revenue": float(total)}
+                for name, quantity, total in by_product
+            ],
+            "top_customers": [
+                {"customer_name": name, "orders": count, "revenue": float(total)}
+                for name, count, total in top_customers
+            ],
+        }
+
+    @classmethod
+    def refresh_totals(cls, order_ids=None) -> int:
+        """Recomputes the totals of Orders from their Items
+        Args:
+            order_ids (list): the ids of the orders to refresh, all of them by default
+        Returns the number of orders whose totals were wrong
+        """
+        logger.info("Refreshing the totals of Orders %s", order_ids or "all")
+        total_amount = _sql_cents(
+            select(func.coalesce(func.sum(Item.quantity * Item.price), 0))
+            .where(Item.order_id == cls.id)
+            .scalar_subquery()
+        )
+        item_count = (
+            select(func.count(Item.id))  # pylint: disable=not-callable
+            .where(Item.order_id == cls.id)
+            .scalar_subquery()
+        )
+        statement = (
+            update(cls)
+            .where(or_(cls.total_amount != total_amount, cls.item_count != item_count))
+            .values(total_amount=total_amount, item_count=item_count)
+            .execution_options(synchronize_session="fetch")
+        )
+        if order_ids is not None:
+            statement = statement.where(cls.id.in_(order_ids))
+        refreshed = db.session.scalars(statement.returning(cls.id)).all()
+        OrderChange.record(_order_updates(refreshed))
+        db.session.commit()
+        if order_ids is None:
+            cache.clear()
+        else:
+            cache.delete(*(cache_key(cls.__name__, order_id) for order_id in order_ids))
+        return len(refreshed)
+
+    @classmethod
+    def update_item(cls, order_id, item_id, data, version=None):
+        """Updates an Item of an Order with two UPDATEs and no SELECT
+        Args:
+            data (dict): the product_name, quantity and price of the Item
+            version (int): only update this version of the Item
+        Returns the updated Item serialized, or None when the Order has no
+        such Item. Raises a ConflictError when the version does not match.
+        """
+        logger.info("Updating Item %s of Order %s", item_id, order_id)
+        changes = Item().deserialize(data)
+        scope = [Item.order_id == order_id, Item.id == item_id]
+        if version is not None:
+            scope.append(Item.version == version)
+        try:
+            # the totals first: the UPDATE of the Order serializes the changes
+            # to its Items, and returns the version of the Item it read the
+            # stored amount of, so the UPDATE of the Item only applies to it
+            read_version = db.session.execute(
+                update(cls)
+                .where(cls.id == order_id, select(Item.id).where(*scope).exists())
+                .values(
+                    total_amount=_sql_cents(
+                        cls.total_amount
+                        + _amount(changes.quantity, changes.price)
+                        - select(Item.quantity * Item.price).where(*scope).scalar_subquery()
+                    )
+                )
+                .returning(select(Item.version).where(*scope).scalar_subquery())
+                .execution_options(synchronize_session="fetch")
+            ).scalar()
+            result = None
+            if read_version is not None:
+                item = db.session.scalars(
+                    update(Item)
+                    .where(*scope, Item.version == read_version)
+                    .values(
+                        product_name=changes.product_name,
+                        quantity=changes.quantity,
+                        price=changes.price,
+                        version=Item.version + 1,
+                    )
+                    .returning(Item)
+                    .execution_options(synchronize_session=False, populate_existing=True)
+                ).one_or_none()
+                result = item.serialize() if item else None
+            if result is None:
+                db.session.rollback()
+            else:
+                OrderChange.record(
+                    [(Item.__tablename__, item_id, order_id, OrderChange.UPDATED), *_order_updates([order_id])]
+                )
+                db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error updating Item %s of Order %s", item_id, order_id)
+            raise DataValidationError(e) from e
+        if result is None:
+            if read_version is None and (version is None or not Item.find_in_order(order_id, item_id)):
+                return None
+            raise ConflictError("Item was changed by another request")
+        cache.delete(cache_key(Item.__name__, item_id), cache_key(cls.__name__, order_id))
+        return result
+
+    @classmethod
+    def transition(cls, order_id, new_status, version=None):
+        """Changes the status of an Order with one conditional UPDATE
+        Args:
+            new_status (OrderStatus): the status allowed from the current one
+            version (int): only change this version of the Order
+        Returns the Order serialized with its items, or None when it does not
+        exist. Raises a ConflictError when the version does not match and a
+        DataValidationError when the transition is not allowed. The UPDATE
+        returns the Order, the items it embeds take a second SELECT.
+        """
+        logger.info("Changing the status of Order %s to %s", order_id, new_status.value)
+        statement = (
+            update(cls)
+            .where(cls.id == order_id, cls.status.in_(new_status.sources()))
+            .values(status=new_status, version=cls.version + 1)
+            .returning(cls)
+            .execution_options(synchronize_session=False, populate_existing=True)
+        )
+        if version is not None:
+            statement = statement.where(cls.version == version)
+        order = db.session.scalars(statement).one_or_none()
+        if order is not None:
+            # the items are read in the same transaction as the UPDATE
+            data = order.serialize()
+            OrderChange.record(_order_updates([order_id]))
+            OrderEvent.record([(OrderEvent.STATUS_CHANGED, order_id, _event_payload(data))])
+            db.session.commit()
+            cache.delete(cache_key(cls.__name__, order_id))
+            return data
+
+        # nothing changed: find out why, which costs a second round trip
+        order = db.session.scalars(
+            select(cls)
+            .options(*cls._load_options(None))
+            .where(cls.id == order_id)
+            .execution_options(populate_existing=True)
+        ).one_or_none()
+        data = order.serialize() if order else None
+        db.session.commit()
+        if data is None:
+            return None
+        # a stale version is a conflict even when the status is already the new one
+        if version is not None and data["version"] != version:
+            raise ConflictError(f"Order {order_id} is at version {data['version']}, not {version}")
+        # asking for the status the Order has changes nothing, unless it is
+        # a terminal status that allows no change at all
+        current = OrderStatus(data["status"])
+        if current == new_status and TRANSITIONS[current]:
+            return data
+        raise DataValidationError(
+            f"Cannot change the status of a {data['status']} order to {new_status.value}"
+        )
+
+    @classmethod
+    def bulk_transition(cls, order_ids, new_status) -> list:
+        """Changes the status of many Orders with one conditional UPDATE
+        Returns the ids of the Orders whose status was allowed to change
+        """
+        logger.info("Changing the status of %d Orders to %s", len(order_ids), new_status.value)
+        rows = db.session.execute(
+            update(cls)
+            .where(cls.id.in_(order_ids), cls.status.in_(new_status.sources()))
+            .values(status=new_status, version=cls.version + 1)
+            .returning(cls.id, *(getattr(cls, name) for name in cls.EVENT_FIELDS))
+            .execution_options(synchronize_session="fetch")
+        ).all()
+        changed = [row.id for row in rows]
+        OrderChange.record(_order_updates(changed))
+        OrderEvent.record([(OrderEvent.STATUS_CHANGED, row.id, _event_payload(row._asdict())) for row in rows])
+        db.session.commit()
+        cache.delete(*(cache_key(cls.__name__, order_id) for order_id in changed))
+        return sorted(changed)
+
+    @classmethod
+    def changes(cls, after=None, limit=100):
+        """Returns a page of the change feed with the current state of the changed records
+        Args:
+            after (list): the [txid, seq] keyset of the last change already read
+            limit (int): the maximum number of changes to read
+        Returns the latest change of each record in the page, the keyset of
+        the last change read, or None when there was none, and whether more
+        changes follow
+        """
+        logger.info("Processing the changes after %s", after)
+        rows = OrderChange.page(after, limit + 1)
+        more = len(rows) > limit
+        rows = rows[:limit]
+        latest = cls._latest_changes(rows)
+        records = cls._changed_records(latest)
+        changes = [
+            {
+                "seq": change.seq,
+                "entity": change.entity,
+                "id": change.entity_id,
+                "order_id": change.order_id,
+                "operation": operation,
+                # None for a record deleted since, whose tombstone follows
+                "data": records[change.entity].get(change.entity_id),
+            }
+            for change, operation in latest.values()
+        ]
+        keyset = [rows[-1].txid, rows[-1].seq] if rows else None
+        return changes, keyset, more
+
+    @staticmethod
+    def _latest_changes(rows) -> dict:
+        """Returns the latest change and operation of each record, in the order of the feed"""
+        latest = {}
+        for change in rows:
+            # a later change of the same record moves it to the end, and a
+            # record created in the page is still reported as created
+            previous = latest.pop((change.entity, change.entity_id), (None, None))[1]
+            operation = change.operation
+            if previous == OrderChange.CREATED and operation == OrderChange.UPDATED:
+                operation = previous
+            latest[(change.entity, change.entity_id)] = (change, operation)
+        return latest
+
+    @classmethod
+    def _changed_records(cls, latest) -> dict:
+        """Returns the current state of the changed records with one SELECT per table"""
+        ids = {cls.__tablename__: [], Item.__tablename__: []}
+        for (entity, entity_id), (_, operation) in latest.items():
+            if operation != OrderChange.DELETED:
+                ids[entity].append(entity_id)
+        records = {entity: {} for entity in ids}
+        if ids[cls.__tablename__]:
+            # without the items, which have changes of their own
+            orders = db.session.scalars(
+                select(cls)
+                .options(*cls._load_options(cls.CHANGE_FIELDS))
+                .where(cls.id.in_(ids[cls.__tablename__]))
+            )
+            records[cls.__tablename__] = {order.id: order.serialize(cls.CHANGE_FIELDS) for order in orders}
+        if ids[Item.__tablename__]:
+            items = db.session.scalars(select(Item).where(Item.id.in_(ids[Item.__tablename__])))
+            records[Item.__tablename__] = {item.id: item.serialize() for item in items}
+        return records
+
+    @classmethod
+    def _filter_statement(
+        cls,
+        customer_name,
+        order_status,
+        product_name,
+        *,
+        fields=None,
+        loaded=(),
+        min_total=None,
+        max_total=None,
+        **criteria,
+    ):  # pylint: disable=too-many-arguments
+        """Builds the SELECT of the Orders matching the given filters
+        Args:
+            fields (list): only load these fields of the orders
+            loaded (tuple): columns loaded whatever the fields, like the sort key
+            min_total (Decimal): the smallest total_amount of orders you want
+            max_total (Decimal): the largest total_amount of orders you want
+            criteria: the time windows and searches of _criteria
+        """
+        statement = select(cls).options(*cls._load_options(fields, *loaded))
+        statement = statement.where(*cls._criteria(**criteria))
         if customer_name:
-            query = query.filter(cls.customer_name == customer_name)
+            statement = statement.where(cls.customer_name == customer_name)
         if order_status:
             order_status = order_status.upper()
             if order_status in OrderStatus.list():
-                query = query.filter(cls.status == OrderStatus[order_status])
+                statement = statement.where(cls.status == OrderStatus[order_status])
             else:
-                query = query.filter(False)
+                statement = statement.where(false())
         if product_name:
-            query = query.join(Item).filter(Item.product_name == product_name)
-        return query.all()
+            # EXISTS rather than a JOIN so an order is never returned twice
+            statement = statement.where(cls.items.any(Item.product_name == product_name))
+        if min_total is not None:
+            statement = statement.where(cls.total_amount >= min_total)
+        if max_total is not None:
+            statement = statement.where(cls.total_amount <= max_total)
+        return statement
+
+    @classmethod
+    def _criteria(cls, created_after=None, created_before=None, updated_since=None, **search) -> list:
+        """Returns the WHERE criteria of the time windows and the searches
+        Args:
+            created_after (datetime): only orders created at or after it
+            created_before (datetime): only orders created before it
+            updated_since (datetime): only orders updated at or after it
+            search: the q, name_contains and product_contains of _search_criteria
+        """
+        criteria = cls._window_criteria(created_after, created_before)
+        if updated_since:
+            criteria.append(cls.updated_at >= cls._naive_utc(updated_since))
+        return criteria + cls._search_criteria(**search)
+
+    @classmethod
+    def _window_criteria(cls, created_after=None, created_before=None) -> list:
+        """Returns the WHERE criteria of the orders created in a time window"""
+        window = []
+        if created_after:
+            window.append(cls.created_at >= cls._naive_utc(created_after))
+        if created_before:
+            window.append(cls.created_at < cls._naive_utc(created_before))
+        return window
+
+    @classmethod
+    def _search_criteria(cls, q=None, name_contains=None, product_contains=None) -> list:
+        """Returns the WHERE criteria of a case-insensitive substring search
+        Args:
+            q (string): in the customer_name or the product_name of an item
+            name_contains (string): in the customer_name
+            product_contains (string): in the product_name of an item
+        """
+        # ILIKE on PostgreSQL, which the trigram indexes of the search serve,
+        # and lower() LIKE lower() on the other databases
+        def name_has(term):
+            return cls.customer_name.icontains(term, autoescape=True)
+
+        def product_has(term):
+            return cls.items.any(Item.product_name.icontains(term, autoescape=True))
+
+        criteria = []
+        if q:
+            criteria.append(or_(name_has(q), product_has(q)))
+        if name_contains:
+            criteria.append(name_has(name_contains))
+        if product_contains:
+            criteria.append(product_has(product_contains))
+        return criteria
+
+    @classmethod
+    def _search_rank(cls, q):
+        """Returns the search_rank of the orders for a q, None without one
+        0 for the customer_name q, 1 for one starting with it, 2 for one
+        containing it and 3 for the orders only found by their items
+        """
+        if not q:
+            return None
+        name = func.lower(cls.customer_name)
+        term = q.lower()
+        return case(
+            (name == term, 0),
+            (name.startswith(term, autoescape=True), 1),
+            (name.contains(term, autoescape=True), 2),
+            else_=3,
+        )
+
+    @classmethod
+    def _after(cls, sort, after, rank=None):
+        """Returns the WHERE criterion of the orders sorted after a keyset
+        Args:
+            sort (string): a key of SORT_KEYS, prefixed with - to sort descending
+            after (list): the [sort key, id] of the last order of the previous
+                page, led by its search_rank when the orders are ranked
+            rank: the search_rank expression of a search, None without one
+        """
+        if rank is not None:
+            try:
+                after_rank, *after = after
+                after_rank = int(after_rank)
+            except (TypeError, ValueError) as error:
+                raise DataValidationError(f"Invalid keyset {after}") from error
+        name = sort.lstrip("-")
+        keyset = tuple_(getattr(cls, name), cls.id)
+        after = cls._keyset(name, after)
+        criterion = keyset < after if sort.startswith("-") else keyset > after
+        if rank is None:
+            return criterion
+        return or_(rank > after_rank, and_(rank == after_rank, criterion))
+
+    @classmethod
+    def _load_options(cls, fields, *columns):
+        """Returns the loader options of a query for the given fields"""
+        # load the items of every matching order in one batched SELECT
+        # instead of one lazy SELECT per order when they are serialized
+        if fields is None:
+            return [selectinload(cls.items)]
+        columns += tuple(getattr(cls, name) for name in fields if name != "items")
+        options = [load_only(cls.id, *columns)]
+        if "items" in fields:
+            options.append(selectinload(cls.items))
+        return options
+
+    @staticmethod
+    def _naive_utc(value):
+        """Converts a datetime to the naive UTC time the timestamps are stored in"""
+        if value.tzinfo is None:
+            return value
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+    @classmethod
+    def _keyset(cls, sort, after):
+        """Converts a decoded [sort key, id] cursor into typed keyset values"""
+        try:
+            value, order_id = after
+            return tuple_(cls.SORT_KEYS[sort](value), int(order_id))
+        except (TypeError, ValueError, ArithmeticError) as error:
+            raise DataValidationError(f"Invalid keyset {after}") from error
+
+
+######################################################################
+#  T O T A L S   M A I N T E N A N C E
+######################################################################
+def _amount(quantity: int, price) -> Decimal:
+    """Returns the amount of a quantity of items at a price, as quantity * price
+    computes it in SQL from the stored price"""
+    if isinstance(quantity, bool) or not isinstance(quantity, int):
+        raise DataValidationError(f"Invalid quantity {quantity!r}: must be an integer")
+    return to_cents(price) * quantity
+
+
+def _sql_cents(amount):
+    """Rounds an amount computed in SQL to the cent like the column, as
+    SQLite computes it in floating point"""
+    return func.round(amount, 2, type_=Order.total_amount.type)
+
+
+def _stored_amount(session, item) -> Decimal:
+    """Returns the amount of a persistent Item as it is stored in the database"""
+    state = inspect(item)
+    values = []
+    for name in ("quantity", "price"):
+        history = state.attrs[name].history
+        if history.deleted:
+            values.append(history.deleted[0])
+        elif not history.added:
+            values.append(getattr(item, name))
+        else:
+            # the attribute was set without its old value ever being loaded
+            row = session.execute(
+                select(Item.quantity, Item.price).where(Item.id == item.id)
+            ).one()
+            return _amount(row.quantity, row.price)
+    return _amount(values[0], values[1])
+
+
+def _item_deltas(session) -> dict:
+    """Returns the (amount, count) changes of each Order made by a flush"""
+    deltas = {}
+
+    def add(item, amount, count):
+        order = item.order
+        if order is None:
+            order = session.get(Order, item.order_id)
+        if order is None or order in session.deleted:
+            return
+        total, items = deltas.get(order, (Decimal(0), 0))
+        deltas[order] = (total + amount, items + count)
+
+    for item in session.new:
+        if isinstance(item, Item):
+            add(item, _amount(item.quantity, item.price), 1)
+    for item in session.dirty:
+        if isinstance(item, Item) and session.is_modified(item, include_collections=False):
+            amount = _amount(item.quantity, item.price) - _stored_amount(session, item)
+            add(item, amount, 0)
+    for item in session.deleted:
+        if isinstance(item, Item):
+            add(item, -_stored_amount(session, item), -1)
+    return deltas
+
+
+@event.listens_for(db.session, "before_flush")
+def maintain_totals(session, flush_context, instances):  # pylint: disable=unused-argument
+    """Applies the changes to Items of a flush to the totals of their Orders"""
+    for order, (total, items) in _item_deltas(session).items():
+        if not total and not items:
+            continue
+        if order in session.new:
+            order.total_amount = (order.total_amount or Decimal("0.00")) + total
+            order.item_count = (order.item_count or 0) + items
+        else:
+            # add in SQL so concurrent changes to the same order are not lost,
+            # outside of the version check of the order, whose own fields stay
+            row = session.execute(
+                update(Order)
+                .where(Order.id == order.id)
+                .values(
+                    total_amount=_sql_cents(Order.total_amount + total),
+                    item_count=Order.item_count + items,
+                )
+                .returning(Order.total_amount, Order.item_count, Order.updated_at)
+                .execution_options(synchronize_session=False)
+            ).one()
+            # the values RETURNING read are the stored ones, so the order is
+            # serialized after the commit without being loaded again
+            for name, value in zip(("total_amount", "item_count", "updated_at"), row):
+                set_committed_value(order, name, value)
+
+
+######################################################################
+#  C H A N G E   L O G
+######################################################################
+def _order_updates(order_ids) -> list:
+    """Returns the change log entries of Orders updated outside of a flush"""
+    return [(Order.__tablename__, order_id, order_id, OrderChange.UPDATED) for order_id in order_ids]
+
+
+@event.listens_for(db.session, "after_flush")
+def log_changes(session, flush_context):  # pylint: disable=unused-argument
+    """Records the Orders and Items a flush created, updated or deleted in the change log"""
+    changes = {}
+    for operation, records in (
+        (OrderChange.CREATED, session.new),
+        (OrderChange.DELETED, session.deleted),
+        (OrderChange.UPDATED, session.dirty),
+    ):
+        # the Orders first, so an Item does not hide their creation or deletion
+        for record in sorted((r for r in records if isinstance(r, (Order, Item))), key=lambda r: isinstance(r, Item)):
+            if operation == OrderChange.UPDATED and not session.is_modified(record, include_collections=False):
+                continue
+            order_id = record.order_id if isinstance(record, Item) else record.id
+            changes.setdefault((record.__tablename__, record.id), (order_id, operation))
+            if isinstance(record, Item):
+                # a change to an Item changes the totals of its Order
+                changes.setdefault((Order.__tablename__, order_id), (order_id, OrderChange.UPDATED))
+    OrderChange.record(
+        [(entity, entity_id, order_id, operation) for (entity, entity_id), (order_id, operation) in changes.items()],
+        session,
+    )
+
+
+######################################################################
+#  O U T B O X
+######################################################################
+def _event_payload(data: dict) -> dict:
+    """Returns the payload of an Order event from the fields of the Order"""
+    payload = {"id": data["id"]}
+    for name in Order.EVENT_FIELDS:
+        value = data[name]
+        payload[name] = value.value if isinstance(value, OrderStatus) else value
+    return payload
+
+
+@event.listens_for(db.session, "after_flush")
+def publish_events(session, flush_context):  # pylint: disable=unused-argument
+    """Adds the events of the Orders a flush created, deleted or changed the status of to the outbox"""
+    events = []
+    for order in session.new:
+        if isinstance(order, Order):
+            events.append((OrderEvent.CREATED, order.id, _event_payload(_event_fields(order))))
+    for order in session.dirty:
+        if isinstance(order, Order) and inspect(order).attrs.status.history.has_changes():
+            events.append((OrderEvent.STATUS_CHANGED, order.id, _event_payload(_event_fields(order))))
+    for order in session.deleted:
+        if isinstance(order, Order):
+            events.append((OrderEvent.DELETED, order.id, {"id": order.id}))
+    OrderEvent.record(events, session)
+
+
+def _event_fields(order: Order) -> dict:
+    """Returns the fields of the payload of an event of a flushed Order"""
+    return {"id": order.id, **{name: getattr(order, name) for name in Order.EVENT_FIELDS}}
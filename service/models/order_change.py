@@ -0,0 +1,95 @@
+"""
+Properties and functions for the change log of the Orders and Items
+"""
+
+import logging
+from datetime import timedelta
+from sqlalchemy import BigInteger, String, cast, delete, func, literal, select, tuple_
+from .persistent_base import db, DataValidationError, utcnow
+
+logger = logging.getLogger("flask.app")
+
+
+def _xid8_as_bigint(xid):
+    """Converts a PostgreSQL xid8, which has no cast to bigint, to a bigint"""
+    return cast(cast(xid, String), BigInteger)
+
+
+class OrderChange(db.Model):
+    """Class that represents a change to an Order or an Item"""
+
+    __tablename__ = "order_change"
+    __table_args__ = (
+        # the feed reads the changes in (txid, seq) order after a keyset
+        db.Index("ix_order_change_txid_seq", "txid", "seq"),
+        db.Index("ix_order_change_changed_at", "changed_at"),
+    )
+
+    CREATED = "created"
+    UPDATED = "updated"
+    DELETED = "deleted"
+
+    seq = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
+    # the id of the transaction on PostgreSQL, 0 elsewhere
+    txid = db.Column(db.BigInteger, nullable=False)
+    # "order" or "item", the table of the changed row
+    entity = db.Column(db.String(8), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    order_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(8), nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<OrderChange seq={self.seq} {self.operation} {self.entity} {self.entity_id}>"
+
+    @classmethod
+    def record(cls, changes, session=None) -> None:
+        """Adds changes to the transaction of a session with one INSERT
+        Args:
+            changes (iterable): (entity, entity_id, order_id, operation) tuples
+            session: the session of the changes, db.session by default
+        """
+        rows = [
+            {"entity": entity, "entity_id": entity_id, "order_id": order_id, "operation": operation}
+            for entity, entity_id, order_id, operation in dict.fromkeys(changes)
+        ]
+        if not rows:
+            return
+        connection = (session or db.session).connection()
+        if connection.dialect.name == "postgresql":
+            txid = _xid8_as_bigint(func.pg_current_xact_id())
+        else:
+            txid = literal(0)
+        connection.execute(cls.__table__.insert().values(txid=txid, changed_at=utcnow()), rows)
+
+    @classmethod
+    def page(cls, after=None, limit=100) -> list:
+        """Returns the committed changes after a keyset, in the order of the feed
+        Args:
+            after (list): the [txid, seq] of the last change already read
+            limit (int): the maximum number of changes to return
+        """
+        statement = select(cls).order_by(cls.txid, cls.seq).limit(limit)
+        if after:
+            try:
+                txid, seq = (int(value) for value in after)
+            except (TypeError, ValueError) as error:
+                raise DataValidationError(f"Invalid keyset {after}") from error
+            statement = statement.where(tuple_(cls.txid, cls.seq) > tuple_(txid, seq))
+        if db.session.get_bind().dialect.name == "postgresql":
+            # the sequence numbers are not taken in commit order, but every
+            # transaction older than the oldest one still running is over, so
+            # no change can appear later before the changes of these ones
+            horizon = _xid8_as_bigint(func.pg_snapshot_xmin(func.pg_current_snapshot()))
+            statement = statement.where(cls.txid < horizon)
+        return db.session.scalars(statement).all()
+
+    @classmethod
+    def prune(cls, days: float) -> int:
+        """Removes the changes older than a number of days and returns how many there were"""
+        removed = db.session.execute(
+            delete(cls).where(cls.changed_at < utcnow() - timedelta(days=days))
+        ).rowcount
+        db.session.commit()
+        logger.info("Removed %d changes older than %s days", removed, days)
+        return removed
@@ -0,0 +1,82 @@
+"""
+Properties and functions for the outbox of the Order events
+"""
+
+import logging
+from sqlalchemy import delete, select
+from .persistent_base import db, utcnow
+
+logger = logging.getLogger("flask.app")
+
+
+class OrderEvent(db.Model):
+    """Class that represents an Order event waiting in the outbox to be delivered"""
+
+    __tablename__ = "order_event"
+
+    CREATED = "order.created"
+    STATUS_CHANGED = "order.status_changed"
+    DELETED = "order.deleted"
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
+    event_type = db.Column(db.String(32), nullable=False)
+    order_id = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<OrderEvent id=[{self.id}] {self.event_type} order_id=[{self.order_id}]>"
+
+    def serialize(self) -> dict:
+        """Serializes an OrderEvent into a dictionary"""
+        return {
+            "id": self.id,
+            "event_type": self.event_type,
+            "order_id": self.order_id,
+            "payload": self.payload,
+            "created_at": self.created_at.isoformat(),
+        }
+
+    @classmethod
+    def record(cls, events, session=None) -> None:
+        """Adds events to the transaction of a session with one INSERT
+        Args:
+            events (iterable): (event_type, order_id, payload) tuples
+            session: the session of the events, db.session by default
+        """
+        rows = [
+            {"event_type": event_type, "order_id": order_id, "payload": payload}
+            for event_type, order_id, payload in events
+        ]
+        if not rows:
+            return
+        connection = (session or db.session).connection()
+        connection.execute(cls.__table__.insert().values(created_at=utcnow()), rows)
+
+    @classmethod
+    def dispatch(cls, deliver, batch_size: int = 100) -> int:
+        """Delivers the oldest events of the outbox and removes them
+        Args:
+            deliver (callable): takes the list of serialized events, raises when it fails
+            batch_size (int): the most events to deliver at once
+        Returns how many events were delivered. The events of a failed
+        delivery stay in the outbox, so each event is delivered at least once.
+        """
+        # SKIP LOCKED lets several dispatchers drain the outbox without
+        # waiting for each other or delivering the same events; SQLite
+        # has no row locks and renders a plain SELECT
+        events = db.session.scalars(
+            select(cls).order_by(cls.id).limit(batch_size).with_for_update(skip_locked=True)
+        ).all()
+        if not events:
+            db.session.commit()
+            return 0
+        try:
+            deliver([event.serialize() for event in events])
+        except Exception:
+            db.session.rollback()
+            raise
+        db.session.execute(delete(cls).where(cls.id.in_([event.id for event in events])))
+        db.session.commit()
+        logger.info("Delivered %d Order events", len(events))
+        return len(events)
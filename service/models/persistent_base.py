@@ -4,9 +4,14 @@ Persistent Base
 
 from datetime import datetime, timezone
 
+import hashlib
 import logging
 from abc import abstractmethod
+from contextlib import contextmanager
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import declared_attr
+from sqlalchemy.orm.exc import StaleDataError
+from service.common.cache import cache, cache_key
 
 logger = logging.getLogger("flask.app")
 
@@ -18,6 +23,37 @@ class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
 
 
+class ConflictError(Exception):
+    """Used when a record was changed by someone else since it was read"""
+
+
+def utcnow() -> datetime:
+    """Returns the current time as the naive UTC time the timestamps are stored in"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+@contextmanager
+def keeping_values():
+    """Keeps the values the commits of the block wrote until the block ends
+
+    Used by the routes that serialize the record they wrote, from the values
+    in memory rather than with another SELECT. The records are expired when
+    the block ends, so they are loaded again as stored afterwards.
+    """
+    session = db.session()
+    session.expire_on_commit = False
+    try:
+        yield
+    finally:
+        session.expire_on_commit = True
+        session.expire_all()
+
+
+def make_etag(*parts) -> str:
+    """Returns a strong entity tag derived from the version parts of a record"""
+    return hashlib.sha1("|".join(map(str, parts)).encode("utf-8")).hexdigest()
+
+
 ######################################################################
 #  P E R S I S T E N T   B A S E   M O D E L
 ######################################################################
@@ -25,15 +61,16 @@ class PersistentBase:
     """Base class added persistent methods"""
 
     id = None
-    created_at = db.Column(
-        db.DateTime, default=lambda: datetime.now(timezone.utc), nullable=False
-    )
-    updated_at = db.Column(
-        db.DateTime,
-        default=lambda: datetime.now(timezone.utc),
-        onupdate=lambda: datetime.now(timezone.utc),
-        nullable=False,
-    )
+    # naive UTC like the stored values, so a record serialized from memory
+    # after its commit reads the same as when it is loaded again
+    created_at = db.Column(db.DateTime, default=utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=utcnow, onupdate=utcnow, nullable=False)
+    # incremented by every UPDATE, which only applies to the version it read
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+
+    @declared_attr.directive
+    def __mapper_args__(cls):  # pylint: disable=no-self-argument
+        return {"version_id_col": cls.version}
 
     @abstractmethod
     def serialize(self) -> dict:
@@ -52,11 +89,45 @@ class PersistentBase:
         self.id = None
         try:
             db.session.add(self)
+            db.session.flush()
+            keys = self.cache_keys()
             db.session.commit()
         except Exception as e:
             db.session.rollback()
             logger.error("Error creating record: %s", self)
             raise DataValidationError(e) from e
+        cache.delete(*keys)
+
+    @classmethod
+    def bulk_create(cls, entities: list, chunk_size: int = 0) -> list:
+        """
+        Creates many entities with one flush and one commit per chunk
+
+        Returns the new id of each entity, or the DataValidationError of
+        the chunk it was part of when that chunk was rolled back
+        """
+        logger.info("Creating %d %s records", len(entities), cls.__name__)
+        chunk_size = chunk_size or len(entities) or 1
+        results = []
+        for start in range(0, len(entities), chunk_size):
+            chunk = entities[start:start + chunk_size]
+            try:
+                for entity in chunk:
+                    entity.id = None
+                db.session.add_all(chunk)
+                # the flush batches the INSERTs and assigns the ids, which are
+                # read before the commit expires them to avoid a reload per row
+                db.session.flush()
+                ids = [entity.id for entity in chunk]
+                keys = [key for entity in chunk for key in entity.cache_keys()]
+                db.session.commit()
+                cache.delete(*keys)
+                results.extend(ids)
+            except Exception as e:  # pylint: disable=broad-except
+                db.session.rollback()
+                logger.error("Error creating %d records: %s", len(chunk), e)
+                results.extend([DataValidationError(e)] * len(chunk))
+        return results
 
     def update(self) -> None:
         """
@@ -66,22 +137,38 @@ class PersistentBase:
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
         try:
+            keys = self.cache_keys()
             db.session.commit()
+        except StaleDataError as e:
+            db.session.rollback()
+            logger.warning("Conflict updating record: %s", self)
+            raise ConflictError(f"{type(self).__name__} was changed by another request") from e
         except Exception as e:
             db.session.rollback()
             logger.error("Error updating record: %s", self)
             raise DataValidationError(e) from e
+        cache.delete(*keys)
 
     def delete(self) -> None:
         """Removes a entity from the data store"""
         logger.info("Deleting %s", self)
         try:
+            keys = self.cache_keys()
             db.session.delete(self)
             db.session.commit()
+        except StaleDataError as e:
+            db.session.rollback()
+            logger.warning("Conflict deleting record: %s", self)
+            raise ConflictError(f"{type(self).__name__} was changed by another request") from e
         except Exception as e:
             db.session.rollback()
             logger.error("Error deleting record: %s", self)
             raise DataValidationError(e) from e
+        cache.delete(*keys)
+
+    def cache_keys(self) -> list:
+        """Returns the keys of the cached records a change to this one makes stale"""
+        return [cache_key(type(self).__name__, self.id)]
 
     @classmethod
     def all(cls):
@@ -96,3 +183,18 @@ class PersistentBase:
         logger.info("Processing lookup for id %s ...", by_id)
         # pylint: disable=no-member
         return cls.query.session.get(cls, by_id)
+
+    @classmethod
+    def find_serialized(cls, by_id):
+        """Finds a record by it's ID and returns it serialized, from the cache when it can"""
+        key = cache_key(cls.__name__, by_id)
+        data = cache.get(key)
+        if data is None:
+            # taken before the read, so a write committed meanwhile drops the set
+            version = cache.version(key)
+            record = cls.find(by_id)
+            if not record:
+                return None
+            data = record.serialize()
+            cache.set(key, data, version)
+        return data
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 ######################################################################
+# pylint: disable=too-many-lines
 
 """
 Order Service with Swagger
@@ -21,11 +22,19 @@ This service implements a REST API that allows you to Create, Read, Update
 and Delete Order
 """
 
-from flask import request
+import json
+
+from flask import Response, request, stream_with_context
 from flask import current_app as app  # Import Flask application
-from flask_restx import Resource, fields, reqparse, Api
-from service.models import Order, Item, OrderStatus
+from flask_restx import Resource, fields, inputs, marshal, reqparse, Api
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.http import quote_etag
+from service.models import DataValidationError, Order, Item, OrderStatus, db, keeping_values, migrations
 from service.common import status  # HTTP Status Codes
+from service.common.cache import cache
+from service.common.db_pool import pool_status
+from service.common.idempotency import MAX_KEY_LENGTH, fingerprint, idempotency_keys
+from service.common.pagination import decode_cursor, encode_cursor
 
 ######################################################################
 # Configure Swagger before initializing it
@@ -43,14 +52,44 @@ api = Api(
 
 
 ############################################################
-# Health Endpoint
+# Health Endpoints
 ############################################################
 @app.route("/health")
+@app.route("/health/live")
 def health():
-    """Health Status"""
+    """Liveness: the worker answers, without touching the database"""
     return {"status": "OK"}, status.HTTP_200_OK
 
 
+@app.route("/health/ready")
+def ready():
+    """Readiness: a pooled connection reads a schema version the code supports"""
+    try:
+        with db.engine.connect() as connection:
+            version = migrations.current_version(connection)
+    except SQLAlchemyError as error:
+        app.logger.error("Readiness check failed: %s", error)
+        return {"status": "UNAVAILABLE", "error": "database unreachable"}, status.HTTP_503_SERVICE_UNAVAILABLE
+    if version < migrations.HEAD:
+        return {
+            "status": "UNAVAILABLE",
+            "error": f"schema version {version} is behind version {migrations.HEAD}",
+        }, status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"status": "OK", "schema_version": version}, status.HTTP_200_OK
+
+
+############################################################
+# Diagnostics Endpoint
+############################################################
+@app.route("/diagnostics")
+def diagnostics():
+    """Statistics of the database connection pool and the cache of this worker"""
+    return {
+        "pool": pool_status(db.engine.pool),
+        "cache": cache.stats(),
+    }, status.HTTP_200_OK
+
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -84,6 +123,9 @@ item_model = api.inherit(
             readOnly=True,
             description="The unique order id assigned internally by service",
         ),
+        "version": fields.Integer(
+            readOnly=True, description="Incremented by every update of the Item"
+        ),
     },
 )
 
@@ -111,11 +153,78 @@ order_model = api.inherit(
         "id": fields.Integer(
             readOnly=True, description="The unique id assigned internally by service"
         ),
+        "total_amount": fields.Float(
+            readOnly=True, description="The sum of quantity * price of the items"
+        ),
+        "item_count": fields.Integer(
+            readOnly=True, description="The number of items in the Order"
+        ),
+        "version": fields.Integer(
+            readOnly=True, description="Incremented by every update of the Order"
+        ),
     },
 )
 
-# query string arguments: customer_name, order_status and product_name
-order_args = reqparse.RequestParser()
+status_model = api.model(
+    "OrderStatusModel",
+    {
+        "id": fields.Integer(
+            readOnly=True, description="The unique id assigned internally by service"
+        ),
+        "status": fields.String(
+            enum=OrderStatus._member_names_, description="Status of the order"
+        ),
+    },
+)
+
+# the find_by_filters arguments a bulk status change can select Orders with
+BULK_FILTERS = {
+    "customer_name": str,
+    "order_status": str,
+    "product_name": str,
+    "min_total": (int, float),
+    "max_total": (int, float),
+}
+
+bulk_filter_model = api.model(
+    "OrderFilterModel",
+    {
+        "customer_name": fields.String(description="Orders of this customer"),
+        "order_status": fields.String(description="Orders with this status"),
+        "product_name": fields.String(description="Orders with an item of this product"),
+        "min_total": fields.Float(description="Orders with a total_amount of at least this value"),
+        "max_total": fields.Float(description="Orders with a total_amount of at most this value"),
+    },
+)
+
+bulk_status_model = api.model(
+    "OrderStatusBatchModel",
+    {
+        "status": fields.String(
+            required=True, enum=OrderStatus._member_names_, description="The new status of the orders"
+        ),
+        "ids": fields.List(fields.Integer, description="The ids of the orders to change"),
+        "filter": fields.Nested(
+            bulk_filter_model, description="Change the orders matching this filter instead of ids"
+        ),
+    },
+)
+
+# the Order fields a fields= projection can select, the id is always returned
+PROJECTION_FIELDS = ("customer_name", "status", "total_amount", "item_count", "version", "items")
+
+# query string argument of the reads of a single Order
+fields_args = reqparse.RequestParser()
+fields_args.add_argument(
+    "fields",
+    type=str,
+    location="args",
+    required=False,
+    help=f"Comma separated Order fields to return among {', '.join(PROJECTION_FIELDS)}",
+)
+
+# query string arguments: customer_name, order_status, product_name, limit, cursor and fields
+order_args = fields_args.copy()
 order_args.add_argument(
     "name",
     type=str,
@@ -137,6 +246,194 @@ order_args.add_argument(
     required=False,
     help="List orders by product_name in items",
 )
+order_args.add_argument(
+    "q",
+    type=str,
+    location="args",
+    required=False,
+    help="Search orders whose customer name or product names contain this text, best matches first",
+)
+order_args.add_argument(
+    "name_contains",
+    type=str,
+    location="args",
+    required=False,
+    help="List orders whose customer name contains this text, ignoring case",
+)
+order_args.add_argument(
+    "product_contains",
+    type=str,
+    location="args",
+    required=False,
+    help="List orders with an item whose product name contains this text, ignoring case",
+)
+order_args.add_argument(
+    "created_after",
+    type=inputs.datetime_from_iso8601,
+    location="args",
+    required=False,
+    help="List orders created at or after this ISO 8601 time",
+)
+order_args.add_argument(
+    "created_before",
+    type=inputs.datetime_from_iso8601,
+    location="args",
+    required=False,
+    help="List orders created before this ISO 8601 time",
+)
+order_args.add_argument(
+    "updated_since",
+    type=inputs.datetime_from_iso8601,
+    location="args",
+    required=False,
+    help="List orders updated at or after this ISO 8601 time",
+)
+order_args.add_argument(
+    "min_total",
+    type=float,
+    location="args",
+    required=False,
+    help="List orders with a total_amount of at least this value",
+)
+order_args.add_argument(
+    "max_total",
+    type=float,
+    location="args",
+    required=False,
+    help="List orders with a total_amount of at most this value",
+)
+order_args.add_argument(
+    "sort",
+    type=str,
+    location="args",
+    required=False,
+    default="created_at",
+    choices=[prefix + key for key in Order.SORT_KEYS for prefix in ("", "-")],
+    help="Sort key of the listing, prefixed with - to sort descending",
+)
+order_args.add_argument(
+    "limit",
+    type=int,
+    location="args",
+    required=False,
+    help="The maximum number of orders to return in one page",
+)
+order_args.add_argument(
+    "cursor",
+    type=str,
+    location="args",
+    required=False,
+    help="The opaque cursor from the Link header of the previous page",
+)
+
+# the export takes the same filters as the listing but is never paged
+export_args = order_args.copy()
+export_args.remove_argument("limit")
+export_args.remove_argument("cursor")
+export_args.remove_argument("fields")
+export_args.remove_argument("sort")
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# aggregates of the orders, grouped by status, product and customer
+status_stats_model = api.model(
+    "StatusStats",
+    {
+        "status": fields.String(enum=OrderStatus._member_names_),
+        "orders": fields.Integer(description="Number of orders with the status"),
+        "revenue": fields.Float(description="Total of quantity * price of their items"),
+    },
+)
+product_stats_model = api.model(
+    "ProductStats",
+    {
+        "product_name": fields.String,
+        "quantity": fields.Integer(description="Units ordered"),
+        "revenue": fields.Float(description="Total of quantity * price"),
+    },
+)
+customer_stats_model = api.model(
+    "CustomerStats",
+    {
+        "customer_name": fields.String,
+        "orders": fields.Integer(description="Number of orders of the customer"),
+        "revenue": fields.Float(description="Total spent by the customer"),
+    },
+)
+stats_model = api.model(
+    "OrderStats",
+    {
+        "orders": fields.Integer(description="Number of orders in the window"),
+        "revenue": fields.Float(description="Revenue of the orders not cancelled"),
+        "by_status": fields.List(fields.Nested(status_stats_model)),
+        "by_product": fields.List(fields.Nested(product_stats_model)),
+        "top_customers": fields.List(fields.Nested(customer_stats_model)),
+    },
+)
+
+# the change feed: one change per record, with its current state
+change_model = api.model(
+    "OrderChangeModel",
+    {
+        "seq": fields.Integer(description="The sequence number of the change"),
+        "entity": fields.String(enum=["order", "item"], description="The kind of the changed record"),
+        "id": fields.Integer(description="The id of the changed record"),
+        "order_id": fields.Integer(description="The id of the Order of the changed record"),
+        "operation": fields.String(enum=["created", "updated", "deleted"], description="What the change did"),
+        "data": fields.Raw(description="The current record, null once it is deleted"),
+    },
+)
+
+changes_model = api.model(
+    "OrderChangesModel",
+    {
+        "changes": fields.List(fields.Nested(change_model)),
+        "cursor": fields.String(description="The cursor to read the next changes with"),
+        "more": fields.Boolean(description="Whether more changes are ready to be read"),
+    },
+)
+
+# query string arguments: since and limit
+changes_args = reqparse.RequestParser()
+changes_args.add_argument(
+    "since",
+    type=str,
+    location="args",
+    required=False,
+    help="The cursor of the last response, omit it to read from the oldest change kept",
+)
+changes_args.add_argument(
+    "limit",
+    type=int,
+    location="args",
+    required=False,
+    help="The maximum number of changes to read",
+)
+
+# query string arguments: created_after, created_before and top
+stats_args = reqparse.RequestParser()
+stats_args.add_argument(
+    "created_after",
+    type=inputs.datetime_from_iso8601,
+    location="args",
+    required=False,
+    help="Only count orders created at or after this ISO 8601 time",
+)
+stats_args.add_argument(
+    "created_before",
+    type=inputs.datetime_from_iso8601,
+    location="args",
+    required=False,
+    help="Only count orders created before this ISO 8601 time",
+)
+stats_args.add_argument(
+    "top",
+    type=inputs.int_range(1, 100),
+    location="args",
+    required=False,
+    default=10,
+    help="The number of products and customers to rank (1 to 100)",
+)
 
 
 ######################################################################
@@ -158,21 +455,44 @@ class OrderResource(Resource):
     # RETRIEVE AN ORDER
     # ------------------------------------------------------------------
     @api.doc("get_order")
+    @api.response(304, "Order not modified")
     @api.response(404, "Order not found")
-    @api.marshal_with(order_model)
+    @api.expect(fields_args, validate=True)
+    @api.response(200, "Success", order_model)
     def get(self, order_id):
         """Retrieve a single order"""
         app.logger.info("Request for Order with id: %s", order_id)
 
+        # Only load the fields asked for, bypassing the cache of whole orders
+        projection = parse_fields(fields_args.parse_args()["fields"])
+        if projection is not None:
+            order = Order.find_projected(order_id, projection)
+            if not order:
+                abort(
+                    status.HTTP_404_NOT_FOUND,
+                    f"Order with id '{order_id}' could not be found.",
+                )
+            return marshal_orders(order.serialize(projection), projection), status.HTTP_200_OK
+
+        # Answer a conditional request without loading the order
+        if request.if_none_match:
+            etag = Order.find_etag(order_id)
+            if etag and request.if_none_match.contains_weak(etag):
+                return None, status.HTTP_304_NOT_MODIFIED, etag_header(etag)
+
         # See if the order exists and abort if it doesn't
-        order = Order.find(order_id)
+        order = Order.find_serialized(order_id)
         if not order:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Order with id '{order_id}' could not be found.",
             )
 
-        return order.serialize(), status.HTTP_200_OK
+        return (
+            marshal_orders(order),
+            status.HTTP_200_OK,
+            etag_header(Order.etag_of(order)),
+        )
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING ORDER
@@ -180,6 +500,8 @@ class OrderResource(Resource):
     @api.doc("update_order")
     @api.response(404, "Order not found")
     @api.response(400, "The posted Order data was not valid")
+    @api.response(409, "The Order was changed by another request")
+    @api.response(412, "The Order was changed since it was read")
     @api.expect(order_model)
     @api.marshal_with(order_model)
     def put(self, order_id):
@@ -191,14 +513,20 @@ class OrderResource(Resource):
             abort(
                 status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found."
             )
+        if request.if_match:
+            check_if_match(Order.find_etag(order_id))
         # Update order with info in the json request
         data = api.payload
         app.logger.debug("Payload received for update: %s", data)
+        check_version(order, data)
         order.deserialize(data)
         order.id = order_id
-        order.update()
-        # Return the updated order
-        return order.serialize(), status.HTTP_200_OK
+        # the response is serialized from the values just written
+        with keeping_values():
+            order.update()
+            # Return the updated order
+            data = order.serialize()
+        return data, status.HTTP_200_OK, etag_header(Order.etag_of(data))
 
     # ------------------------------------------------------------------
     # DELETE AN ORDER
@@ -229,49 +557,273 @@ class OrderCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc("list_orders")
     @api.expect(order_args, validate=True)
-    @api.marshal_list_with(order_model)
+    @api.response(200, "Success", [order_model])
     def get(self):
         """Returns all of the Orders"""
         app.logger.info("Request to list Orders...")
         orders = []
         args = order_args.parse_args()
+        projection = parse_fields(args["fields"])
         customer_name = args["name"]
         order_status = args["order_status"]
         product_name = args["product_name"]
-
+        limit = args["limit"]
+        if limit is None:
+            limit = app.config["DEFAULT_PAGE_SIZE"]
+        if limit < 1:
+            abort(status.HTTP_400_BAD_REQUEST, "limit must be a positive integer")
+        limit = min(limit, app.config["MAX_PAGE_SIZE"])
+        after = decode_cursor(args["cursor"]) if args["cursor"] else None
+
+        # Ask for one extra order to find out if there is a next page
         orders = Order.find_by_filters(
             customer_name=customer_name,
             order_status=order_status,
             product_name=product_name,
+            limit=limit + 1,
+            after=after,
+            fields=projection,
+            min_total=args["min_total"],
+            max_total=args["max_total"],
+            sort=args["sort"],
+            **criteria_args(args),
         )
 
+        headers = {}
+        if len(orders) > limit:
+            orders = orders[:limit]
+            last = orders[-1]
+            next_args = request.args.to_dict()
+            keyset = [getattr(last, args["sort"].lstrip("-")), last.id]
+            if args["q"]:
+                # the orders of a search are ranked before they are sorted
+                keyset.insert(0, last.search_rank)
+            next_args["cursor"] = encode_cursor(*keyset)
+            next_url = api.url_for(OrderCollection, _external=True, **next_args)
+            headers["Link"] = f'<{next_url}>; rel="next"'
+
         # Return as an array of dictionaries
-        results = [order.serialize() for order in orders]
-        return results, status.HTTP_200_OK
+        results = [order.serialize(projection) for order in orders]
+        return marshal_orders(results, projection), status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # ADD A NEW ORDER
     # ------------------------------------------------------------------
-    @api.doc("create_order")
+    @api.doc(
+        "create_order",
+        params={
+            "Idempotency-Key": {
+                "in": "header",
+                "description": "Unique key of the request, a retry with the same key gets the original response",
+            }
+        },
+    )
     @api.response(400, "The posted data was not valid")
+    @api.response(409, "The request of the Idempotency-Key is still running")
+    @api.response(422, "The Idempotency-Key was used for another request")
     @api.expect(base_order_model)
     @api.marshal_with(order_model, code=201)
     def post(self):
         """Create an Order"""
         app.logger.info("Request to create an Order")
 
+        # a retried request is answered with the response stored for its key
+        key = request.headers.get("Idempotency-Key")
+        if key is not None:
+            if not key or len(key) > MAX_KEY_LENGTH:
+                abort(
+                    status.HTTP_400_BAD_REQUEST,
+                    f"Idempotency-Key must have 1 to {MAX_KEY_LENGTH} characters",
+                )
+            digest = fingerprint(api.payload)
+            stored = idempotency_keys.get(key)
+            if stored:
+                return replay(key, digest, stored)
+
         # Create the order
         order = Order()
         order.deserialize(api.payload)
-        order.create()
+        # the key is reserved in the transaction of the Order, so of two
+        # requests with the same key only the first creates one
+        if key is not None and not idempotency_keys.reserve(key, digest):
+            return replay(key, digest, idempotency_keys.get(key) or (digest, None))
+        try:
+            with keeping_values():
+                order.create()
+                # Create a message to return
+                message = order.serialize()
+        except DataValidationError:
+            if key is not None:
+                idempotency_keys.release(key)
+            raise
 
-        # Create a message to return
-        message = order.serialize()
-        location_url = api.url_for(OrderResource, order_id=order.id, _external=True)
+        location_url = api.url_for(OrderResource, order_id=message["id"], _external=True)
+
+        if key is not None:
+            idempotency_keys.complete(key, {"body": marshal(message, order_model), "location": location_url})
 
         return message, status.HTTP_201_CREATED, {"Location": location_url}
 
 
+######################################################################
+#  PATH: /orders/batch
+######################################################################
+@api.route("/orders/batch")
+class OrderBatchResource(Resource):
+    """Handles the creation of many Orders at once"""
+
+    @api.doc("create_orders")
+    @api.response(400, "The posted data was not a list of Orders")
+    @api.response(413, "The posted list has too many Orders")
+    @api.response(207, "Some of the Orders could not be created")
+    @api.expect([base_order_model])
+    def post(self):
+        """
+        Create many Orders
+
+        The Orders are validated one by one and the valid ones are inserted
+        in a single transaction (or one per BULK_CHUNK_SIZE Orders).
+        The response reports the outcome of every element of the request.
+        """
+        app.logger.info("Request to create a batch of Orders")
+        payload = api.payload
+        if not isinstance(payload, list):
+            abort(status.HTTP_400_BAD_REQUEST, "Request body must be a list of Orders")
+        if len(payload) > app.config["MAX_BATCH_SIZE"]:
+            abort(
+                status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                f"A batch can have at most {app.config['MAX_BATCH_SIZE']} Orders",
+            )
+
+        results = [None] * len(payload)
+        orders = []
+        positions = []
+        for position, data in enumerate(payload):
+            try:
+                orders.append(Order().deserialize(data))
+                positions.append(position)
+            except DataValidationError as error:
+                results[position] = batch_error(position, error)
+
+        created = Order.bulk_create(orders, app.config["BULK_CHUNK_SIZE"])
+        for position, outcome in zip(positions, created):
+            if isinstance(outcome, DataValidationError):
+                results[position] = batch_error(position, outcome)
+            else:
+                results[position] = {
+                    "index": position,
+                    "status": status.HTTP_201_CREATED,
+                    "id": outcome,
+                    "location": api.url_for(
+                        OrderResource, order_id=outcome, _external=True
+                    ),
+                }
+
+        failed = [result for result in results if "error" in result]
+        code = status.HTTP_207_MULTI_STATUS if failed else status.HTTP_201_CREATED
+        return {
+            "created": len(results) - len(failed),
+            "failed": len(failed),
+            "results": results,
+        }, code
+
+
+######################################################################
+#  PATH: /orders/export
+######################################################################
+@api.route("/orders/export")
+class OrderExportResource(Resource):
+    """Streams collections of Orders"""
+
+    @api.doc("export_orders")
+    @api.expect(export_args, validate=True)
+    @api.response(406, "The client does not accept newline delimited JSON")
+    @api.produces([NDJSON_MIMETYPE])
+    def get(self):
+        """Streams all of the matching Orders as newline delimited JSON"""
+        app.logger.info("Request to export Orders...")
+        if request.accept_mimetypes and not request.accept_mimetypes.best_match(
+            [NDJSON_MIMETYPE]
+        ):
+            abort(
+                status.HTTP_406_NOT_ACCEPTABLE,
+                f"Orders can only be exported as {NDJSON_MIMETYPE}",
+            )
+        args = export_args.parse_args()
+        orders = Order.export_by_filters(
+            customer_name=args["name"],
+            order_status=args["order_status"],
+            product_name=args["product_name"],
+            batch_size=app.config["EXPORT_BATCH_SIZE"],
+            min_total=args["min_total"],
+            max_total=args["max_total"],
+            **criteria_args(args),
+        )
+
+        def generate():
+            for order in orders:
+                yield json.dumps(marshal(order.serialize(), order_model)) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+######################################################################
+#  PATH: /orders/stats
+######################################################################
+@api.route("/orders/stats")
+class OrderStatsResource(Resource):
+    """Aggregates of collections of Orders"""
+
+    @api.doc("order_stats")
+    @api.expect(stats_args, validate=True)
+    @api.marshal_with(stats_model)
+    def get(self):
+        """Returns the order counts and revenues computed by the database"""
+        app.logger.info("Request for Order stats...")
+        args = stats_args.parse_args()
+        stats = Order.stats(
+            created_after=args["created_after"],
+            created_before=args["created_before"],
+            top=args["top"],
+        )
+        return stats, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /orders/changes
+######################################################################
+@api.route("/orders/changes")
+class OrderChangesResource(Resource):
+    """The change feed of the Orders and Items"""
+
+    @api.doc("list_order_changes")
+    @api.expect(changes_args, validate=True)
+    @api.response(200, "Success", changes_model)
+    def get(self):
+        """Returns the changes to the Orders and Items after a cursor, oldest first"""
+        app.logger.info("Request for the changes of Orders...")
+        args = changes_args.parse_args()
+        limit = args["limit"]
+        if limit is None:
+            limit = app.config["DEFAULT_PAGE_SIZE"]
+        if limit < 1:
+            abort(status.HTTP_400_BAD_REQUEST, "limit must be a positive integer")
+        limit = min(limit, app.config["MAX_PAGE_SIZE"])
+        after = decode_cursor(args["since"]) if args["since"] else None
+
+        changes, keyset, more = Order.changes(after=after, limit=limit)
+        for change in changes:
+            if change["data"] is None:
+                continue
+            if change["entity"] == Order.__tablename__:
+                change["data"] = marshal_orders(change["data"], Order.CHANGE_FIELDS)
+            else:
+                change["data"] = marshal(change["data"], item_model)
+        # an empty page leaves the cursor where it was
+        cursor = encode_cursor(*keyset) if keyset else args["since"]
+        return {"changes": changes, "cursor": cursor, "more": more}, status.HTTP_200_OK
+
+
 ######################################################################
 #  PATH: /orders/<int:order_id>/cancel
 ######################################################################
@@ -286,21 +838,17 @@ class CancelOrderResource(Resource):
     def put(self, order_id):
         """Cancels an order"""
         app.logger.info(f"Request to cancel order id:{order_id}")
-        # Check if order exists
-        order = Order.find(order_id)
-        if not order:
+        # a single conditional UPDATE, which leaves a cancelled order as it is
+        try:
+            data = Order.transition(order_id, OrderStatus.CANCELLED)
+        except DataValidationError:
+            # the order was already cancelled: cancelling it again succeeds
+            data = Order.find_serialized(order_id)
+        if not data:
             abort(
                 status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found."
             )
-
-        app.logger.info(
-            f"Changing status of order with order id:{order_id} to CANCELLED"
-        )
-        order.status = OrderStatus.CANCELLED
-        order.update()
-        app.logger.info(f"{order}")
-        # Return the updated order
-        return order.serialize(), status.HTTP_200_OK
+        return data, status.HTTP_200_OK
 
 
 ######################################################################
@@ -309,11 +857,26 @@ class CancelOrderResource(Resource):
 @api.route("/orders/<int:order_id>/status")
 @api.param("order_id", "The order identifier")
 class UpdateStatusResource(Resource):
-    """Update status actions on a Order"""
+    """Read and update status actions on a Order"""
+
+    @api.doc("get_order_status")
+    @api.response(404, "Order not found")
+    @api.marshal_with(status_model)
+    def get(self, order_id):
+        """Returns the status of an Order"""
+        app.logger.info("Request for the status of Order with id: %s", order_id)
+        order_status = Order.find_status(order_id)
+        if not order_status:
+            abort(
+                status.HTTP_404_NOT_FOUND,
+                f"Order with id '{order_id}' was not found.",
+            )
+        return {"id": order_id, "status": order_status.value}, status.HTTP_200_OK
 
     @api.doc("update_order_status")
     @api.response(404, "Order not found")
-    @api.response(400, "The posted Order data was not valid")
+    @api.response(400, "The status is not valid or not allowed from the current one")
+    @api.response(409, "The Order was changed by another request")
     @api.expect(order_model)
     @api.marshal_with(order_model)
     def put(self, order_id):
@@ -322,43 +885,65 @@ class UpdateStatusResource(Resource):
             "Request to update order status for order with id: %s", order_id
         )
 
-        # Find the order by ID
-        order = Order.find(order_id)
-        if not order:
-            abort(
-                status.HTTP_404_NOT_FOUND,
-                f"Order with id '{order_id}' was not found.",
-            )
-
         # Get the new status from request body
         data = api.payload
-        if not data or "status" not in data:
-            abort(
-                status.HTTP_400_BAD_REQUEST,
-                "Required field 'status' missing from request body",
-            )
-
-        try:
-            new_status = OrderStatus(data["status"].upper())
+        new_status = parse_status(data)
 
-        except ValueError as error:
-            abort(status.HTTP_400_BAD_REQUEST, f"Invalid status value: {str(error)}")
+        version = data.get("version")
+        if version is not None and not isinstance(version, int):
+            abort(status.HTTP_400_BAD_REQUEST, "version must be an integer")
 
-        # If current status is Cancelled, don't allow any changes
-        if order.status == OrderStatus.CANCELLED:
+        # a single conditional UPDATE: the transition applies to the status the
+        # database holds, and changing to the current status does nothing
+        order = Order.transition(order_id, new_status, version)
+        if not order:
             abort(
-                status.HTTP_400_BAD_REQUEST,
-                "Cannot update status of a cancelled order",
+                status.HTTP_404_NOT_FOUND,
+                f"Order with id '{order_id}' was not found.",
             )
+        return order, status.HTTP_200_OK
 
-        # If the status is not changing, return success (idempotent)
-        if order.status == new_status:
-            return order.serialize(), status.HTTP_200_OK
 
-        # Update the status
-        order.status = new_status
-        order.update()
-        return order.serialize(), status.HTTP_200_OK
+######################################################################
+#  PATH: /orders/status
+######################################################################
+@api.route("/orders/status")
+class BulkStatusResource(Resource):
+    """Changes the status of many Orders at once"""
+
+    @api.doc("update_order_statuses")
+    @api.response(400, "The status or the selection of the Orders is not valid")
+    @api.response(413, "The selection has too many Orders")
+    @api.response(207, "Some of the Orders could not change status")
+    @api.expect(bulk_status_model)
+    def put(self):
+        """
+        Update the status of many Orders
+
+        The Orders are selected by a list of ids or by a filter. Those that
+        may change to the new status are changed by one UPDATE, and the
+        response reports the outcome of every selected Order.
+        """
+        app.logger.info("Request to update the status of a batch of Orders")
+        data = api.payload
+        new_status = parse_status(data)
+        order_ids = bulk_status_ids(data)
+
+        changed = set(Order.bulk_transition(order_ids, new_status))
+        statuses = Order.find_statuses([order_id for order_id in order_ids if order_id not in changed])
+        results = [
+            transition_result(order_id, new_status, order_id in changed, statuses.get(order_id))
+            for order_id in order_ids
+        ]
+
+        failed = [result for result in results if "error" in result]
+        code = status.HTTP_207_MULTI_STATUS if failed else status.HTTP_200_OK
+        return {
+            "changed": len(changed),
+            "unchanged": len(results) - len(changed) - len(failed),
+            "failed": len(failed),
+            "results": results,
+        }, code
 
 
 ######################################################################
@@ -425,21 +1010,80 @@ class ItemCollection(Resource):
         item = Item()
         item.deserialize(request.get_json())
 
-        # Append the item to the order
-        order.items.append(item)
-        order.update()
-
-        # Prepare a message to return
-        message = item.serialize()
+        # set the Order of the item rather than appending to order.items, so
+        # the existing items are not loaded: the backref only adds the item
+        # to the collection when it was already loaded
+        item.order = order
+        with keeping_values():
+            item.create()
+            # Prepare a message to return
+            message = item.serialize()
 
         # Send the location to GET the new item
         location_url = api.url_for(
-            ItemResource, order_id=order.id, item_id=item.id, _external=True
+            ItemResource, order_id=order_id, item_id=message["id"], _external=True
         )
 
         return message, status.HTTP_201_CREATED, {"Location": location_url}
 
 
+######################################################################
+#  PATH: /orders/<int:order_id>/items/batch
+######################################################################
+@api.route("/orders/<int:order_id>/items/batch")
+@api.param("order_id", "The order identifier")
+class ItemBatchResource(Resource):
+    """Handles the addition of many Items to an Order at once"""
+
+    @api.doc("add_items_in_order")
+    @api.response(404, "Order not found")
+    @api.response(400, "The posted data was not a list of valid Items")
+    @api.response(413, "The posted list has too many Items")
+    @api.expect([base_item_model])
+    def post(self, order_id):
+        """
+        Add many Items to an Order
+
+        All of the Items are inserted with one multi-row INSERT and one commit,
+        or none of them are when one is not valid
+        """
+        app.logger.info("Request to add a batch of Items to Order with id: %s", order_id)
+        order = Order.find(order_id)
+        if not order:
+            abort(
+                status.HTTP_404_NOT_FOUND,
+                f"Order with id '{order_id}' could not be found.",
+            )
+        payload = api.payload
+        if not isinstance(payload, list):
+            abort(status.HTTP_400_BAD_REQUEST, "Request body must be a list of Items")
+        if len(payload) > app.config["MAX_BATCH_SIZE"]:
+            abort(
+                status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                f"A batch can have at most {app.config['MAX_BATCH_SIZE']} Items",
+            )
+
+        items = []
+        for data in payload:
+            item = Item().deserialize(data)
+            # set the key instead of appending to order.items so the
+            # existing items of the order are never loaded
+            item.order_id = order.id
+            items.append(item)
+
+        ids = Item.bulk_create(items)
+        for outcome in ids:
+            if isinstance(outcome, DataValidationError):
+                raise outcome
+
+        location_url = api.url_for(ItemCollection, order_id=order.id, _external=True)
+        return (
+            {"order_id": order.id, "ids": ids},
+            status.HTTP_201_CREATED,
+            {"Location": location_url},
+        )
+
+
 ######################################################################
 #  PATH: /orders/<int:order_id>/items/<int:item_id>
 ######################################################################
@@ -460,7 +1104,8 @@ class ItemResource(Resource):
     # RETRIEVE AN ITEM IN ORDER
     # ------------------------------------------------------------------
     @api.doc("get_item")
-    @api.response(404, "Order not found")
+    @api.response(304, "Item not modified")
+    @api.response(404, "Item not found in the Order")
     @api.marshal_with(item_model)
     def get(self, order_id, item_id):
         """
@@ -472,23 +1117,23 @@ class ItemResource(Resource):
             "Request to retrieve Item %s for Order id: %s", item_id, order_id
         )
 
-        # See if the item exists and abort if it doesn't
-        item = Item.find(item_id)
+        # See if the item exists in the order and abort if it doesn't
+        item = Item.find_in_order(order_id, item_id)
         if not item:
-            abort(
-                status.HTTP_404_NOT_FOUND,
-                f"Order with id '{item_id}' could not be found.",
-            )
+            abort_item_not_found(order_id, item_id)
+        if request.if_none_match.contains_weak(item.etag):
+            return None, status.HTTP_304_NOT_MODIFIED, etag_header(item.etag)
 
-        return item.serialize(), status.HTTP_200_OK
+        return item.serialize(), status.HTTP_200_OK, etag_header(item.etag)
 
     # ------------------------------------------------------------------
     # UPDATE AN ITEM IN AN EXISTING ORDER
     # ------------------------------------------------------------------
     @api.doc("update_item_in_order")
-    @api.response(404, "Order not found")
-    @api.response(404, "Item not found")
+    @api.response(404, "Item not found in the Order")
     @api.response(400, "The posted item data was not valid")
+    @api.response(409, "The Item was changed by another request")
+    @api.response(412, "The Item was changed since it was read")
     @api.expect(item_model)
     @api.marshal_with(item_model)
     def put(self, order_id, item_id):
@@ -496,30 +1141,27 @@ class ItemResource(Resource):
         app.logger.info(
             f"Request to update item {item_id} in order with order id:{order_id}"
         )
-        # Check if order exists
-        order = Order.find(order_id)
-        if not order:
-            abort(
-                status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found."
-            )
-
-        # Check if item exists
-        item = Item.find(item_id)
-        if not item:
-            abort(
-                status.HTTP_404_NOT_FOUND,
-                f"Order with id '{item_id}' could not be found.",
-            )
-
-        # Update item with info in the json request
         data = api.payload
         app.logger.debug("Payload received for update: %s", data)
-        item.deserialize(data)
-        item.id = item_id
-        if item:
-            Item.update(item)
-        # Return the updated order
-        return item.serialize(), status.HTTP_200_OK
+        version = data.get("version") if isinstance(data, dict) else None
+        if version is not None and not isinstance(version, int):
+            abort(status.HTTP_400_BAD_REQUEST, "version must be an integer")
+
+        # only a conditional request reads the Item first, and then updates
+        # just the version whose entity tag it matched
+        if request.if_match:
+            item = Item.find_in_order(order_id, item_id)
+            if not item:
+                abort_item_not_found(order_id, item_id)
+            check_if_match(item.etag)
+            check_version(item, data)
+            version = item.version
+
+        # a single UPDATE ... RETURNING of the Item of this Order
+        item = Order.update_item(order_id, item_id, data, version)
+        if not item:
+            abort_item_not_found(order_id, item_id)
+        return item, status.HTTP_200_OK, etag_header(Item.etag_of(item))
 
     # ------------------------------------------------------------------
     # DELETE AN ITEM FROM ORDER
@@ -530,15 +1172,18 @@ class ItemResource(Resource):
     def delete(self, order_id, item_id):
         """Delete an item from an order"""
         app.logger.info(f"Request to delete Item {item_id} from Order id: {order_id}")
-        # Check if order exists
-        order = Order.find(order_id)
-        if not order:
+        item = Item.find_in_order(order_id, item_id)
+        if item:
+            item.delete()
+            return "", status.HTTP_204_NO_CONTENT
+        # only a miss looks further, to tell a missing Order or an Item of
+        # another Order apart from an Item that is already gone
+        if not Order.find_status(order_id):
             abort(
                 status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found."
             )
-        item = Item.find(item_id)
-        if item:
-            item.delete()
+        if Item.find(item_id):
+            abort_item_not_found(order_id, item_id)
         return "", status.HTTP_204_NO_CONTENT
 
 
@@ -565,3 +1210,146 @@ def abort(error_code: int, message: str):
     """Logs errors before aborting"""
     app.logger.error(message)
     api.abort(error_code, message)
+
+
+def replay(key: str, digest: str, stored: tuple):
+    """Returns the stored response of an Idempotency-Key, when it was for the same request"""
+    stored_digest, response = stored
+    if stored_digest != digest:
+        abort(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            f"Idempotency-Key '{key}' was already used for another request",
+        )
+    if response is None:
+        abort(
+            status.HTTP_409_CONFLICT,
+            f"The request of Idempotency-Key '{key}' is still running, retry later",
+        )
+    app.logger.info("Replaying the response of Idempotency-Key %s", key)
+    headers = {"Location": response["location"], "Idempotent-Replayed": "true"}
+    return response["body"], status.HTTP_201_CREATED, headers
+
+
+def abort_item_not_found(order_id: int, item_id: int):
+    """Aborts with 404 for an Item that is not in an Order"""
+    abort(
+        status.HTTP_404_NOT_FOUND,
+        f"Item with id '{item_id}' was not found in Order with id '{order_id}'.",
+    )
+
+
+def parse_status(data) -> OrderStatus:
+    """Returns the OrderStatus of the status field of a request body"""
+    if not isinstance(data, dict) or "status" not in data:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "Required field 'status' missing from request body",
+        )
+    try:
+        return OrderStatus(data["status"].upper())
+    except (AttributeError, ValueError) as error:
+        abort(status.HTTP_400_BAD_REQUEST, f"Invalid status value: {str(error)}")
+    return None
+
+
+def bulk_status_ids(data: dict) -> list:
+    """Returns the ids of the Orders selected by the ids or the filter of a request body"""
+    if ("ids" in data) == ("filter" in data):
+        abort(status.HTTP_400_BAD_REQUEST, "Select the Orders with either ids or filter")
+    max_size = app.config["MAX_BATCH_SIZE"]
+    if "ids" in data:
+        ids = data["ids"]
+        if not isinstance(ids, list) or not all(
+            isinstance(order_id, int) and not isinstance(order_id, bool) for order_id in ids
+        ):
+            abort(status.HTTP_400_BAD_REQUEST, "ids must be a list of Order ids")
+        order_ids = list(dict.fromkeys(ids))
+    else:
+        filters = data["filter"]
+        if not isinstance(filters, dict) or not all(
+            name in BULK_FILTERS and isinstance(value, BULK_FILTERS[name]) and not isinstance(value, bool)
+            for name, value in filters.items()
+        ):
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                f"filter can only have {', '.join(BULK_FILTERS)}, with string or number values",
+            )
+        # one more id than allowed tells a filter that matches too many Orders
+        order_ids = Order.find_ids(limit=max_size + 1, **filters)
+    if len(order_ids) > max_size:
+        abort(
+            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            f"A batch can have at most {max_size} Orders",
+        )
+    return order_ids
+
+
+def transition_result(order_id: int, new_status: OrderStatus, changed: bool, current) -> dict:
+    """Reports the outcome of the status change of one Order of a batch"""
+    if changed or current == new_status:
+        return {"id": order_id, "status": status.HTTP_200_OK, "order_status": new_status.value, "changed": changed}
+    if current is None:
+        result = {"id": order_id, "status": status.HTTP_404_NOT_FOUND}
+        result["error"] = f"Order with id '{order_id}' was not found."
+    else:
+        result = {"id": order_id, "status": status.HTTP_400_BAD_REQUEST, "order_status": current.value}
+        result["error"] = f"Cannot change the status of a {current.value} order to {new_status.value}"
+    app.logger.error("Status change of Order %s failed: %s", order_id, result["error"])
+    return result
+
+
+def criteria_args(args: dict) -> dict:
+    """Returns the time window and substring search arguments of a listing"""
+    names = ("created_after", "created_before", "updated_since", "q", "name_contains", "product_contains")
+    return {name: args[name] for name in names}
+
+
+def parse_fields(value: str):
+    """Returns the fields of a fields= projection, or None for whole Orders"""
+    if not value:
+        return None
+    names = list(dict.fromkeys(name.strip() for name in value.split(",")))
+    names = [name for name in names if name and name != "id"]
+    unknown = [name for name in names if name not in PROJECTION_FIELDS]
+    if unknown:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"Unknown fields {', '.join(unknown)}, choose from {', '.join(PROJECTION_FIELDS)}",
+        )
+    return names
+
+
+def marshal_orders(data, projection=None):
+    """Marshals Orders, keeping only the id and the fields of a projection"""
+    mask = None if projection is None else "{" + ",".join(["id", *projection]) + "}"
+    return marshal(data, order_model, mask=mask)
+
+
+def batch_error(position: int, error: Exception) -> dict:
+    """Logs the error of one element of a batch request and reports it"""
+    app.logger.error("Batch element %s failed: %s", position, error)
+    return {"index": position, "status": status.HTTP_400_BAD_REQUEST, "error": str(error)}
+
+
+def etag_header(etag: str) -> dict:
+    """Returns the ETag header of a strong entity tag"""
+    return {"ETag": quote_etag(etag)}
+
+
+def check_version(record, data):
+    """Aborts with 409 when a payload was read from another version of a record"""
+    version = data.get("version") if isinstance(data, dict) else None
+    if version is not None and version != record.version:
+        abort(
+            status.HTTP_409_CONFLICT,
+            f"Version {version} is not the current version {record.version}, fetch it again and retry.",
+        )
+
+
+def check_if_match(etag: str):
+    """Aborts with 412 when the If-Match header does not match an entity tag"""
+    if request.if_match and not request.if_match.contains(etag):
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            "The resource was changed since it was read, fetch it again and retry.",
+        )
@@ -0,0 +1,270 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Async Order Service Test Suite
+
+Also measures the requests per second of the reads at BENCHMARK_CONCURRENCY
+concurrent requests, served by the Flask application in a thread pool and by
+the async handlers. Neither mode is asserted to be faster unless
+BENCHMARK_ASYNC_SPEEDUP sets the ratio the async handlers must reach.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from unittest import TestCase
+from urllib.parse import urlencode
+
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy import event
+
+from service.asgi import AsyncOrderApp, _etag_matches, async_database_uri, split_pool
+from service.common import status
+from service.common.cache import cache
+from service.models import db
+from tests.factories import ItemFactory
+from tests.test_base import TestBase
+from wsgi import app
+
+BASE_URL = "/api/orders"
+BENCHMARK_CONCURRENCY = int(os.getenv("BENCHMARK_CONCURRENCY", "200"))
+BENCHMARK_REQUESTS = int(os.getenv("BENCHMARK_REQUESTS", "1000"))
+BENCHMARK_ASYNC_SPEEDUP = float(os.getenv("BENCHMARK_ASYNC_SPEEDUP", "0"))
+
+logger = logging.getLogger(__name__)
+
+
+async def asgi_get(asgi_app, path, query=None, headers=None):
+    """Sends a GET request to an ASGI application and returns (status, headers, body)"""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode("latin-1"),
+        "root_path": "",
+        "query_string": urlencode(query or {}).encode("latin-1"),
+        "headers": [(b"host", b"localhost")]
+        + [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+        "server": ("localhost", 80),
+        "client": ("127.0.0.1", 12345),
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi_app(scope, receive, send)
+    response_headers = {
+        name.decode("latin-1").lower(): value.decode("latin-1")
+        for name, value in messages[0]["headers"]
+    }
+    body = b"".join(message.get("body", b"") for message in messages[1:])
+    return messages[0]["status"], response_headers, body
+
+
+######################################################################
+#  A S Y N C   O R D E R   A P P   T E S T   C A S E S
+######################################################################
+class TestAsyncOrderApp(TestBase):
+    """Async Order Service Tests"""
+
+    def setUp(self):
+        super().setUp()
+        if app.config["SQLALCHEMY_DATABASE_URI"] in ["sqlite://", "sqlite:///:memory:"]:
+            self.skipTest("an in-memory SQLite database is not shared with the async engine")
+        self.asgi = AsyncOrderApp(app)
+
+    def _run(self, *requests):
+        """Sends GET requests to the async app and returns their responses"""
+
+        async def run():
+            try:
+                return [await asgi_get(self.asgi, *request) for request in requests]
+            finally:
+                await self.asgi.engine.dispose()
+
+        return asyncio.run(run())
+
+    def _assert_same_as_flask(self, path, query=None, headers=None):
+        """Asserts the async app answers a GET like the Flask application"""
+        code, response_headers, body = self._run((path, query, headers))[0]
+        # Flask reads the stored rows too, not the records the test session
+        # kept from the requests that wrote them
+        db.session.expire_all()
+        expected = self.client.get(path, query_string=query, headers=headers)
+        self.assertEqual(code, expected.status_code)
+        self.assertEqual(body, expected.data)
+        for name in ("ETag", "Link"):
+            self.assertEqual(response_headers.get(name.lower()), expected.headers.get(name))
+        return code, response_headers, body
+
+    def test_get_order(self):
+        """It should read an Order asynchronously like the Flask route"""
+        order = self._create_orders(1)[0]
+        self.client.post(f"{BASE_URL}/{order.id}/items", json=ItemFactory().serialize())
+        cache.clear()
+        code, headers, _ = self._assert_same_as_flask(f"{BASE_URL}/{order.id}")
+        self.assertEqual(code, status.HTTP_200_OK)
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):  # pylint: disable=unused-argument
+            statements.append(statement)
+
+        event.listen(self.asgi.engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+        code, _, body = self._run((f"{BASE_URL}/{order.id}", None, {"If-None-Match": headers["etag"]}))[0]
+        self.assertEqual(code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(body, b"")
+        # only the entity tag lookup, without loading the order and its items
+        self.assertEqual(len(statements), 1)
+        self._assert_same_as_flask(f"{BASE_URL}/{order.id}", {"fields": "status"})
+        self._assert_same_as_flask(f"{BASE_URL}/0")
+
+    def test_engine_options(self):
+        """It should size the async pool from the engine options it is given"""
+        if "pool_size" not in app.config["SQLALCHEMY_ENGINE_OPTIONS"]:
+            self.skipTest("the database has no connection pool to share")
+        _, async_options = split_pool(app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+        asgi = AsyncOrderApp(app, async_options)
+        self.assertEqual(asgi.engine.pool.size(), async_options["pool_size"])
+        asyncio.run(asgi.engine.dispose())
+
+    def test_list_orders(self):
+        """It should list Orders asynchronously like the Flask route"""
+        orders = self._create_orders(5)
+        self.client.post(f"{BASE_URL}/{orders[1].id}/items", json=ItemFactory().serialize())
+        self._assert_same_as_flask(BASE_URL)
+        _, headers, _ = self._assert_same_as_flask(BASE_URL, {"limit": 2, "sort": "-total_amount"})
+        self.assertIn('rel="next"', headers["link"])
+        self._assert_same_as_flask(BASE_URL, {"name": orders[2].customer_name})
+        self._assert_same_as_flask(BASE_URL, {"order_status": "shipped", "min_total": 0})
+        self._assert_same_as_flask(BASE_URL, {"limit": 0})
+        self._assert_same_as_flask(BASE_URL, {"cursor": "not a cursor"})
+        self._assert_same_as_flask(BASE_URL, {"fields": "status"})
+
+    def test_list_items(self):
+        """It should list the Items of an Order asynchronously like the Flask route"""
+        order = self._create_orders(1)[0]
+        self._assert_same_as_flask(f"{BASE_URL}/{order.id}/items")
+        for _ in range(3):
+            self.client.post(f"{BASE_URL}/{order.id}/items", json=ItemFactory().serialize())
+        self._assert_same_as_flask(f"{BASE_URL}/{order.id}/items")
+        self._assert_same_as_flask(f"{BASE_URL}/0/items")
+
+    def test_other_requests(self):
+        """It should pass every other request to the Flask application"""
+        order = self._create_orders(1)[0]
+        self._assert_same_as_flask("/health")
+        self._assert_same_as_flask(f"{BASE_URL}/{order.id}/status")
+        self._assert_same_as_flask(f"{BASE_URL}/stats")
+
+    def test_lifespan(self):
+        """It should dispose of the async pool when the server shuts down"""
+        messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message["type"])
+
+        asyncio.run(self.asgi({"type": "lifespan"}, receive, send))
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+
+    def test_read_throughput(self):
+        """It should answer concurrent reads like the threaded mode and log both throughputs"""
+        orders = self._create_orders(20)
+        for order in orders:
+            self.client.post(f"{BASE_URL}/{order.id}/items", json=ItemFactory().serialize())
+        paths = [f"{BASE_URL}/{orders[i % 20].id}/items" for i in range(BENCHMARK_REQUESTS)]
+
+        async def benchmark(asgi_app):
+            semaphore = asyncio.Semaphore(BENCHMARK_CONCURRENCY)
+
+            async def get(path):
+                async with semaphore:
+                    code, _, body = await asgi_get(asgi_app, path)
+                    self.assertEqual(code, status.HTTP_200_OK)
+                    return body
+
+            start = time.perf_counter()
+            bodies = await asyncio.gather(*(get(path) for path in paths))
+            elapsed = time.perf_counter() - start
+            await self.asgi.engine.dispose()
+            return BENCHMARK_REQUESTS / elapsed, bodies
+
+        threaded, expected = asyncio.run(benchmark(WsgiToAsgi(app)))
+        asynchronous, bodies = asyncio.run(benchmark(self.asgi))
+        logger.info(
+            "%d reads at concurrency %d: %.0f requests/s with WSGI threads, %.0f requests/s async",
+            BENCHMARK_REQUESTS,
+            BENCHMARK_CONCURRENCY,
+            threaded,
+            asynchronous,
+        )
+        # every concurrent read got the response of the threaded mode
+        self.assertEqual(bodies, expected)
+        if BENCHMARK_ASYNC_SPEEDUP:
+            self.assertGreaterEqual(asynchronous / threaded, BENCHMARK_ASYNC_SPEEDUP)
+
+
+######################################################################
+#  U T I L I T Y   T E S T   C A S E S
+######################################################################
+class TestAsyncUtilities(TestCase):
+    """Async Order Service Utility Tests"""
+
+    def test_async_database_uri(self):
+        """It should use the async driver of the database"""
+        self.assertEqual(
+            async_database_uri("postgresql+psycopg://postgres@localhost/orders"),
+            "postgresql+psycopg://postgres@localhost/orders",
+        )
+        self.assertEqual(
+            async_database_uri("postgresql://postgres@localhost/orders"),
+            "postgresql+psycopg://postgres@localhost/orders",
+        )
+        self.assertEqual(async_database_uri("sqlite:////tmp/test.db"), "sqlite+aiosqlite:////tmp/test.db")
+        self.assertRaises(ValueError, async_database_uri, "mysql://localhost/orders")
+
+    def test_split_pool(self):
+        """It should split the pool of a worker between its two engines"""
+        options = {"pool_pre_ping": True, "pool_size": 5, "max_overflow": 10}
+        self.assertEqual(
+            split_pool(options),
+            (
+                {"pool_pre_ping": True, "pool_size": 2, "max_overflow": 5},
+                {"pool_pre_ping": True, "pool_size": 3, "max_overflow": 5},
+            ),
+        )
+        self.assertEqual(split_pool({"pool_size": 1, "max_overflow": 0}), ({"pool_size": 1, "max_overflow": 0},) * 2)
+        # a single connection database has no pool to split
+        self.assertEqual(split_pool({"pool_recycle": 60}), ({"pool_recycle": 60},) * 2)
+
+    def test_etag_matches(self):
+        """It should compare If-None-Match headers with an entity tag"""
+        self.assertTrue(_etag_matches('"abc"', "abc"))
+        self.assertTrue(_etag_matches('"xyz", W/"abc"', "abc"))
+        self.assertTrue(_etag_matches("*", "abc"))
+        self.assertFalse(_etag_matches('"xyz"', "abc"))
@@ -4,10 +4,14 @@ Base Test Case for Order Service Test Suite
 
 import logging
 import os
+from contextlib import contextmanager
 from unittest import TestCase
 
+from sqlalchemy import event
+
 from service.common import status
-from service.models import Item, Order, db
+from service.common.cache import cache
+from service.models import IdempotencyKey, Item, Order, OrderChange, OrderEvent, db, migrations
 from tests.factories import OrderFactory
 from wsgi import app
 
@@ -28,6 +32,7 @@ class TestBase(TestCase):
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
         app.logger.setLevel(logging.CRITICAL)
         app.app_context().push()
+        migrations.upgrade(db.engine)
 
     @classmethod
     def tearDownClass(cls):
@@ -39,17 +44,21 @@ class TestBase(TestCase):
         self.client = app.test_client()
         db.session.query(Order).delete()  # clean up the last tests
         db.session.query(Item).delete()  # clean up the last tests
+        db.session.query(IdempotencyKey).delete()
+        db.session.query(OrderChange).delete()
+        db.session.query(OrderEvent).delete()
         db.session.commit()
+        cache.clear()
 
     def tearDown(self):
         """This runs after each test"""
         db.session.remove()
 
-    def _create_orders(self, count):
+    def _create_orders(self, count, **attributes):
         """Factory method to create orders in bulk"""
         orders = []
         for _ in range(count):
-            order = OrderFactory()
+            order = OrderFactory(**attributes)
             resp = self.client.post("/api/orders", json=order.serialize())
             self.assertEqual(
                 resp.status_code,
@@ -61,6 +70,20 @@ class TestBase(TestCase):
             orders.append(order)
         return orders
 
+    @contextmanager
+    def _count_queries(self):
+        """Collects every SQL statement sent to the database inside the block"""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):  # pylint: disable=unused-argument
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
     def test_index(self):
         """It should call the home page"""
         resp = self.client.get("/")
@@ -0,0 +1,329 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Batch API Service Test Suite
+"""
+
+import logging
+import os
+import time
+from unittest.mock import patch
+
+from service.common import status
+from service.models import Order, OrderStatus, db
+from tests.factories import ItemFactory, OrderFactory
+from tests.test_base import TestBase
+from wsgi import app
+
+BASE_URL = "/api/orders"
+BENCHMARK_BATCH = int(os.getenv("BENCHMARK_BATCH", "200"))
+# the speedup of the batch asserted against PostgreSQL, e.g. 10 over the
+# network, where each request pays its round trips; a local database is
+# bound by the work per row in Python and only gets about 6x
+BENCHMARK_SPEEDUP = float(os.getenv("BENCHMARK_SPEEDUP", "0"))
+
+logger = logging.getLogger(__name__)
+
+
+def make_order_payload(item_count=2):
+    """Returns the JSON of a fake Order with fake Items"""
+    order = OrderFactory()
+    data = order.serialize()
+    data["items"] = [ItemFactory().serialize() for _ in range(item_count)]
+    return data
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestBatchService(TestBase):
+    """Batch REST API Server Tests"""
+
+    def test_create_orders_batch(self):
+        """It should Create a batch of Orders with their Items"""
+        payload = [make_order_payload() for _ in range(5)]
+        resp = self.client.post(f"{BASE_URL}/batch", json=payload)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual(data["created"], 5)
+        self.assertEqual(data["failed"], 0)
+        for index, result in enumerate(data["results"]):
+            self.assertEqual(result["index"], index)
+            self.assertEqual(result["status"], status.HTTP_201_CREATED)
+            resp = self.client.get(result["location"])
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            order = resp.get_json()
+            self.assertEqual(order["id"], result["id"])
+            self.assertEqual(order["customer_name"], payload[index]["customer_name"])
+            self.assertEqual(len(order["items"]), 2)
+
+    def test_create_orders_batch_partial(self):
+        """It should report the Orders of a batch that are not valid"""
+        payload = [make_order_payload(), {"status": "CREATED"}, make_order_payload()]
+        payload[2]["status"] = "UNKNOWN"
+        payload.append(make_order_payload())
+        resp = self.client.post(f"{BASE_URL}/batch", json=payload)
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        data = resp.get_json()
+        self.assertEqual(data["created"], 2)
+        self.assertEqual(data["failed"], 2)
+        outcomes = [result["status"] for result in data["results"]]
+        self.assertEqual(
+            outcomes,
+            [
+                status.HTTP_201_CREATED,
+                status.HTTP_400_BAD_REQUEST,
+                status.HTTP_400_BAD_REQUEST,
+                status.HTTP_201_CREATED,
+            ],
+        )
+        self.assertIn("customer_name", data["results"][1]["error"])
+        self.assertEqual(len(Order.all()), 2)
+
+    def test_create_orders_batch_in_chunks(self):
+        """It should only roll back the chunk of a batch that failed"""
+        payload = [make_order_payload() for _ in range(4)]
+        chunk_size = app.config["BULK_CHUNK_SIZE"]
+        app.config["BULK_CHUNK_SIZE"] = 2
+        real_flush = db.session.flush
+
+        def fail_second_chunk():
+            if flush_mock.call_count > 1:
+                raise Exception("chunk failed")  # pylint: disable=broad-exception-raised
+            real_flush()
+
+        try:
+            with patch("service.models.db.session.flush") as flush_mock:
+                flush_mock.side_effect = fail_second_chunk
+                resp = self.client.post(f"{BASE_URL}/batch", json=payload)
+        finally:
+            app.config["BULK_CHUNK_SIZE"] = chunk_size
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        data = resp.get_json()
+        self.assertEqual(data["created"], 2)
+        outcomes = [result["status"] for result in data["results"]]
+        self.assertEqual(outcomes[:2], [status.HTTP_201_CREATED] * 2)
+        self.assertEqual(outcomes[2:], [status.HTTP_400_BAD_REQUEST] * 2)
+        self.assertIn("chunk failed", data["results"][3]["error"])
+
+    def test_create_orders_batch_bad_request(self):
+        """It should not Create a batch that is not a list or is too large"""
+        resp = self.client.post(f"{BASE_URL}/batch", json=make_order_payload())
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        max_size = app.config["MAX_BATCH_SIZE"]
+        app.config["MAX_BATCH_SIZE"] = 2
+        try:
+            payload = [make_order_payload() for _ in range(3)]
+            resp = self.client.post(f"{BASE_URL}/batch", json=payload)
+        finally:
+            app.config["MAX_BATCH_SIZE"] = max_size
+        self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    def test_create_orders_batch_query_count(self):
+        """It should Create a batch of Orders with a constant number of queries"""
+        if db.engine.dialect.name != "postgresql":
+            self.skipTest("only PostgreSQL batches INSERT ... RETURNING of serial ids")
+        with self._count_queries() as statements:
+            resp = self.client.post(
+                f"{BASE_URL}/batch", json=[make_order_payload() for _ in range(2)]
+            )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        few_queries = len(statements)
+        with self._count_queries() as statements:
+            resp = self.client.post(
+                f"{BASE_URL}/batch", json=[make_order_payload() for _ in range(20)]
+            )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(statements), few_queries)
+
+    def test_create_orders_batch_throughput(self):
+        """It should Create a batch of Orders much faster than one by one"""
+        if BENCHMARK_SPEEDUP and db.engine.dialect.name != "postgresql":
+            self.skipTest("the speedup is measured against PostgreSQL")
+        payload = [make_order_payload() for _ in range(BENCHMARK_BATCH)]
+        with self._count_queries() as single_statements:
+            start = time.perf_counter()
+            for data in payload:
+                resp = self.client.post(BASE_URL, json=data)
+                self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            one_by_one = time.perf_counter() - start
+
+        with self._count_queries() as batch_statements:
+            start = time.perf_counter()
+            resp = self.client.post(f"{BASE_URL}/batch", json=payload)
+            batched = time.perf_counter() - start
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        # the round trips the batch saves, whatever the host; only PostgreSQL
+        # batches the INSERT ... RETURNING of the rows
+        if db.engine.dialect.name == "postgresql":
+            self.assertGreaterEqual(len(single_statements), 10 * len(batch_statements))
+
+        speedup = one_by_one / batched
+        logger.info(
+            "Created %d orders: %.0f orders/s one by one, %.0f orders/s batched (%.1fx)",
+            BENCHMARK_BATCH,
+            BENCHMARK_BATCH / one_by_one,
+            BENCHMARK_BATCH / batched,
+            speedup,
+        )
+        self.assertGreater(speedup, max(BENCHMARK_SPEEDUP, 1))
+
+    def test_add_items_batch(self):
+        """It should add a batch of Items to an Order"""
+        order = self._create_orders(1)[0]
+        payload = [ItemFactory().serialize() for _ in range(50)]
+        resp = self.client.post(f"{BASE_URL}/{order.id}/items/batch", json=payload)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual(data["order_id"], order.id)
+        self.assertEqual(len(data["ids"]), 50)
+
+        resp = self.client.get(resp.headers["Location"])
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        items = resp.get_json()
+        self.assertEqual(sorted(item["id"] for item in items), sorted(data["ids"]))
+        by_id = {item["id"]: item for item in items}
+        for item_id, item in zip(data["ids"], payload):
+            self.assertEqual(by_id[item_id]["product_name"], item["product_name"])
+            self.assertEqual(by_id[item_id]["quantity"], item["quantity"])
+
+    def test_add_items_batch_invalid_item(self):
+        """It should not add any Item of a batch with an invalid Item"""
+        order = self._create_orders(1)[0]
+        payload = [ItemFactory().serialize(), {"product_name": "no quantity"}]
+        resp = self.client.post(f"{BASE_URL}/{order.id}/items/batch", json=payload)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get(f"{BASE_URL}/{order.id}/items")
+        self.assertEqual(resp.get_json(), [])
+
+    def test_add_items_batch_failed(self):
+        """It should not add any Item of a batch when the insert fails"""
+        order = self._create_orders(1)[0]
+        payload = [ItemFactory().serialize() for _ in range(3)]
+        with patch("service.models.db.session.commit") as commit_mock:
+            commit_mock.side_effect = Exception("insert failed")
+            resp = self.client.post(f"{BASE_URL}/{order.id}/items/batch", json=payload)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get(f"{BASE_URL}/{order.id}/items")
+        self.assertEqual(resp.get_json(), [])
+
+    def test_add_items_batch_bad_request(self):
+        """It should not add a batch of Items that is not a list, too large or for no Order"""
+        resp = self.client.post(f"{BASE_URL}/0/items/batch", json=[])
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        order = self._create_orders(1)[0]
+        resp = self.client.post(
+            f"{BASE_URL}/{order.id}/items/batch", json=ItemFactory().serialize()
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        max_size = app.config["MAX_BATCH_SIZE"]
+        app.config["MAX_BATCH_SIZE"] = 2
+        try:
+            payload = [ItemFactory().serialize() for _ in range(3)]
+            resp = self.client.post(f"{BASE_URL}/{order.id}/items/batch", json=payload)
+        finally:
+            app.config["MAX_BATCH_SIZE"] = max_size
+        self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    def test_add_items_batch_query_count(self):
+        """It should add a batch of Items with a constant number of queries"""
+        if db.engine.dialect.name != "postgresql":
+            self.skipTest("only PostgreSQL batches INSERT ... RETURNING of serial ids")
+        order = self._create_orders(1)[0]
+        url = f"{BASE_URL}/{order.id}/items/batch"
+        with self._count_queries() as statements:
+            resp = self.client.post(url, json=[ItemFactory().serialize()])
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        few_queries = len(statements)
+        with self._count_queries() as statements:
+            resp = self.client.post(url, json=[ItemFactory().serialize() for _ in range(50)])
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(statements), few_queries)
+
+    def test_update_statuses_by_ids(self):
+        """It should report the status change of every Order of a list"""
+        created, cancelled, shipped = (
+            self._create_orders(1, status=order_status)[0]
+            for order_status in (OrderStatus.CREATED, OrderStatus.CANCELLED, OrderStatus.SHIPPED)
+        )
+        ids = [created.id, cancelled.id, shipped.id, 0, created.id]
+        with self._count_queries() as statements:
+            resp = self.client.put(f"{BASE_URL}/status", json={"status": "shipped", "ids": ids})
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        # the UPDATE, the INSERTs of its changes and events and the statuses of the others
+        self.assertEqual(len(statements), 4)
+        data = resp.get_json()
+        self.assertEqual((data["changed"], data["unchanged"], data["failed"]), (1, 1, 2))
+        results = data["results"]
+        self.assertEqual([result["id"] for result in results], ids[:4])
+        self.assertEqual(results[0], {"id": created.id, "status": 200, "order_status": "SHIPPED", "changed": True})
+        self.assertEqual(results[1]["status"], status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(results[1]["order_status"], "CANCELLED")
+        self.assertIn("CANCELLED", results[1]["error"])
+        self.assertFalse(results[2]["changed"])
+        self.assertEqual(results[3]["status"], status.HTTP_404_NOT_FOUND)
+
+        resp = self.client.get(f"{BASE_URL}/{created.id}")
+        self.assertEqual(resp.get_json()["status"], "SHIPPED")
+        resp = self.client.get(f"{BASE_URL}/{cancelled.id}")
+        self.assertEqual(resp.get_json()["status"], "CANCELLED")
+
+    def test_update_statuses_by_filter(self):
+        """It should change the status of the Orders matching a filter"""
+        orders = self._create_orders(3, status=OrderStatus.IN_PROGRESS, customer_name="Warehouse")
+        self._create_orders(2, status=OrderStatus.IN_PROGRESS)
+        payload = {"status": "SHIPPED", "filter": {"customer_name": "Warehouse", "order_status": "in_progress"}}
+        resp = self.client.put(f"{BASE_URL}/status", json=payload)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["changed"], 3)
+        self.assertEqual([result["id"] for result in data["results"]], sorted(order.id for order in orders))
+        self.assertEqual(len(Order.find_by_filters(order_status="IN_PROGRESS")), 2)
+
+        # nothing matches any more
+        resp = self.client.put(f"{BASE_URL}/status", json=payload)
+        self.assertEqual(resp.get_json(), {"changed": 0, "unchanged": 0, "failed": 0, "results": []})
+
+    def test_update_statuses_bad_request(self):
+        """It should not change the status of Orders badly selected"""
+        order = self._create_orders(1, status=OrderStatus.CREATED)[0]
+        url = f"{BASE_URL}/status"
+        for payload in (
+            [order.id],
+            {"ids": [order.id]},
+            {"status": "LOST", "ids": [order.id]},
+            {"status": "SHIPPED"},
+            {"status": "SHIPPED", "ids": [order.id], "filter": {}},
+            {"status": "SHIPPED", "ids": order.id},
+            {"status": "SHIPPED", "ids": [str(order.id)]},
+            {"status": "SHIPPED", "filter": {"id": order.id}},
+            {"status": "SHIPPED", "filter": {"min_total": "10"}},
+        ):
+            resp = self.client.put(url, json=payload)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, payload)
+        self.assertEqual(Order.find_status(order.id), OrderStatus.CREATED)
+
+        self._create_orders(2)
+        max_size = app.config["MAX_BATCH_SIZE"]
+        app.config["MAX_BATCH_SIZE"] = 2
+        try:
+            resp = self.client.put(url, json={"status": "SHIPPED", "filter": {}})
+            self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+            resp = self.client.put(url, json={"status": "SHIPPED", "ids": [1, 2, 3]})
+            self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        finally:
+            app.config["MAX_BATCH_SIZE"] = max_size
@@ -0,0 +1,343 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the Cache
+"""
+
+import fnmatch
+import sys
+import time
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import Flask
+
+from service.common import status
+from service.common.cache import Cache, LRUCache, NullCache, RedisCache, cache, cache_key
+from service.models import Order, OrderStatus
+from tests.factories import ItemFactory
+from tests.test_base import TestBase
+
+BASE_URL = "/api/orders"
+
+
+class FakeRedis:
+    """An in-memory stand in for the subset of the Redis client the cache uses"""
+
+    def __init__(self):
+        self.values = {}
+
+    @classmethod
+    def from_url(cls, url):  # pylint: disable=unused-argument
+        """Mimics redis.Redis.from_url"""
+        return cls()
+
+    def get(self, key):
+        """Returns a value unless it expired"""
+        value, expires = self.values.get(key, (None, 0))
+        return value if expires > time.monotonic() else None
+
+    def set(self, key, value, px):
+        """Stores a value for px milliseconds"""
+        self.values[key] = (value, time.monotonic() + px / 1000)
+
+    def incr(self, key):
+        """Increments a counter that never expires"""
+        value = int(self.get(key) or 0) + 1
+        self.values[key] = (value, float("inf"))
+        return value
+
+    def eval(self, script, numkeys, *args):
+        """Mimics RedisCache.SET_UNLESS_DELETED, the only script the cache runs"""
+        assert script == RedisCache.SET_UNLESS_DELETED and numkeys == 2
+        key, deleted, value, version, px = args
+        if int(self.get(deleted) or 0) > version:
+            return 0
+        self.set(key, value, px)
+        return 1
+
+    def delete(self, key):
+        """Removes a key"""
+        self.values.pop(key, None)
+
+    def scan_iter(self, match):
+        """Iterates over the keys matching a glob"""
+        return [key for key in list(self.values) if fnmatch.fnmatch(key, match)]
+
+
+######################################################################
+#  C A C H E   B A C K E N D   T E S T   C A S E S
+######################################################################
+class TestCacheBackends(TestCase):
+    """Cache Backend Tests"""
+
+    def test_lru_cache(self):
+        """It should evict the least recently used entries"""
+        lru = LRUCache(max_size=2, ttl=60)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        self.assertEqual(lru.get("a"), 1)
+        lru.set("c", 3)
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(lru.get("a"), 1)
+        self.assertEqual(lru.get("c"), 3)
+        self.assertEqual(len(lru), 2)
+        lru.delete("a")
+        self.assertIsNone(lru.get("a"))
+        lru.clear()
+        self.assertEqual(len(lru), 0)
+
+    def test_lru_cache_ttl(self):
+        """It should expire entries older than the ttl"""
+        lru = LRUCache(max_size=2, ttl=0.01)
+        lru.set("a", 1)
+        time.sleep(0.02)
+        self.assertIsNone(lru.get("a"))
+        self.assertEqual(len(lru), 0)
+
+    def test_lru_cache_version(self):
+        """It should drop a set when the key was deleted after its version"""
+        lru = LRUCache(max_size=2, ttl=60)
+        version = lru.version("a")
+        lru.delete("a")
+        lru.set("a", "stale", version)
+        self.assertIsNone(lru.get("a"))
+        lru.set("a", "fresh", lru.version("a"))
+        self.assertEqual(lru.get("a"), "fresh")
+        # the other keys are not held back
+        version = lru.version("b")
+        lru.delete("a")
+        lru.set("b", 2, version)
+        self.assertEqual(lru.get("b"), 2)
+        # a delete forgotten by the bounded map still drops the older versions
+        version = lru.version("a")
+        for key in ("a", "c", "d"):
+            lru.delete(key)
+        lru.set("a", "stale", version)
+        self.assertIsNone(lru.get("a"))
+        version = lru.version("a")
+        lru.clear()
+        lru.set("b", "stale", version)
+        self.assertIsNone(lru.get("b"))
+
+    def test_redis_cache(self):
+        """It should keep values as JSON in a shared client"""
+        client = FakeRedis()
+        shared = RedisCache(client, ttl=60, prefix="test:")
+        shared.set("Order:1", {"id": 1, "price": Decimal("9.99")})
+        self.assertIn("test:Order:1", client.values)
+        self.assertEqual(shared.get("Order:1"), {"id": 1, "price": "9.99"})
+        shared.delete("Order:1")
+        self.assertIsNone(shared.get("Order:1"))
+        shared.set("Order:2", {"id": 2})
+        client.values["other"] = ("kept", time.monotonic() + 60)
+        shared.clear()
+        self.assertIsNone(shared.get("Order:2"))
+        self.assertEqual(client.get("other"), "kept")
+
+    def test_redis_cache_version(self):
+        """It should drop a set when another worker deleted the key after its version"""
+        client = FakeRedis()
+        worker, other_worker = RedisCache(client, ttl=60), RedisCache(client, ttl=60)
+        version = worker.version("Order:1")
+        other_worker.delete("Order:1")
+        worker.set("Order:1", {"id": 1, "status": "CREATED"}, version)
+        self.assertIsNone(other_worker.get("Order:1"))
+        worker.set("Order:1", {"id": 1, "status": "SHIPPED"}, worker.version("Order:1"))
+        self.assertEqual(other_worker.get("Order:1"), {"id": 1, "status": "SHIPPED"})
+        worker.clear()
+        self.assertGreater(worker.version("Order:1"), version)
+
+    def test_null_cache(self):
+        """It should not cache anything when caching is off"""
+        null = NullCache()
+        null.set("a", 1)
+        self.assertIsNone(null.get("a"))
+        null.delete("a")
+        null.clear()
+
+    def test_cache_stats(self):
+        """It should count the hits and misses"""
+        counted = Cache(LRUCache())
+        self.assertIsNone(counted.get("a"))
+        counted.set("a", 1)
+        self.assertEqual(counted.get("a"), 1)
+        counted.delete("a", "b")
+        self.assertIsNone(counted.get("a"))
+        self.assertEqual(counted.stats(), {"backend": "LRUCache", "hits": 1, "misses": 2})
+        counted.clear()
+
+    def test_cache_version(self):
+        """It should drop a set older than the ttl of the delete markers"""
+        counted = Cache(LRUCache(ttl=0.01))
+        version = counted.version("a")
+        time.sleep(0.02)
+        counted.set("a", 1, version)
+        self.assertIsNone(counted.get("a"))
+        counted.set("a", 1, counted.version("a"))
+        self.assertEqual(counted.get("a"), 1)
+
+    def test_init_app(self):
+        """It should create the backend selected by the configuration"""
+        app = Flask(__name__)
+        configured = Cache(LRUCache())
+        configured.init_app(app)
+        self.assertIsInstance(configured.backend, NullCache)
+        app.config.update(CACHE_BACKEND="LRU", CACHE_MAX_SIZE=5, CACHE_TTL=1)
+        configured.init_app(app)
+        self.assertIsInstance(configured.backend, LRUCache)
+        self.assertEqual(configured.backend.max_size, 5)
+
+        app.config.update(CACHE_BACKEND="redis", CACHE_URL="redis://cache:6379/0")
+        with patch.dict(sys.modules, {"redis": SimpleNamespace(Redis=FakeRedis)}):
+            configured.init_app(app)
+        self.assertIsInstance(configured.backend, RedisCache)
+        self.assertIsInstance(configured.backend.client, FakeRedis)
+
+        app.config.update(CACHE_BACKEND="none")
+        configured.init_app(app)
+        self.assertIsInstance(configured.backend, NullCache)
+
+        app.config.update(CACHE_BACKEND="memcached")
+        self.assertRaises(ValueError, configured.init_app, app)
+
+
+######################################################################
+#  C A C H E D   R O U T E S   T E S T   C A S E S
+######################################################################
+class TestCachedRoutes(TestBase):
+    """Order Cache Invalidation Tests"""
+
+    def setUp(self):
+        super().setUp()
+        # caching is off by default, these tests run as a single worker
+        self.addCleanup(setattr, cache, "backend", cache.backend)
+        cache.backend = LRUCache()
+        # cancelling an Order that is already cancelled changes nothing
+        self.order = self._create_orders(1, status=OrderStatus.CREATED)[0]
+        self.url = f"{BASE_URL}/{self.order.id}"
+
+    def _get(self):
+        """Reads the order and returns it with the hit and miss counters"""
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        stats = cache.stats()
+        return resp.get_json(), stats["hits"], stats["misses"]
+
+    def _assert_invalidated(self, change):
+        """Asserts the cached order is refreshed after a change"""
+        self._get()
+        _, hits, misses = self._get()
+        self.assertEqual(cache.stats()["hits"], hits)
+        change()
+        data, _, new_misses = self._get()
+        self.assertEqual(new_misses, misses + 1)
+        return data
+
+    def test_read_order_from_cache(self):
+        """It should read an Order from the cache after the first read"""
+        with self._count_queries() as statements:
+            first, hits, misses = self._get()
+        self.assertGreater(len(statements), 0)
+        with self._count_queries() as statements:
+            second, new_hits, new_misses = self._get()
+        self.assertEqual(statements, [])
+        self.assertEqual(first, second)
+        self.assertEqual((new_hits, new_misses), (hits + 1, misses))
+
+        resp = self.client.get("/diagnostics")
+        self.assertEqual(resp.get_json()["cache"]["hits"], new_hits)
+
+    def test_update_invalidates(self):
+        """It should refresh the cached Order when it is updated"""
+        data = self._assert_invalidated(
+            lambda: self.client.put(
+                self.url, json={"customer_name": "New Name", "status": "CREATED"}
+            )
+        )
+        self.assertEqual(data["customer_name"], "New Name")
+
+    def test_status_invalidates(self):
+        """It should refresh the cached Order when its status changes"""
+        if self.order.status.value == "CANCELLED":
+            self.skipTest("a cancelled order cannot change status")
+        new_status = "SHIPPED" if self.order.status.value != "SHIPPED" else "COMPLETED"
+        data = self._assert_invalidated(
+            lambda: self.client.put(f"{self.url}/status", json={"status": new_status})
+        )
+        self.assertEqual(data["status"], new_status)
+
+    def test_cancel_invalidates(self):
+        """It should refresh the cached Order when it is cancelled"""
+        data = self._assert_invalidated(lambda: self.client.put(f"{self.url}/cancel"))
+        self.assertEqual(data["status"], "CANCELLED")
+
+    def test_late_set_dropped(self):
+        """It should not cache an Order read before a write that invalidated it"""
+        stale = self._get()[0]
+        cache.clear()
+        find = Order.find
+        writes = []
+
+        def find_then_write(by_id):
+            # another request commits a change after this one read the Order
+            order = find(by_id)
+            if not writes:
+                writes.append(order.serialize())
+                self.client.put(self.url, json={"customer_name": "Written", "status": stale["status"]})
+            return order
+
+        with patch.object(Order, "find", side_effect=find_then_write):
+            Order.find_serialized(self.order.id)
+        # the copy read before the write is not cached
+        self.assertIsNone(cache.backend.get(cache_key("Order", self.order.id)))
+        data, _, _ = self._get()
+        self.assertEqual(data["customer_name"], "Written")
+
+    def test_delete_invalidates(self):
+        """It should not read a deleted Order from the cache"""
+        self._get()
+        self.client.delete(self.url)
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_item_changes_invalidate(self):
+        """It should refresh the cached Order when its Items change"""
+        item = ItemFactory()
+        data = self._assert_invalidated(
+            lambda: self.client.post(f"{self.url}/items", json=item.serialize())
+        )
+        self.assertEqual(len(data["items"]), 1)
+        item_url = f"{self.url}/items/{data['items'][0]['id']}"
+
+        item.quantity = 99
+        data = self._assert_invalidated(
+            lambda: self.client.put(item_url, json=item.serialize())
+        )
+        self.assertEqual(data["items"][0]["quantity"], 99)
+
+        data = self._assert_invalidated(
+            lambda: self.client.post(
+                f"{self.url}/items/batch", json=[item.serialize(), item.serialize()]
+            )
+        )
+        self.assertEqual(len(data["items"]), 3)
+
+        data = self._assert_invalidated(lambda: self.client.delete(item_url))
+        self.assertEqual(len(data["items"]), 2)
@@ -0,0 +1,170 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the change feed of the Orders and Items
+"""
+
+from datetime import timedelta
+
+from sqlalchemy import select, update
+
+from service.common import status
+from service.models import Order, OrderChange, OrderStatus, db
+from tests.factories import ItemFactory
+from tests.test_base import TestBase
+
+BASE_URL = "/api/orders"
+CHANGES_URL = f"{BASE_URL}/changes"
+
+
+######################################################################
+#  C H A N G E   F E E D   T E S T   C A S E S
+######################################################################
+class TestChangeFeed(TestBase):
+    """Change Feed Tests"""
+
+    def _read_changes(self, **query):
+        """Reads a page of the change feed"""
+        resp = self.client.get(CHANGES_URL, query_string=query)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return resp.get_json()
+
+    def _read_all(self, since=None, limit=2):
+        """Follows the cursor of the change feed until it has no more changes"""
+        changes = []
+        while True:
+            query = {"limit": limit}
+            if since:
+                query["since"] = since
+            page = self._read_changes(**query)
+            changes.extend(page["changes"])
+            since = page["cursor"]
+            if not page["more"]:
+                return changes, since
+
+    def test_change_feed(self):
+        """It should list the created, updated and deleted Orders and Items"""
+        order = self._create_orders(1)[0]
+        url = f"{BASE_URL}/{order.id}"
+        item = self.client.post(f"{url}/items", json=ItemFactory().serialize()).get_json()
+        page = self._read_changes()
+        entries = {(change["entity"], change["id"]): change for change in page["changes"]}
+        self.assertEqual(entries[("order", order.id)]["operation"], "created")
+        self.assertEqual(entries[("item", item["id"])]["operation"], "created")
+        self.assertEqual(entries[("item", item["id"])]["order_id"], order.id)
+        # the latest state of the Order, with the totals of its new Item
+        data = self.client.get(url, query_string={"fields": "item_count"}).get_json()
+        self.assertEqual(entries[("order", order.id)]["data"]["item_count"], data["item_count"])
+        self.assertEqual(entries[("item", item["id"])]["data"]["product_name"], item["product_name"])
+        self.assertNotIn("items", entries[("order", order.id)]["data"])
+        self.assertFalse(page["more"])
+
+        # nothing new after the cursor
+        cursor = page["cursor"]
+        self.assertEqual(self._read_changes(since=cursor), {"changes": [], "cursor": cursor, "more": False})
+
+        data = self.client.get(url).get_json()
+        data["customer_name"] = "Renamed"
+        # the items of an update are added to the Order
+        del data["items"]
+        self.client.put(url, json=data)
+        self.client.delete(f"{url}/items/{item['id']}")
+        page = self._read_changes(since=cursor)
+        operations = [(change["entity"], change["id"], change["operation"]) for change in page["changes"]]
+        self.assertEqual(operations, [("item", item["id"], "deleted"), ("order", order.id, "updated")])
+        self.assertIsNone(page["changes"][0]["data"])
+        self.assertEqual(page["changes"][1]["data"]["customer_name"], "Renamed")
+        self.assertEqual(page["changes"][1]["data"]["item_count"], data["item_count"] - 1)
+
+        self.client.delete(url)
+        page = self._read_changes(since=page["cursor"])
+        self.assertEqual(
+            [(change["entity"], change["id"], change["operation"], change["data"]) for change in page["changes"]],
+            [("order", order.id, "deleted", None)],
+        )
+
+    def test_change_feed_pages(self):
+        """It should resume the change feed from its cursor in bounded batches"""
+        orders = self._create_orders(5, status=OrderStatus.CREATED)
+        changes, cursor = self._read_all(limit=2)
+        order_ids = [change["id"] for change in changes if change["entity"] == "order"]
+        self.assertEqual(order_ids, [order.id for order in orders])
+        self.assertEqual(len({change["seq"] for change in changes}), len(changes))
+
+        with self._count_queries() as statements:
+            page = self._read_changes(limit=3)
+        self.assertEqual(len(page["changes"]), 3)
+        self.assertTrue(page["more"])
+        # the changes, then the current Orders and Items, whatever the page size
+        self.assertLessEqual(len(statements), 3)
+
+        resp = self.client.put(f"{BASE_URL}/{orders[0].id}/cancel")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        later, _ = self._read_all(since=cursor)
+        self.assertEqual([(change["id"], change["operation"]) for change in later], [(orders[0].id, "updated")])
+        self.assertEqual(later[0]["data"]["status"], "CANCELLED")
+
+    def test_change_feed_latest_change(self):
+        """It should return one change per record in a page, at its latest position"""
+        orders = self._create_orders(2)
+        first, second = orders[0], orders[1]
+        cursor = self._read_changes()["cursor"]
+        for order in (first, second, first):
+            data = self.client.get(f"{BASE_URL}/{order.id}").get_json()
+            data["customer_name"] += "!"
+            self.client.put(f"{BASE_URL}/{order.id}", json=data)
+        changes = self._read_changes(since=cursor)["changes"]
+        self.assertEqual([change["id"] for change in changes], [second.id, first.id])
+        self.assertTrue(changes[1]["data"]["customer_name"].endswith("!!"))
+
+    def test_change_feed_core_updates(self):
+        """It should log the changes made by the bulk statements"""
+        orders = self._create_orders(3, status=OrderStatus.IN_PROGRESS)
+        cursor = self._read_changes(limit=1000)["cursor"]
+        ids = [order.id for order in orders]
+        resp = self.client.put(f"{BASE_URL}/status", json={"status": "SHIPPED", "ids": ids[:2]})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.client.put(f"{BASE_URL}/{ids[2]}/status", json={"status": "CANCELLED"})
+        changes, cursor = self._read_all(since=cursor)
+        self.assertEqual(
+            [(change["id"], change["data"]["status"]) for change in changes],
+            [(ids[0], "SHIPPED"), (ids[1], "SHIPPED"), (ids[2], "CANCELLED")],
+        )
+
+        db.session.execute(update(Order).where(Order.id == ids[0]).values(item_count=999))
+        db.session.commit()
+        self.assertEqual(Order.refresh_totals([ids[0]]), 1)
+        changes, _ = self._read_all(since=cursor)
+        self.assertEqual([(change["id"], change["operation"]) for change in changes], [(ids[0], "updated")])
+
+    def test_bad_cursor(self):
+        """It should reject a malformed cursor or limit"""
+        resp = self.client.get(CHANGES_URL, query_string={"since": "not-a-cursor"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get(CHANGES_URL, query_string={"since": "WyJhIiwiYiJd"})  # ["a","b"]
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get(CHANGES_URL, query_string={"limit": 0})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_prune(self):
+        """It should remove the changes older than the retention"""
+        self._create_orders(2)
+        db.session.execute(update(OrderChange).values(changed_at=OrderChange.changed_at - timedelta(days=8)))
+        db.session.commit()
+        self._create_orders(1)
+        self.assertEqual(OrderChange.prune(7), 2)
+        self.assertEqual(len(db.session.scalars(select(OrderChange)).all()), 1)
@@ -19,12 +19,26 @@ CLI Command Extensions for Flask
 """
 
 import os
+import subprocess
+import sys
+import tempfile
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 
 from click.testing import CliRunner
+from sqlalchemy import create_engine
 
-from service.common.cli_commands import db_create  # noqa: E402
+from service.common.cli_commands import (  # noqa: E402
+    changes_prune,
+    db_create,
+    db_rebuild_totals,
+    db_upgrade,
+    idempotency_sweep,
+    outbox_dispatch,
+)
+from service.models import migrations
+from service.models.migrations import Migration
+from wsgi import app
 
 
 class TestFlaskCLI(TestCase):
@@ -33,10 +47,82 @@ class TestFlaskCLI(TestCase):
     def setUp(self):
         self.runner = CliRunner()
 
+    @patch("service.common.cli_commands.migrations")
     @patch("service.common.cli_commands.db")
-    def test_db_create(self, db_mock):
+    def test_db_create(self, db_mock, migrations_mock):
         """It should call the db-create command"""
         db_mock.return_value = MagicMock()
         with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+        db_mock.drop_all.assert_called_once_with()
+        migrations_mock.upgrade.assert_called_once_with(db_mock.engine)
+
+    @patch("service.common.cli_commands.migrations")
+    def test_db_upgrade(self, migrations_mock):
+        """It should call the db-upgrade command"""
+        migrations_mock.upgrade.return_value = [Migration(3, "Store the totals of the orders", None)]
+        migrations_mock.HEAD = 3
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_upgrade)
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Applied migration 3: Store the totals of the orders", result.output)
+        self.assertIn("Schema version 3", result.output)
+
+    def test_db_upgrade_empty_database(self):
+        """It should upgrade an empty database without SCHEMA_AUTO_UPGRADE"""
+        with tempfile.TemporaryDirectory() as directory:
+            uri = f"sqlite:///{directory}/orders.db"
+            env = {key: value for key, value in os.environ.items() if key != "SCHEMA_AUTO_UPGRADE"}
+            env.update(FLASK_APP="wsgi:app", DATABASE_URI=uri)
+            result = subprocess.run(
+                [sys.executable, "-m", "flask", "db-upgrade"],
+                env=env, capture_output=True, text=True, timeout=60, check=False,
+            )
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertIn(f"Schema version {migrations.HEAD}", result.stdout)
+            engine = create_engine(uri)
+            self.assertEqual(migrations.verify(engine), migrations.HEAD)
+            engine.dispose()
+
+    @patch("service.common.cli_commands.Order")
+    def test_db_rebuild_totals(self, order_mock):
+        """It should call the db-rebuild-totals command"""
+        order_mock.refresh_totals.return_value = 3
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_rebuild_totals)
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("3 orders", result.output)
+        order_mock.refresh_totals.assert_called_once_with()
+
+    @patch("service.common.cli_commands.idempotency_keys")
+    def test_idempotency_sweep(self, keys_mock):
+        """It should call the idempotency-sweep command"""
+        keys_mock.sweep.return_value = 2
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(idempotency_sweep)
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Removed 2 expired idempotency keys", result.output)
+
+    @patch("service.common.cli_commands.OrderChange")
+    def test_changes_prune(self, change_mock):
+        """It should call the changes-prune command"""
+        change_mock.prune.return_value = 5
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True), app.app_context():
+            result = self.runner.invoke(changes_prune)
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Removed 5 old changes", result.output)
+        change_mock.prune.assert_called_once_with(app.config["CHANGE_RETENTION_DAYS"])
+
+    @patch("service.common.cli_commands.outbox")
+    def test_outbox_dispatch(self, outbox_mock):
+        """It should call the outbox-dispatch command"""
+        outbox_mock.drain.return_value = 4
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(outbox_dispatch, ["--once"])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("Delivered 4 order events", result.output)
+            outbox_mock.run.assert_not_called()
+            result = self.runner.invoke(outbox_dispatch)
+        self.assertEqual(result.exit_code, 0)
+        outbox_mock.run.assert_called_once_with()
@@ -0,0 +1,199 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the optimistic concurrency control of Orders and Items
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import update
+
+from service.common import status
+from service.models import ConflictError, Order, OrderStatus, db
+from tests.factories import ItemFactory
+from tests.test_base import TestBase
+from wsgi import app
+
+BASE_URL = "/api/orders"
+# the statuses the stress test cycles through, each PUT moves to the next one
+CYCLE = ["CREATED", "IN_PROGRESS", "SHIPPED"]
+MAX_RETRIES = 100
+
+
+######################################################################
+#  C O N C U R R E N C Y   T E S T   C A S E S
+######################################################################
+class TestConcurrency(TestBase):
+    """Optimistic Concurrency Tests"""
+
+    def setUp(self):
+        super().setUp()
+        self.order = self._create_orders(1)[0]
+        self.url = f"{BASE_URL}/{self.order.id}"
+        db.session.execute(
+            update(Order).where(Order.id == self.order.id).values(status=OrderStatus.CREATED)
+        )
+        db.session.commit()
+
+    def _bump_version(self):
+        """Changes the Order from another connection, like a concurrent request"""
+        with db.engine.begin() as connection:
+            connection.execute(
+                update(Order.__table__)
+                .where(Order.__table__.c.id == self.order.id)
+                .values(version=Order.__table__.c.version + 1)
+            )
+
+    def test_versions(self):
+        """It should count the updates of Orders and Items"""
+        data = self.client.get(self.url).get_json()
+        self.assertEqual(data["version"], 1)
+        data["customer_name"] = "New Name"
+        resp = self.client.put(self.url, json=data)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["version"], 2)
+
+        resp = self.client.post(f"{self.url}/items", json=ItemFactory().serialize())
+        item = resp.get_json()
+        self.assertEqual(item["version"], 1)
+        item["quantity"] += 1
+        resp = self.client.put(f"{self.url}/items/{item['id']}", json=item)
+        self.assertEqual(resp.get_json()["version"], 2)
+
+        # the totals follow the items without changing the version of the order
+        data = self.client.get(self.url).get_json()
+        self.assertEqual(data["version"], 2)
+        self.assertEqual(data["item_count"], 1)
+
+    def test_stale_update(self):
+        """It should not update an Order changed since it was loaded"""
+        order = Order.find(self.order.id)
+        self._bump_version()
+        order.customer_name = "Lost Update"
+        self.assertRaises(ConflictError, order.update)
+        db.session.expire_all()
+        self.assertNotEqual(Order.find(self.order.id).customer_name, "Lost Update")
+
+        order = Order.find(self.order.id)
+        self._bump_version()
+        self.assertRaises(ConflictError, order.delete)
+        self.assertIsNotNone(Order.find(self.order.id))
+
+    def test_stale_payload(self):
+        """It should not apply a payload read from an older version"""
+        data = self.client.get(self.url).get_json()
+        self._bump_version()
+        resp = self.client.put(self.url, json=data)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.client.put(f"{self.url}/status", json={"status": "SHIPPED", "version": 1})
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
+        item = self.client.post(f"{self.url}/items", json=ItemFactory().serialize()).get_json()
+        item["version"] = 0
+        resp = self.client.put(f"{self.url}/items/{item['id']}", json=item)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
+    def test_conflict_response(self):
+        """It should answer 409 when an update loses the race"""
+        original = Order.update
+
+        def update_after_another_request(order):
+            self._bump_version()
+            original(order)
+
+        data = self.client.get(self.url).get_json()
+        data["customer_name"] = "Lost Update"
+        Order.update = update_after_another_request
+        try:
+            resp = self.client.put(self.url, json=data)
+        finally:
+            Order.update = original
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(resp.get_json()["error"], "Conflict")
+
+    def test_concurrent_status_transitions(self):
+        """It should apply every concurrent status transition to the version it read"""
+        transitions = 40
+
+        def transition(_):
+            client = app.test_client()
+            for conflicts in range(MAX_RETRIES):
+                # a projection is read from the database rather than the cache
+                data = client.get(self.url, query_string={"fields": "status,version"}).get_json()
+                next_status = CYCLE[(CYCLE.index(data["status"]) + 1) % len(CYCLE)]
+                resp = client.put(
+                    f"{self.url}/status",
+                    json={"status": next_status, "version": data["version"]},
+                )
+                if resp.status_code == status.HTTP_200_OK:
+                    return data["version"], resp.get_json(), conflicts
+                self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+            raise AssertionError(f"No transition after {MAX_RETRIES} conflicts")
+
+        with self._count_queries() as statements:
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                results = list(pool.map(transition, range(transitions)))
+
+        # each transition succeeded once and none of them was overwritten
+        for read_version, written, _ in results:
+            self.assertGreater(written["version"], read_version)
+        final = self.client.get(self.url).get_json()
+        self.assertEqual(final["version"], transitions + 1)
+        self.assertEqual(final["status"], CYCLE[transitions % len(CYCLE)])
+        self.assertFalse([statement for statement in statements if "FOR UPDATE" in statement.upper()])
+
+    def test_concurrent_item_changes(self):
+        """It should add Items to an Order concurrently without conflicts"""
+
+        def add_item(_):
+            return app.test_client().post(
+                f"{self.url}/items",
+                json={"product_name": "foo", "quantity": 1, "price": 2},
+            ).status_code
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            codes = list(pool.map(add_item, range(20)))
+        self.assertEqual(codes, [status.HTTP_201_CREATED] * 20)
+        data = self.client.get(self.url).get_json()
+        self.assertEqual(data["item_count"], 20)
+        self.assertEqual(data["total_amount"], 40.0)
+
+    def test_concurrent_item_updates(self):
+        """It should keep the totals of an Order whose Items are updated concurrently"""
+        items = [
+            self.client.post(f"{self.url}/items", json={"product_name": "foo", "quantity": 1, "price": 1}).get_json()
+            for _ in range(4)
+        ]
+
+        def update_item(quantity):
+            client = app.test_client()
+            for item in items:
+                # a conflict on the same Item is retried with its new version
+                while True:
+                    url = f"{self.url}/items/{item['id']}"
+                    data = client.get(url).get_json()
+                    data["quantity"] = quantity
+                    resp = client.put(url, json=data)
+                    if resp.status_code != status.HTTP_409_CONFLICT:
+                        break
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(update_item, range(2, 10)))
+        quantities = [item["quantity"] for item in self.client.get(f"{self.url}/items").get_json()]
+        data = self.client.get(self.url, query_string={"fields": "total_amount"}).get_json()
+        self.assertEqual(data["total_amount"], sum(quantities))
@@ -0,0 +1,76 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the Database Pool
+"""
+
+import sqlite3
+from unittest import TestCase
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import StaticPool
+
+from service.common.db_pool import InstrumentedQueuePool, pool_status
+
+
+def connect():
+    """Creates a raw DBAPI connection for the pools under test"""
+    return sqlite3.connect(":memory:", check_same_thread=False)
+
+
+class TestDatabasePool(TestCase):
+    """Database Pool Tests"""
+
+    def test_pool_status(self):
+        """It should report the occupancy and checkouts of the pool"""
+        pool = InstrumentedQueuePool(connect, pool_size=2, max_overflow=1, timeout=5)
+        first = pool.connect()
+        second = pool.connect()
+        stats = pool_status(pool)
+        self.assertEqual(stats["pool_class"], "InstrumentedQueuePool")
+        self.assertEqual(stats["size"], 2)
+        self.assertEqual(stats["checked_out"], 2)
+        self.assertEqual(stats["max_overflow"], 1)
+        self.assertEqual(stats["timeout"], 5)
+        self.assertEqual(stats["checkouts"], 2)
+        self.assertEqual(stats["timeouts"], 0)
+        self.assertGreaterEqual(stats["checkout_wait_ms"]["max"], 0)
+
+        overflow = pool.connect()
+        self.assertEqual(pool_status(pool)["overflow"], 1)
+        for connection in [first, second, overflow]:
+            connection.close()
+        stats = pool_status(pool)
+        self.assertEqual(stats["checked_out"], 0)
+        self.assertEqual(stats["checked_in"], 2)
+
+    def test_pool_timeout(self):
+        """It should count the checkouts that timed out"""
+        pool = InstrumentedQueuePool(connect, pool_size=1, max_overflow=0, timeout=0.01)
+        connection = pool.connect()
+        self.assertRaises(PoolTimeoutError, pool.connect)
+        stats = pool_status(pool)
+        self.assertEqual(stats["checkouts"], 1)
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertGreaterEqual(stats["checkout_wait_ms"]["max"], 10)
+        self.assertGreater(stats["checkout_wait_ms"]["avg"], 0)
+        connection.close()
+
+    def test_other_pool_status(self):
+        """It should only report the class of pools without a queue"""
+        stats = pool_status(StaticPool(connect))
+        self.assertEqual(stats, {"pool_class": "StaticPool"})
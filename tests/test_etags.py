@@ -0,0 +1,132 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the ETags and conditional requests
+"""
+
+from service.common import status
+from service.models import Order
+from tests.factories import ItemFactory
+from tests.test_base import TestBase
+
+BASE_URL = "/api/orders"
+
+
+######################################################################
+#  E T A G   T E S T   C A S E S
+######################################################################
+class TestETags(TestBase):
+    """Conditional Request Tests"""
+
+    def setUp(self):
+        super().setUp()
+        self.order = self._create_orders(1)[0]
+        self.url = f"{BASE_URL}/{self.order.id}"
+
+    def _add_item(self):
+        """Adds an Item to the Order and returns its JSON"""
+        resp = self.client.post(f"{self.url}/items", json=ItemFactory().serialize())
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        return resp.get_json()
+
+    def _etag(self, url=None):
+        """Reads a resource and returns its ETag"""
+        resp = self.client.get(url or self.url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn("ETag", resp.headers)
+        return resp.headers["ETag"]
+
+    def test_find_etag(self):
+        """It should compute the ETag of an Order like the one of its JSON"""
+        self._add_item()
+        self._add_item()
+        with self._count_queries() as statements:
+            etag = Order.find_etag(self.order.id)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(etag, Order.etag_of(Order.find(self.order.id).serialize()))
+        self.assertEqual(f'"{etag}"', self._etag())
+        self.assertIsNone(Order.find_etag(0))
+
+    def test_get_order_not_modified(self):
+        """It should not send an unchanged Order again"""
+        self._add_item()
+        etag = self._etag()
+        with self._count_queries() as statements:
+            resp = self.client.get(self.url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.headers["ETag"], etag)
+        self.assertEqual(resp.data, b"")
+        self.assertEqual(len(statements), 1)
+
+        resp = self.client.get(self.url, headers={"If-None-Match": '"stale"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["ETag"], etag)
+
+        resp = self.client.get(f"{BASE_URL}/0", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_etag_changes_with_items(self):
+        """It should change the ETag of an Order when its Items change"""
+        etag = self._etag()
+        item = self._add_item()
+        with_item = self._etag()
+        self.assertNotEqual(with_item, etag)
+
+        item["quantity"] += 1
+        self.client.put(f"{self.url}/items/{item['id']}", json=item)
+        updated = self._etag()
+        self.assertNotIn(updated, (etag, with_item))
+
+        self.client.delete(f"{self.url}/items/{item['id']}")
+        resp = self.client.get(self.url, headers={"If-None-Match": updated})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_update_order_if_match(self):
+        """It should only Update an Order that did not change since it was read"""
+        etag = self._etag()
+        data = self.client.get(self.url).get_json()
+        data["customer_name"] = "First Writer"
+        resp = self.client.put(self.url, json=data, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        self.assertEqual(resp.headers["ETag"], self._etag())
+
+        data["customer_name"] = "Second Writer"
+        resp = self.client.put(self.url, json=data, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.get_json()["customer_name"], "First Writer")
+
+    def test_item_etags(self):
+        """It should support conditional requests on Items"""
+        item = self._add_item()
+        url = f"{self.url}/items/{item['id']}"
+        etag = self._etag(url)
+        resp = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        item["quantity"] += 1
+        resp = self.client.put(url, json=item, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        new_etag = resp.headers["ETag"]
+        self.assertNotEqual(new_etag, etag)
+
+        resp = self.client.put(url, json=item, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["ETag"], new_etag)
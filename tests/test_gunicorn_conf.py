@@ -0,0 +1,107 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the Gunicorn configuration
+"""
+
+import os
+import runpy
+import tempfile
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+
+from service.models import db
+from wsgi import app
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "gunicorn.conf.py")
+
+
+def load_config(**env):
+    """Runs the configuration module with environment variables"""
+    with patch.dict(os.environ, env):
+        return runpy.run_path(CONFIG_FILE)
+
+
+class TestGunicornConfig(TestCase):
+    """Gunicorn Configuration Tests"""
+
+    def _cgroup(self, files):
+        """Creates a cgroup directory with the files given"""
+        root = tempfile.mkdtemp()
+        for name, content in files.items():
+            os.makedirs(os.path.dirname(os.path.join(root, name)), exist_ok=True)
+            with open(os.path.join(root, name), "w", encoding="utf-8") as file:
+                file.write(content)
+        return root
+
+    def test_cpu_limit(self):
+        """It should read the CPU quota of the container"""
+        cpu_limit = load_config()["cpu_limit"]
+        with patch("os.cpu_count", return_value=8):
+            self.assertEqual(cpu_limit(self._cgroup({"cpu.max": "50000 100000\n"})), 1)
+            self.assertEqual(cpu_limit(self._cgroup({"cpu.max": "250000 100000\n"})), 3)
+            self.assertEqual(cpu_limit(self._cgroup({"cpu.max": "max 100000\n"})), 8)
+            self.assertEqual(cpu_limit(self._cgroup({"cpu.max": "2000000 100000\n"})), 8)
+            v1 = {"cpu/cpu.cfs_quota_us": "200000\n", "cpu/cpu.cfs_period_us": "100000\n"}
+            self.assertEqual(cpu_limit(self._cgroup(v1)), 2)
+            v1["cpu/cpu.cfs_quota_us"] = "-1\n"
+            self.assertEqual(cpu_limit(self._cgroup(v1)), 8)
+            self.assertEqual(cpu_limit(self._cgroup({})), 8)
+
+    def test_settings(self):
+        """It should size the workers and select the worker class"""
+        config = load_config(PORT="9000")
+        self.assertEqual(config["workers"], 2 * config["cpu_limit"]() + 1)
+        self.assertEqual(config["worker_class"], "gthread")
+        self.assertEqual(config["bind"], "0.0.0.0:9000")
+        self.assertTrue(config["preload_app"])
+
+        config = load_config(
+            GUNICORN_WORKERS="3",
+            GUNICORN_WORKER_CLASS="gevent",
+            GUNICORN_WORKER_CONNECTIONS="50",
+            GUNICORN_BIND="127.0.0.1:8000",
+        )
+        self.assertEqual(config["workers"], 3)
+        self.assertEqual(config["worker_connections"], 50)
+        self.assertEqual(config["bind"], "127.0.0.1:8000")
+        self.assertFalse(config["preload_app"])
+
+        self.assertRaises(ValueError, load_config, GUNICORN_WORKER_CLASS="sync")
+        self.assertRaises(ValueError, load_config, GUNICORN_WORKERS="2", CACHE_BACKEND="lru")
+        self.assertEqual(load_config(GUNICORN_WORKERS="1", CACHE_BACKEND="lru")["workers"], 1)
+
+    def test_server_hooks(self):
+        """It should drop the pooled connections of the master in the workers"""
+        config = load_config()
+        server = SimpleNamespace(
+            cfg=SimpleNamespace(preload_app=True),
+            app=SimpleNamespace(wsgi=lambda: app),
+        )
+        with app.app_context():
+            engine = db.engine
+        with patch.object(engine, "dispose") as dispose:
+            config["when_ready"](server)
+            dispose.assert_called_once_with(close=True)
+            dispose.reset_mock()
+            config["post_fork"](server, None)
+            dispose.assert_called_once_with(close=False)
+            dispose.reset_mock()
+            server.cfg.preload_app = False
+            config["post_fork"](server, None)
+            dispose.assert_not_called()
@@ -0,0 +1,273 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the Idempotency-Keys of the Order creation
+"""
+
+import logging
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import Flask
+from sqlalchemy import select, update
+
+from service.common import status
+from service.common.idempotency import (
+    IdempotencyKeys,
+    MemoryStore,
+    SQLStore,
+    fingerprint,
+    idempotency_keys,
+)
+from service.models import IdempotencyKey, Order, OrderEvent, db
+from tests.factories import ItemFactory, OrderFactory
+from tests.test_base import TestBase
+import wsgi
+
+BASE_URL = "/api/orders"
+
+logger = logging.getLogger(__name__)
+
+
+######################################################################
+#  S T O R E   T E S T   C A S E S
+######################################################################
+class TestIdempotencyStores(TestCase):
+    """Idempotency Store Tests"""
+
+    def test_fingerprint(self):
+        """It should digest a request body whatever the order of its keys"""
+        self.assertEqual(fingerprint({"a": 1, "b": [2]}), fingerprint({"b": [2], "a": 1}))
+        self.assertNotEqual(fingerprint({"a": 1}), fingerprint({"a": 2}))
+        self.assertEqual(len(fingerprint(None)), 40)
+
+    def test_memory_store(self):
+        """It should keep the first response of each key"""
+        store = MemoryStore(max_size=2, ttl=60)
+        self.assertIsNone(store.get("a"))
+        self.assertTrue(store.reserve("a", "digest"))
+        self.assertEqual(store.get("a"), ("digest", None))
+        self.assertFalse(store.reserve("a", "other"))
+        store.complete("a", {"id": 1})
+        self.assertEqual(store.get("a"), ("digest", {"id": 1}))
+        store.release("a")
+        self.assertEqual(store.get("a"), ("digest", {"id": 1}))
+        store.reserve("b", "digest")
+        store.release("b")
+        self.assertIsNone(store.get("b"))
+        store.reserve("b", "digest")
+        store.reserve("c", "digest")
+        self.assertIsNone(store.get("a"))
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.sweep(), 0)
+
+    def test_memory_store_ttl(self):
+        """It should expire and sweep the keys older than the ttl"""
+        store = MemoryStore(ttl=0.01)
+        store.reserve("a", "digest")
+        time.sleep(0.02)
+        self.assertIsNone(store.get("a"))
+        self.assertEqual(store.sweep(), 1)
+        self.assertEqual(len(store), 0)
+        store.reserve("b", "digest")
+        time.sleep(0.02)
+        self.assertTrue(store.reserve("b", "digest"))
+
+    def test_init_app(self):
+        """It should create the store selected by the configuration"""
+        app = Flask(__name__)
+        configured = IdempotencyKeys()
+        app.config.update(IDEMPOTENCY_BACKEND="SQL", IDEMPOTENCY_TTL=5)
+        configured.init_app(app)
+        self.assertIsInstance(configured.store, SQLStore)
+        self.assertIs(configured.store.model, IdempotencyKey)
+        self.assertEqual(configured.store.ttl, 5)
+
+        app.config.update(IDEMPOTENCY_BACKEND="memory", IDEMPOTENCY_MAX_SIZE=3)
+        configured.init_app(app)
+        self.assertIsInstance(configured.store, MemoryStore)
+        self.assertEqual(configured.store.max_size, 3)
+        self.assertTrue(configured.reserve("a", "digest"))
+        configured.complete("a", {})
+        self.assertEqual(configured.get("a"), ("digest", {}))
+        configured.release("a")
+        self.assertEqual(configured.sweep(), 0)
+
+        app.config.update(IDEMPOTENCY_BACKEND="redis")
+        self.assertRaises(ValueError, configured.init_app, app)
+
+
+######################################################################
+#  I D E M P O T E N T   R O U T E S   T E S T   C A S E S
+######################################################################
+class TestIdempotentRoutes(TestBase):
+    """Idempotent Order Creation Tests"""
+
+    def setUp(self):
+        super().setUp()
+        self.payload = OrderFactory().serialize()
+        self.payload["items"] = [ItemFactory().serialize()]
+
+    def _post(self, key, payload=None):
+        return self.client.post(
+            BASE_URL, json=payload or self.payload, headers={"Idempotency-Key": key}
+        )
+
+    def _assert_replays(self):
+        """Asserts a retry gets the original response and creates nothing"""
+        first = self._post("checkout-1")
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        with self._count_queries() as statements:
+            retry = self._post("checkout-1")
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.get_json(), first.get_json())
+        self.assertEqual(retry.headers["Location"], first.headers["Location"])
+        self.assertEqual(retry.headers["Idempotent-Replayed"], "true")
+        self.assertNotIn("Idempotent-Replayed", first.headers)
+        self.assertFalse([statement for statement in statements if "INSERT" in statement.upper()])
+        self.assertEqual(len(Order.all()), 1)
+
+    def test_replay(self):
+        """It should answer a retried creation with the original response"""
+        with patch.object(Order, "deserialize", autospec=True, side_effect=Order.deserialize) as deserialize:
+            self._assert_replays()
+        self.assertEqual(deserialize.call_count, 1)
+        # another key creates another Order
+        self.assertEqual(self._post("checkout-2").status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(Order.all()), 2)
+
+    def test_replay_from_memory(self):
+        """It should replay responses kept in the in-memory store"""
+        store = idempotency_keys.store
+        idempotency_keys.store = MemoryStore()
+        try:
+            self._assert_replays()
+        finally:
+            idempotency_keys.store = store
+
+    def test_key_of_another_request(self):
+        """It should not replay a key for another request"""
+        self._post("checkout-1")
+        payload = dict(self.payload, customer_name="Someone Else")
+        resp = self._post("checkout-1", payload)
+        self.assertEqual(resp.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(len(Order.all()), 1)
+
+    def test_invalid_key(self):
+        """It should not accept an empty or too long key"""
+        for key in ("", "k" * 256):
+            resp = self._post(key)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Order.all(), [])
+
+    def test_failed_request_is_not_stored(self):
+        """It should run a request again when it failed the first time"""
+        payload = dict(self.payload)
+        del payload["customer_name"]
+        self.assertEqual(self._post("checkout-1", payload).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIsNone(idempotency_keys.get("checkout-1"))
+        payload["customer_name"] = "Fixed"
+        self.assertEqual(self._post("checkout-1", payload).status_code, status.HTTP_201_CREATED)
+
+    def test_concurrent_retry(self):
+        """It should only create the Order of the request that reserved its key first"""
+        first = self._post("checkout-1")
+        # the retry looked the key up before the first request reserved it
+        with patch.object(idempotency_keys.store, "get", side_effect=[None, idempotency_keys.get("checkout-1")]):
+            with self._count_queries() as statements:
+                retry = self._post("checkout-1")
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.get_json(), first.get_json())
+        self.assertEqual([order.id for order in Order.all()], [first.get_json()["id"]])
+        # nothing was created, so nothing was deleted or logged
+        self.assertEqual([statement.split()[0].upper() for statement in statements], ["INSERT"])
+        self.assertEqual(len(db.session.scalars(select(OrderEvent)).all()), 1)
+
+    def test_concurrent_requests(self):
+        """It should create one Order for requests with the same key sent at once"""
+
+        def post(_):
+            resp = wsgi.app.test_client().post(BASE_URL, json=self.payload, headers={"Idempotency-Key": "checkout-1"})
+            return resp.status_code, resp.get_json()
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(post, range(16)))
+        created = [body for code, body in results if code == status.HTTP_201_CREATED]
+        # the others ran while the first one was running
+        self.assertEqual(len(created) + [code for code, _ in results].count(status.HTTP_409_CONFLICT), 16)
+        self.assertEqual(len(Order.all()), 1)
+        self.assertTrue(all(body == created[0] for body in created))
+        events = db.session.scalars(select(OrderEvent.event_type)).all()
+        self.assertEqual(events, [OrderEvent.CREATED])
+
+    def test_running_request(self):
+        """It should not run a request while the request of its key is running"""
+        digest = fingerprint(self.payload)
+        self.assertTrue(IdempotencyKey.reserve("checkout-1", digest, 60))
+        db.session.commit()
+        resp = self._post("checkout-1")
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(Order.all(), [])
+
+    def test_failed_creation_releases_key(self):
+        """It should free the key of a request whose Order could not be created"""
+        store = idempotency_keys.store
+        idempotency_keys.store = MemoryStore()
+        try:
+            with patch("service.models.db.session.commit", side_effect=Exception("database down")):
+                self.assertEqual(self._post("checkout-1").status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIsNone(idempotency_keys.get("checkout-1"))
+            self.assertEqual(self._post("checkout-1").status_code, status.HTTP_201_CREATED)
+        finally:
+            idempotency_keys.store = store
+
+    def test_expired_key(self):
+        """It should ignore and sweep the keys older than the ttl"""
+        self._post("checkout-1")
+        db.session.execute(update(IdempotencyKey).values(expires_at=datetime.utcnow() - timedelta(seconds=1)))
+        db.session.commit()
+        self.assertIsNone(idempotency_keys.get("checkout-1"))
+        self.assertEqual(idempotency_keys.sweep(), 1)
+        self.assertEqual(self._post("checkout-1").status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(Order.all()), 2)
+
+        # a key that expired but was not swept yet is reused
+        db.session.execute(update(IdempotencyKey).values(expires_at=datetime.utcnow() - timedelta(seconds=1)))
+        db.session.commit()
+        payload = dict(self.payload, customer_name="Someone Else")
+        resp = self._post("checkout-1", payload)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self._post("checkout-1", payload).get_json(), resp.get_json())
+        self.assertEqual(len(Order.all()), 3)
+
+    def test_lookup_latency(self):
+        """It should look a key up in well under a millisecond"""
+        for number in range(100):
+            self._post(f"checkout-{number}", dict(self.payload, customer_name=f"Customer {number}"))
+        timings = []
+        for number in range(200):
+            start = time.perf_counter()
+            self.assertIsNotNone(idempotency_keys.get(f"checkout-{number % 100}"))
+            timings.append((time.perf_counter() - start) * 1000)
+        db.session.rollback()
+        median = statistics.median(timings)
+        logger.info("Idempotency-Key lookup: %.3f ms median, %.3f ms max", median, max(timings))
+        self.assertLess(median, 1)
@@ -0,0 +1,177 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Index benchmark for the Order filters
+
+Seeds BENCHMARK_ORDERS orders and shows the query plan and the latency of
+each filter used by Order.find_by_filters
+"""
+
+import logging
+import os
+import time
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+from service.models import Order, OrderStatus, db
+from tests.factories import ItemFactory, OrderFactory
+from tests.test_base import TestBase
+
+BENCHMARK_ORDERS = int(os.getenv("BENCHMARK_ORDERS", "2000"))
+RARE_PRODUCT = "limited edition"
+
+logger = logging.getLogger(__name__)
+
+
+######################################################################
+#        I N D E X   B E N C H M A R K   T E S T   C A S E S
+######################################################################
+class TestIndexes(TestBase):
+    """Index Benchmark Test Cases"""
+
+    def _seed(self):
+        """Bulk inserts the benchmark dataset built by the factories"""
+        orders = OrderFactory.build_batch(BENCHMARK_ORDERS, id=None)
+        for order in orders:
+            ItemFactory.build_batch(2, id=None, order=order)
+        for order in orders[::100]:
+            order.items[0].product_name = RARE_PRODUCT
+        db.session.add_all(orders)
+        db.session.commit()
+        if db.engine.dialect.name == "postgresql":
+            db.session.execute(text('ANALYZE "order", item'))
+        return orders
+
+    def _compile(self, **filters):
+        """Returns the SQL of the first page of find_by_filters"""
+        statement = Order.page_statement(limit=100, **filters)
+        return str(
+            statement.compile(
+                dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}
+            )
+        )
+
+    def _plan(self, sql):
+        """Returns the query plan of the SQL as text"""
+        if db.engine.dialect.name == "postgresql":
+            rows = db.session.execute(text(f"EXPLAIN {sql}")).all()
+            return "\n".join(row[0] for row in rows)
+        rows = db.session.execute(text(f"EXPLAIN QUERY PLAN {sql}")).all()
+        return "\n".join(row[-1] for row in rows)
+
+    def _latency(self, sql, indexes=True):
+        """Returns the best of five run times of the SQL in milliseconds"""
+        if not indexes:
+            db.session.execute(text("SET LOCAL enable_indexscan = off"))
+            db.session.execute(text("SET LOCAL enable_bitmapscan = off"))
+            db.session.execute(text("SET LOCAL enable_indexonlyscan = off"))
+        timings = []
+        for _ in range(5):
+            start = time.perf_counter()
+            db.session.execute(text(sql)).all()
+            timings.append((time.perf_counter() - start) * 1000)
+        db.session.rollback()
+        return min(timings)
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+
+    def test_filter_columns_are_indexed(self):
+        """It should declare indexes for every column find_by_filters uses"""
+        inspector = inspect(db.engine)
+        order_indexes = {
+            index["name"]: index["column_names"]
+            for index in inspector.get_indexes("order")
+        }
+        item_indexes = {
+            index["name"]: index["column_names"]
+            for index in inspector.get_indexes("item")
+        }
+        self.assertEqual(order_indexes["ix_order_customer_name_id"], ["customer_name", "id"])
+        self.assertNotIn("ix_order_customer_name", order_indexes)
+        self.assertEqual(order_indexes["ix_order_updated_at_id"], ["updated_at", "id"])
+        self.assertEqual(
+            order_indexes["ix_order_status_created_at"], ["status", "created_at", "id"]
+        )
+        self.assertEqual(order_indexes["ix_order_created_at_id"], ["created_at", "id"])
+        self.assertEqual(item_indexes["ix_item_order_id_id"], ["order_id", "id"])
+        self.assertNotIn("ix_item_order_id", item_indexes)
+        self.assertEqual(item_indexes["ix_item_product_name"], ["product_name"])
+
+    def test_filter_query_plans(self):
+        """It should use an index for each filter of find_by_filters"""
+        orders = self._seed()
+        benchmarks = {
+            "customer_name": self._compile(customer_name=orders[7].customer_name),
+            "order_status": self._compile(order_status=OrderStatus.SHIPPED.value),
+            "product_name": self._compile(product_name=RARE_PRODUCT),
+        }
+        for name, sql in benchmarks.items():
+            plan = self._plan(sql)
+            logger.info("Query plan filtering by %s:\n%s", name, plan)
+            self.assertIn("INDEX", plan.upper(), f"{name} filter does not use an index")
+            if db.engine.dialect.name == "postgresql":
+                indexed = self._latency(sql)
+                scanned = self._latency(sql, indexes=False)
+                logger.info(
+                    "Filtering %d orders by %s: %.3f ms with indexes, %.3f ms without",
+                    BENCHMARK_ORDERS,
+                    name,
+                    indexed,
+                    scanned,
+                )
+
+    def test_sort_query_plans(self):
+        """It should read every sort order of the listing from an index, without sorting"""
+        orders = self._seed()
+        middle = datetime.combine(sorted(order.created_at for order in orders)[BENCHMARK_ORDERS // 2], datetime.min.time())
+        benchmarks = {sort: self._compile(sort=sort) for sort in Order.SORT_KEYS}
+        benchmarks.update({f"-{sort}": self._compile(sort=f"-{sort}") for sort in Order.SORT_KEYS})
+        benchmarks["created window"] = self._compile(created_after=middle, sort="-created_at")
+        benchmarks["updated_since"] = self._compile(updated_since=middle, sort="updated_at")
+        for name, sql in benchmarks.items():
+            plan = self._plan(sql)
+            logger.info("Query plan sorted by %s:\n%s", name, plan)
+            self.assertNotIn("TEMP B-TREE", plan.upper(), f"{name} is sorted in memory")
+            self.assertNotIn("Sort", plan, f"{name} is sorted in memory")
+
+    def test_search_query_plans(self):
+        """It should serve the substring searches with the trigram indexes"""
+        indexes = {index["name"] for index in inspect(db.engine).get_indexes("order")}
+        if "ix_order_customer_name_trgm" not in indexes:
+            self.skipTest("only PostgreSQL with pg_trgm indexes the searches")
+        orders = self._seed()
+        benchmarks = {
+            "name_contains": self._compile(name_contains=orders[7].customer_name[1:6]),
+            "product_contains": self._compile(product_contains=RARE_PRODUCT[2:10]),
+            "q": self._compile(q=orders[7].customer_name[1:6]),
+        }
+        for name, sql in benchmarks.items():
+            plan = self._plan(sql)
+            logger.info("Query plan searching by %s:\n%s", name, plan)
+            self.assertIn("INDEX", plan.upper(), f"{name} search does not use an index")
+            indexed = self._latency(sql)
+            scanned = self._latency(sql, indexes=False)
+            logger.info(
+                "Searching %d orders by %s: %.3f ms with indexes, %.3f ms without",
+                BENCHMARK_ORDERS,
+                name,
+                indexed,
+                scanned,
+            )
@@ -18,7 +18,9 @@
 Test cases for Item Model
 """
 
-from service.models import DataValidationError, Item, Order
+from decimal import Decimal
+
+from service.models import ConflictError, DataValidationError, Item, Order
 from tests.factories import ItemFactory, OrderFactory
 # Local application imports
 from tests.test_base import TestBase
@@ -87,6 +89,16 @@ class TestItem(TestBase):
         self.assertEqual(new_item.quantity, item.quantity)
         self.assertEqual(new_item.price, item.price)
 
+    def test_deserialize_quantity_and_price(self):
+        """It should only accept an integer quantity and round the price to the cent"""
+        data = {"product_name": "foo", "quantity": 3, "price": 1.005}
+        item = Item().deserialize(data)
+        self.assertEqual(repr(item.price), repr(Decimal("1.01")))
+        for quantity in (2.5, 2.0, "2", True, None):
+            self.assertRaises(DataValidationError, Item().deserialize, dict(data, quantity=quantity))
+        for price in ("cheap", None):
+            self.assertRaises(DataValidationError, Item().deserialize, dict(data, price=price))
+
     def test_item_repr(self):
         """It should return a string representation of the item"""
         item = ItemFactory()
@@ -104,3 +116,32 @@ class TestItem(TestBase):
         item = ItemFactory()
         item.id = 0  # Set to an ID that doesn't exist
         self.assertRaises(DataValidationError, item.delete)
+
+    def test_find_in_order(self):
+        """It should only find an Item in its own Order"""
+        orders = OrderFactory.create_batch(2)
+        item = ItemFactory(order=orders[0])
+        for order in orders:
+            order.create()
+        self.assertEqual(Item.find_in_order(orders[0].id, item.id), item)
+        self.assertIsNone(Item.find_in_order(orders[1].id, item.id))
+        self.assertIsNone(Item.find_in_order(orders[0].id, 0))
+
+    def test_update_item_in_order(self):
+        """It should update an Item of its Order and the totals of the Order"""
+        order = OrderFactory()
+        order.items.append(ItemFactory(quantity=2, price=10))
+        order.create()
+        item_id = order.items[0].id
+        changes = {"product_name": "bar", "quantity": 3, "price": 10}
+        data = Order.update_item(order.id, item_id, changes)
+        self.assertEqual((data["product_name"], data["quantity"], data["version"]), ("bar", 3, 2))
+        self.assertEqual(Item.etag_of(data), Item.find(item_id).etag)
+        self.assertEqual(Order.find(order.id).total_amount, 30)
+
+        self.assertIsNone(Order.update_item(0, item_id, changes))
+        self.assertRaises(ConflictError, Order.update_item, order.id, item_id, changes, version=1)
+        self.assertRaises(DataValidationError, Order.update_item, order.id, item_id, {"quantity": 1})
+        changes["quantity"] = "many"
+        self.assertRaises(DataValidationError, Order.update_item, order.id, item_id, changes)
+        self.assertEqual(Item.find(item_id).quantity, 3)
@@ -22,6 +22,7 @@ import logging
 from datetime import datetime
 
 from service.common import status
+from service.models import db
 from tests.factories import ItemFactory
 # Local application imports
 from tests.test_base import TestBase
@@ -293,3 +294,65 @@ class TestOrderService(TestBase):
             content_type="application/json",
         )
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_item_of_another_order(self):
+        """It should not read, update or delete an Item through another Order"""
+        orders = self._create_orders(2)
+        item = self.client.post(f"{BASE_URL}/{orders[0].id}/items", json=ItemFactory().serialize()).get_json()
+        url = f"{BASE_URL}/{orders[1].id}/items/{item['id']}"
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.client.put(url, json=item)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.client.delete(url)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+        resp = self.client.get(f"{BASE_URL}/{orders[0].id}/items/{item['id']}")
+        self.assertEqual(resp.get_json(), item)
+
+    def test_add_item_query_count(self):
+        """It should add an Item without loading the others or reading it back"""
+        order = self._create_orders(1)[0]
+        url = f"{BASE_URL}/{order.id}/items"
+        self.client.post(url, json=ItemFactory().serialize())
+        db.session.remove()
+        with self._count_queries() as statements:
+            resp = self.client.post(url, json=ItemFactory().serialize())
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        # the Order, the UPDATE of its totals, the INSERT and their changes
+        self.assertEqual(
+            [statement.split()[0].upper() for statement in statements], ["SELECT", "UPDATE", "INSERT", "INSERT"]
+        )
+        self.assertEqual(self.client.get(resp.headers["Location"]).get_json(), resp.get_json())
+        self.assertEqual(self.client.get(f"{BASE_URL}/{order.id}").get_json()["item_count"], 2)
+
+    def test_update_item_query_count(self):
+        """It should update an Item and the totals of its Order without reading them"""
+        order = self._create_orders(1)[0]
+        item = self.client.post(f"{BASE_URL}/{order.id}/items", json=ItemFactory(quantity=1).serialize()).get_json()
+        url = f"{BASE_URL}/{order.id}/items/{item['id']}"
+        item["quantity"] = 2
+        with self._count_queries() as statements:
+            resp = self.client.put(url, json=item)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([statement.split()[0].upper() for statement in statements], ["UPDATE", "UPDATE", "INSERT"])
+        self.assertIn("order", statements[0].split()[1])
+        updated = resp.get_json()
+        self.assertEqual(updated["version"], item["version"] + 1)
+        self.assertEqual(self.client.get(url).headers["ETag"], resp.headers["ETag"])
+
+        order_data = self.client.get(f"{BASE_URL}/{order.id}").get_json()
+        self.assertEqual(float(order_data["total_amount"]), 2 * float(item["price"]))
+
+        # an Item that is not there is found out by the first UPDATE
+        with self._count_queries() as statements:
+            resp = self.client.put(f"{BASE_URL}/{order.id}/items/0", json=ItemFactory().serialize())
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(len(statements), 1)
+
+        # a stale version is a conflict
+        resp = self.client.put(url, json=item)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
+        resp = self.client.put(url, json={**item, "version": "2"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
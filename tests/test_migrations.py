@@ -0,0 +1,185 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the schema migrations and the health checks
+"""
+
+from datetime import datetime, timezone
+from decimal import Decimal
+from unittest.mock import patch
+
+from sqlalchemy import delete, insert, inspect, select, text
+from sqlalchemy.exc import OperationalError
+
+from service.common import status
+from service.models import Item, Order, db, migrations
+from service.models.migrations import schema_version
+from tests.test_base import TestBase
+
+
+######################################################################
+#  M I G R A T I O N   T E S T   C A S E S
+######################################################################
+class TestMigrations(TestBase):
+    """Schema Migration Tests"""
+
+    def tearDown(self):
+        super().tearDown()
+        migrations.upgrade(db.engine)
+
+    def _drop_all(self):
+        """Drops every table, as in a new database"""
+        db.session.remove()
+        db.drop_all()
+
+    def _version(self):
+        with db.engine.connect() as connection:
+            return migrations.current_version(connection)
+
+    def _assert_schema_of_models(self):
+        """Asserts the database has the columns and indexes of the models"""
+        # the SQLite PRAGMAs of a pooled connection can read a stale schema
+        db.engine.dispose()
+        inspector = inspect(db.engine)
+        for table in db.metadata.sorted_tables:
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            self.assertEqual(columns, set(table.columns.keys()), table.name)
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)} - set(migrations.POSTGRESQL_INDEXES)
+            self.assertEqual(indexes, {index.name for index in table.indexes}, table.name)
+
+    def test_upgrade_new_database(self):
+        """It should create the schema of the models in a new database"""
+        self._drop_all()
+        self.assertEqual(self._version(), 0)
+        applied = migrations.upgrade(db.engine)
+        self.assertEqual([migration.version for migration in applied], list(range(1, migrations.HEAD + 1)))
+        self.assertEqual(self._version(), migrations.HEAD)
+        self._assert_schema_of_models()
+        self.assertEqual(migrations.upgrade(db.engine), [])
+
+    def test_upgrade_created_database(self):
+        """It should adopt a database created from the models"""
+        self._drop_all()
+        db.create_all()
+        self.assertEqual(len(migrations.upgrade(db.engine)), migrations.HEAD)
+        self._assert_schema_of_models()
+
+    def test_upgrade_backfills_totals(self):
+        """It should compute the totals of the existing orders"""
+        self._drop_all()
+        now = datetime.now(timezone.utc)
+        with db.engine.begin() as connection:
+            schema_version.create(connection)
+            for migration in migrations.MIGRATIONS[:2]:
+                migration.apply(connection)
+                connection.execute(
+                    insert(schema_version).values(
+                        version=migration.version, description=migration.description, applied_at=now
+                    )
+                )
+            order = migrations._order_table(
+                *(db.Column(name) for name in ("customer_name", "status", "created_at", "updated_at"))
+            )
+            item = migrations._item_table(
+                *(db.Column(name) for name in ("order_id", "product_name", "quantity", "price", "created_at", "updated_at"))
+            )
+            timestamps = {"created_at": now, "updated_at": now}
+            connection.execute(insert(order).values(id=1, customer_name="Ann", status="CREATED", **timestamps))
+            connection.execute(insert(order).values(id=2, customer_name="Bob", status="CREATED", **timestamps))
+            for quantity, price in [(2, 10), (1, 5)]:
+                connection.execute(
+                    insert(item).values(order_id=1, product_name="foo", quantity=quantity, price=price, **timestamps)
+                )
+        self.assertEqual(self._version(), 2)
+
+        applied = migrations.upgrade(db.engine)
+        self.assertEqual([migration.version for migration in applied], list(range(3, migrations.HEAD + 1)))
+        totals = db.session.execute(select(Order.id, Order.total_amount, Order.item_count).order_by(Order.id)).all()
+        self.assertEqual([tuple(row) for row in totals], [(1, Decimal("25.00"), 2), (2, Decimal("0"), 0)])
+        db.session.execute(delete(Item))
+        db.session.execute(delete(Order))
+        db.session.commit()
+
+    def test_search_indexes(self):
+        """It should index the searched names by trigrams only where pg_trgm is available"""
+        postgresql = db.engine.dialect.name == "postgresql"
+        trgm = postgresql and db.session.execute(
+            text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        ).first() is not None
+        db.session.commit()
+        if postgresql and not trgm:
+            with self.assertLogs("flask.app", level="WARNING") as logs, db.engine.begin() as connection:
+                migrations.create_search_indexes(connection)
+            self.assertIn("pg_trgm is not available", logs.output[0])
+        else:
+            with db.engine.begin() as connection:
+                migrations.create_search_indexes(connection)
+        db.engine.dispose()
+        inspector = inspect(db.engine)
+        indexes = {index["name"] for table in ("order", "item") for index in inspector.get_indexes(table)}
+        self.assertEqual(indexes & set(migrations.SEARCH_INDEXES), set(migrations.SEARCH_INDEXES) if trgm else set())
+
+    def test_verify(self):
+        """It should fail when the schema is behind the code"""
+        self.assertEqual(migrations.verify(db.engine), migrations.HEAD)
+        db.session.execute(delete(schema_version).where(schema_version.c.version == migrations.HEAD))
+        db.session.commit()
+        try:
+            with self.assertRaisesRegex(migrations.SchemaVersionError, "run flask db-upgrade"):
+                migrations.verify(db.engine)
+        finally:
+            migrations.upgrade(db.engine)
+
+
+######################################################################
+#  H E A L T H   T E S T   C A S E S
+######################################################################
+class TestHealth(TestBase):
+    """Liveness and Readiness Tests"""
+
+    def test_liveness(self):
+        """It should answer the liveness probe without the database"""
+        with self._count_queries() as statements:
+            resp = self.client.get("/health/live")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"status": "OK"})
+        self.assertEqual(statements, [])
+
+    def test_readiness(self):
+        """It should be ready when the schema is at the version of the code"""
+        resp = self.client.get("/health/ready")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"status": "OK", "schema_version": migrations.HEAD})
+
+    def test_not_ready_behind(self):
+        """It should not be ready while the migrations are not applied"""
+        db.session.execute(delete(schema_version).where(schema_version.c.version == migrations.HEAD))
+        db.session.commit()
+        try:
+            resp = self.client.get("/health/ready")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertIn("is behind", resp.get_json()["error"])
+        finally:
+            migrations.upgrade(db.engine)
+
+    def test_not_ready_unreachable(self):
+        """It should not be ready when the database cannot be reached"""
+        error = OperationalError("SELECT 1", {}, Exception("connection refused"))
+        with patch.object(type(db.engine), "connect", side_effect=error):
+            resp = self.client.get("/health/ready")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(resp.get_json()["error"], "database unreachable")
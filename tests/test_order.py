@@ -18,9 +18,12 @@
 Test cases for Order Model
 """
 
+from decimal import Decimal
 from unittest.mock import patch
 
-from service.models import DataValidationError, Item, Order, OrderStatus
+from sqlalchemy import inspect
+
+from service.models import ConflictError, DataValidationError, Item, Order, OrderStatus, db, keeping_values
 from tests.factories import ItemFactory, OrderFactory
 from tests.test_base import TestBase
 
@@ -118,6 +121,19 @@ class TestOrder(TestBase):
         orders = Order.all()
         self.assertEqual(len(orders), 1)
 
+    def test_add_order_serialized_as_stored(self):
+        """It should serialize a created Order like the Order loaded again"""
+        order = Order(customer_name="Jane Doe")
+        with keeping_values():
+            order.create()
+            self.assertFalse(inspect(order).expired_attributes)
+            created = order.serialize()
+        # Decimal(0) == 0, only the text tells the scale apart
+        self.assertEqual(repr(created["total_amount"]), repr(Decimal("0.00")))
+        # the values are only kept in the block
+        self.assertIn("total_amount", inspect(order).expired_attributes)
+        self.assertEqual(order.serialize(), created)
+
     @patch("service.models.db.session.commit")
     def test_add_order_failed(self, exception_mock):
         """It should not create an Order on database error"""
@@ -273,3 +289,79 @@ class TestOrder(TestBase):
 
         orders = Order.find_by_filters(product_name="IMPOSSIBLE PRODUCT")
         self.assertEqual(len(orders), 0)
+
+    def test_find_by_filters_loads_items_in_batch(self):
+        """It should load the Items of all found Orders with a constant number of queries"""
+
+        def create_orders(count):
+            for _ in range(count):
+                order = OrderFactory()
+                order.items.append(ItemFactory())
+                order.items.append(ItemFactory())
+                order.create()
+
+        def count_queries(finder):
+            db.session.expire_all()
+            with self._count_queries() as statements:
+                orders = finder()
+                serialized = [order.serialize() for order in orders]
+            return len(statements), serialized
+
+        create_orders(2)
+        few_queries, few_orders = count_queries(Order.find_by_filters)
+        self.assertEqual(len(few_orders), 2)
+        create_orders(8)
+        many_queries, many_orders = count_queries(Order.find_by_filters)
+        self.assertEqual(len(many_orders), 10)
+        for order in many_orders:
+            self.assertEqual(len(order["items"]), 2)
+        self.assertEqual(few_queries, many_queries)
+        self.assertLessEqual(many_queries, 2)
+
+        all_queries, all_orders = count_queries(Order.all)
+        self.assertEqual(len(all_orders), 10)
+        self.assertEqual(all_queries, many_queries)
+
+    def test_status_sources(self):
+        """It should list the statuses an Order may change from"""
+        # any status but CANCELLED may change to any other one
+        self.assertEqual(
+            OrderStatus.CREATED.sources(),
+            [OrderStatus.IN_PROGRESS, OrderStatus.SHIPPED, OrderStatus.COMPLETED],
+        )
+        self.assertEqual(
+            OrderStatus.CANCELLED.sources(),
+            [OrderStatus.CREATED, OrderStatus.IN_PROGRESS, OrderStatus.SHIPPED, OrderStatus.COMPLETED],
+        )
+
+    def test_transition(self):
+        """It should change the status of an Order only when it is allowed"""
+        order = OrderFactory(status=OrderStatus.CREATED)
+        order.create()
+        data = Order.transition(order.id, OrderStatus.SHIPPED)
+        self.assertEqual(data["status"], "SHIPPED")
+        self.assertEqual(data["version"], 2)
+        self.assertEqual(len(data["items"]), len(order.items))
+        # the same status again changes nothing, unless the version is stale
+        self.assertEqual(Order.transition(order.id, OrderStatus.SHIPPED)["version"], 2)
+        self.assertRaises(ConflictError, Order.transition, order.id, OrderStatus.SHIPPED, 1)
+        self.assertEqual(Order.transition(order.id, OrderStatus.CANCELLED)["version"], 3)
+        # a cancelled Order is final, even to the status it has
+        self.assertRaises(DataValidationError, Order.transition, order.id, OrderStatus.CREATED)
+        self.assertRaises(DataValidationError, Order.transition, order.id, OrderStatus.CANCELLED)
+        self.assertIsNone(Order.transition(0, OrderStatus.CANCELLED))
+        self.assertEqual(Order.find(order.id).status, OrderStatus.CANCELLED)
+
+    def test_bulk_transition(self):
+        """It should change the status of the Orders allowed to change"""
+        orders = [OrderFactory(status=status) for status in OrderStatus]
+        for order in orders:
+            order.create()
+        ids = [order.id for order in orders]
+        changed = Order.bulk_transition(ids, OrderStatus.CREATED)
+        # all but the CREATED Order, which has the status, and the CANCELLED one
+        self.assertEqual(changed, sorted(ids[1:4]))
+        db.session.expire_all()
+        statuses = [Order.find(order_id).status for order_id in ids]
+        self.assertEqual(statuses, [OrderStatus.CREATED] * 4 + [OrderStatus.CANCELLED])
+        self.assertEqual(Order.bulk_transition([], OrderStatus.CANCELLED), [])
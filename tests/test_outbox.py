@@ -0,0 +1,184 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the outbox of the Order events and its dispatcher
+"""
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from flask import Flask
+from sqlalchemy import select
+
+from service.common import status
+from service.common.outbox import EventSink, FileSink, MemorySink, Outbox
+from service.models import OrderEvent, OrderStatus, db
+from tests.factories import OrderFactory
+from tests.test_base import TestBase
+
+BASE_URL = "/api/orders"
+
+
+######################################################################
+#  S I N K   T E S T   C A S E S
+######################################################################
+class TestSinks(TestCase):
+    """Event Sink Tests"""
+
+    def test_memory_sink(self):
+        """It should keep the delivered events in order"""
+        sink = MemorySink()
+        sink.send([{"id": 1}, {"id": 2}])
+        sink.send([{"id": 3}])
+        self.assertEqual([event["id"] for event in sink.events], [1, 2, 3])
+        sink.clear()
+        self.assertEqual(len(sink), 0)
+
+    def test_file_sink(self):
+        """It should append the events to a file as newline delimited JSON"""
+        with tempfile.TemporaryDirectory() as directory:
+            sink = FileSink(os.path.join(directory, "events.ndjson"))
+            sink.send([{"id": 1}, {"id": 2}])
+            sink.send([{"id": 3}])
+            with open(sink.path, encoding="utf-8") as file:
+                self.assertEqual([json.loads(line)["id"] for line in file], [1, 2, 3])
+
+    def test_init_app(self):
+        """It should create the sink selected by the configuration"""
+        app = Flask(__name__)
+        outbox = Outbox()
+        app.config.update(OUTBOX_SINK="file", OUTBOX_FILE="/tmp/events.ndjson", OUTBOX_BATCH_SIZE=7)
+        outbox.init_app(app)
+        self.assertIsInstance(outbox.sink, FileSink)
+        self.assertEqual((outbox.sink.path, outbox.batch_size), ("/tmp/events.ndjson", 7))
+        app.config["OUTBOX_SINK"] = "memory"
+        outbox.init_app(app)
+        self.assertIsInstance(outbox.sink, MemorySink)
+        app.config["OUTBOX_SINK"] = "kafka"
+        self.assertRaises(ValueError, outbox.init_app, app)
+
+
+######################################################################
+#  O U T B O X   T E S T   C A S E S
+######################################################################
+class TestOutbox(TestBase):
+    """Outbox Tests"""
+
+    def setUp(self):
+        super().setUp()
+        self.outbox = Outbox(MemorySink(), batch_size=2, poll_interval=0)
+
+    def _events(self):
+        """Returns the (event_type, order_id, status) of the events in the outbox"""
+        db.session.commit()
+        events = db.session.scalars(select(OrderEvent).order_by(OrderEvent.id))
+        return [(event.event_type, event.order_id, event.payload.get("status")) for event in events]
+
+    def test_events_of_mutations(self):
+        """It should write an event in the transaction of each change of an Order"""
+        order = self._create_orders(1, status=OrderStatus.CREATED)[0]
+        other = self._create_orders(1, status=OrderStatus.CREATED)[0]
+        url = f"{BASE_URL}/{order.id}"
+        self.client.put(f"{url}/status", json={"status": "IN_PROGRESS"})
+        self.client.put(f"{BASE_URL}/{other.id}/cancel")
+        # only the Order that may be shipped changes
+        self.client.put(f"{BASE_URL}/status", json={"status": "SHIPPED", "ids": [order.id, other.id]})
+        self.client.delete(url)
+        self.assertEqual(
+            self._events(),
+            [
+                (OrderEvent.CREATED, order.id, "CREATED"),
+                (OrderEvent.CREATED, other.id, "CREATED"),
+                (OrderEvent.STATUS_CHANGED, order.id, "IN_PROGRESS"),
+                (OrderEvent.STATUS_CHANGED, other.id, "CANCELLED"),
+                (OrderEvent.STATUS_CHANGED, order.id, "SHIPPED"),
+                (OrderEvent.DELETED, order.id, None),
+            ],
+        )
+        event = db.session.scalars(select(OrderEvent).where(OrderEvent.order_id == other.id)).first()
+        self.assertEqual(
+            event.payload, {"id": other.id, "customer_name": other.customer_name, "status": "CREATED", "version": 1}
+        )
+
+    def test_no_event_without_change(self):
+        """It should not write an event when nothing changed"""
+        order = self._create_orders(1, status=OrderStatus.CANCELLED)[0]
+        resp = self.client.put(f"{BASE_URL}/{order.id}/status", json={"status": "SHIPPED"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.put(f"{BASE_URL}/{order.id}/cancel")
+        data = self.client.get(f"{BASE_URL}/{order.id}").get_json()
+        del data["items"]
+        data["customer_name"] = "Renamed"
+        self.client.put(f"{BASE_URL}/{order.id}", json=data)
+        self.assertEqual(self._events(), [(OrderEvent.CREATED, order.id, "CANCELLED")])
+
+    def test_dispatch(self):
+        """It should deliver the events in batches and remove them from the outbox"""
+        orders = self._create_orders(5)
+        with self._count_queries() as statements:
+            self.assertEqual(self.outbox.dispatch(), 2)
+        # the locked batch and its DELETE, whatever the size of the batch
+        self.assertEqual([statement.split()[0].upper() for statement in statements], ["SELECT", "DELETE"])
+        if db.engine.dialect.name == "postgresql":
+            self.assertIn("SKIP LOCKED", statements[0].upper())
+        self.assertEqual(self.outbox.drain(), 3)
+        self.assertEqual(self.outbox.dispatch(), 0)
+        self.assertEqual([event["order_id"] for event in self.outbox.sink.events], [order.id for order in orders])
+        self.assertEqual(self._events(), [])
+
+    def test_dispatch_failure(self):
+        """It should keep the events of a failed delivery for the next one"""
+        self._create_orders(3)
+        # a sink whose transport is down
+        self.outbox.sink = Mock(spec=EventSink, **{"send.side_effect": ConnectionError("broker unreachable")})
+        self.assertRaises(ConnectionError, self.outbox.dispatch)
+        self.assertEqual(len(self._events()), 3)
+        with self.assertLogs("flask.app", level="ERROR") as logs:
+            self.outbox.run(should_stop=iter([False, True]).__next__)
+        self.assertIn("broker unreachable", logs.output[0])
+
+        self.outbox.sink = MemorySink()
+        self.outbox.run(should_stop=iter([False, True]).__next__)
+        self.assertEqual(len(self.outbox.sink), 3)
+        self.assertEqual(self._events(), [])
+
+    def test_skip_locked(self):
+        """It should skip the events another dispatcher is delivering"""
+        if db.engine.dialect.name != "postgresql":
+            self.skipTest("SQLite has no row locks")
+        self._create_orders(4)
+        with db.engine.connect() as connection:
+            # another dispatcher holds the first batch
+            held = connection.execute(
+                select(OrderEvent.id).order_by(OrderEvent.id).limit(2).with_for_update(skip_locked=True)
+            ).scalars().all()
+            self.assertEqual(self.outbox.drain(), 2)
+            connection.rollback()
+        delivered = [event["id"] for event in self.outbox.sink.events]
+        self.assertFalse(set(held) & set(delivered))
+        self.assertEqual(self.outbox.drain(), 2)
+
+    @patch("service.models.order_event.OrderEvent.record")
+    def test_event_in_transaction(self, record_mock):
+        """It should not create an Order whose event cannot be written"""
+        record_mock.side_effect = RuntimeError("outbox unavailable")
+        resp = self.client.post(BASE_URL, json=OrderFactory().serialize())
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(BASE_URL).get_json(), [])
@@ -18,12 +18,20 @@
 TestOrder API Service Test Suite
 """
 
+import base64
+import json
 import logging
+from datetime import datetime
+from urllib.parse import parse_qs, urlparse
+
+from sqlalchemy import update
 
 from service.common import status
-from service.models import OrderStatus
+from service.common.pagination import encode_cursor
+from service.models import Order, OrderStatus, db
 from tests.factories import ItemFactory, OrderFactory
 from tests.test_base import TestBase
+from wsgi import app
 
 BASE_URL = "/api/orders"
 
@@ -33,6 +41,7 @@ BASE_URL = "/api/orders"
 ######################################################################
 
 
+# pylint: disable=too-many-public-methods
 class TestOrderService(TestBase):
     """REST API Server Tests"""
 
@@ -59,6 +68,34 @@ class TestOrderService(TestBase):
                 data = resp.get_json()
                 self.assertEqual(data["status"], new_status.upper())
 
+    def test_update_order_status_query_count(self):
+        """It should change the status of an Order with one conditional UPDATE"""
+        order = self._create_orders(1, status=OrderStatus.CREATED)[0]
+        with self._count_queries() as statements:
+            resp = self.client.put(f"{BASE_URL}/{order.id}/status", json={"status": "IN_PROGRESS"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()["items"]), len(order.items))
+        # the UPDATE, the items of the response, and the INSERTs of the change and of the event
+        self.assertEqual([statement.split()[0].upper() for statement in statements], ["UPDATE", "SELECT", "INSERT", "INSERT"])
+
+    def test_update_order_status_version(self):
+        """It should only change the status of the version that was read"""
+        order = self._create_orders(1, status=OrderStatus.CREATED)[0]
+        url = f"{BASE_URL}/{order.id}/status"
+        resp = self.client.put(url, json={"status": "IN_PROGRESS", "version": 1})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["version"], 2)
+        resp = self.client.put(url, json={"status": "SHIPPED", "version": 1})
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.client.put(url, json={"status": "SHIPPED", "version": "2"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        # changing to the current status is idempotent, but not from a stale version
+        resp = self.client.put(url, json={"status": "IN_PROGRESS", "version": 2})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["version"], 2)
+        resp = self.client.put(url, json={"status": "IN_PROGRESS", "version": 1})
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
     def test_update_order_idempotent(self):
         """It should be idempotent when updating to same status"""
         order = None
@@ -101,6 +138,31 @@ class TestOrderService(TestBase):
         )
         self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_update_cancelled_order_same_status(self):
+        """It should not change a cancelled Order even to CANCELLED, but cancel it again"""
+        order = self._create_orders(1, status=OrderStatus.CANCELLED)[0]
+        resp = self.client.put(f"{BASE_URL}/{order.id}/status", json={"status": "CANCELLED"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.put(f"{BASE_URL}/{order.id}/cancel")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["status"], "CANCELLED")
+
+    def test_update_order_status_statements(self):
+        """It should change a status with one UPDATE and read the items it returns"""
+        order = self._create_orders(1, status=OrderStatus.CREATED)[0]
+        self.client.post(f"{BASE_URL}/{order.id}/items", json=ItemFactory().serialize())
+        db.session.remove()
+        with self._count_queries() as statements:
+            resp = self.client.put(f"{BASE_URL}/{order.id}/status", json={"status": "SHIPPED"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()["items"]), 1)
+        # the UPDATE ... RETURNING of the Order, then the SELECT of its items
+        # for the response, before the change log and outbox INSERTs
+        self.assertEqual([statement.split()[0].upper() for statement in statements][:2], ["UPDATE", "SELECT"])
+        self.assertIn("RETURNING", statements[0].upper())
+        self.assertIn("FROM item", statements[1])
+        self.assertEqual(len(statements), 4)
+
     def test_update_order_status_invalid(self):
         """It should not update status with invalid value"""
         order = self._create_orders(1)[0]
@@ -220,3 +282,318 @@ class TestOrderService(TestBase):
         test_order["status"] = "INVALID_STATUS"  # invalid status
         response = self.client.post(BASE_URL, json=test_order)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    # ----------------------------------------------------------
+    # TEST PAGINATION
+    # ----------------------------------------------------------
+    def _next_cursor(self, response):
+        """Returns the cursor of the next page from the Link header"""
+        link = response.headers.get("Link")
+        if not link:
+            return None
+        self.assertTrue(link.endswith('>; rel="next"'))
+        query = parse_qs(urlparse(link[1:link.index(">")]).query)
+        return query["cursor"][0]
+
+    def test_list_orders_paginated(self):
+        """It should page through Orders with a cursor"""
+        orders = self._create_orders(5)
+        seen = []
+        pages = []
+        query_string = "limit=2"
+        while True:
+            response = self.client.get(BASE_URL, query_string=query_string)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            data = response.get_json()
+            pages.append(len(data))
+            seen.extend(order["id"] for order in data)
+            cursor = self._next_cursor(response)
+            if not cursor:
+                break
+            query_string = f"limit=2&cursor={cursor}"
+        self.assertEqual(pages, [2, 2, 1])
+        self.assertEqual(sorted(seen), sorted(order.id for order in orders))
+        self.assertEqual(len(set(seen)), len(orders))
+
+    def test_list_orders_paginated_with_filter(self):
+        """It should keep the filters in the cursor link of the next page"""
+        orders = self._create_orders(6)
+        name = orders[0].customer_name
+        for order in orders[1:3]:
+            resp = self.client.put(
+                f"{BASE_URL}/{order.id}",
+                json={"customer_name": name, "status": order.status.value},
+            )
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        response = self.client.get(BASE_URL, query_string=f"name={name}&limit=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), 2)
+        self.assertIn("name=", response.headers["Link"])
+        response = self.client.get(
+            BASE_URL,
+            query_string={"name": name, "limit": 2, "cursor": self._next_cursor(response)},
+        )
+        data = response.get_json()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["customer_name"], name)
+        self.assertIsNone(self._next_cursor(response))
+
+    def test_list_orders_default_page_size(self):
+        """It should bound the page size when no limit is given"""
+        self._create_orders(4)
+        default_size = app.config["DEFAULT_PAGE_SIZE"]
+        max_size = app.config["MAX_PAGE_SIZE"]
+        app.config["DEFAULT_PAGE_SIZE"] = 3
+        app.config["MAX_PAGE_SIZE"] = 2
+        try:
+            response = self.client.get(BASE_URL)
+            self.assertEqual(len(response.get_json()), 2)
+            app.config["MAX_PAGE_SIZE"] = max_size
+            response = self.client.get(BASE_URL)
+            self.assertEqual(len(response.get_json()), 3)
+            self.assertIsNotNone(self._next_cursor(response))
+        finally:
+            app.config["DEFAULT_PAGE_SIZE"] = default_size
+            app.config["MAX_PAGE_SIZE"] = max_size
+
+    def test_list_orders_bad_pagination(self):
+        """It should not List Orders with a bad limit or cursor"""
+        response = self.client.get(BASE_URL, query_string="limit=0")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string="limit=abc")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string="cursor=not-a-cursor!")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        cursor = base64.urlsafe_b64encode(b'{"id": 1}').decode()
+        response = self.client.get(BASE_URL, query_string=f"cursor={cursor}")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        cursor = encode_cursor("yesterday", 1)
+        response = self.client.get(BASE_URL, query_string=f"cursor={cursor}")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_orders_by_time_window(self):
+        """It should List the Orders created or updated in a time window"""
+        orders = self._create_orders(3)
+        for day, order in enumerate(orders, start=1):
+            db.session.execute(
+                update(Order)
+                .where(Order.id == order.id)
+                .values(created_at=datetime(2024, 1, day), updated_at=datetime(2024, 2, day))
+            )
+        db.session.commit()
+
+        def ids(**args):
+            response = self.client.get(BASE_URL, query_string=args)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return [order["id"] for order in response.get_json()]
+
+        self.assertEqual(ids(created_after="2024-01-02T00:00:00"), [orders[1].id, orders[2].id])
+        self.assertEqual(ids(created_before="2024-01-02T00:00:00"), [orders[0].id])
+        window = {"created_after": "2024-01-01T12:00:00+00:00", "created_before": "2024-01-03T00:00:00Z"}
+        self.assertEqual(ids(**window), [orders[1].id])
+        self.assertEqual(ids(updated_since="2024-02-02T00:00:00", sort="-updated_at"), [orders[2].id, orders[1].id])
+        response = self.client.get(BASE_URL, query_string={"updated_since": "yesterday"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_orders_sorted(self):
+        """It should page through the Orders in each sort order"""
+        orders = self._create_orders(5)
+        for sort in ("customer_name", "-customer_name", "updated_at", "-updated_at"):
+            seen = []
+            query_string = {"sort": sort, "limit": 2}
+            while True:
+                response = self.client.get(BASE_URL, query_string=query_string)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                seen.extend(response.get_json())
+                query_string["cursor"] = self._next_cursor(response)
+                if not query_string["cursor"]:
+                    break
+            self.assertEqual(len(seen), len(orders))
+            if sort.lstrip("-") == "customer_name":
+                keys = [(order["customer_name"], order["id"]) for order in seen]
+            else:
+                # the orders were created, and last updated, in id order
+                keys = [order["id"] for order in seen]
+            self.assertEqual(keys, sorted(keys, reverse=sort.startswith("-")), sort)
+
+    # ----------------------------------------------------------
+    # TEST SEARCH
+    # ----------------------------------------------------------
+    def _create_named_orders(self, *names, product_name="widget"):
+        """Creates an Order with an Item of the product for each customer name"""
+        orders = []
+        for name in names:
+            order = OrderFactory(customer_name=name).serialize()
+            order["items"] = [ItemFactory(product_name=product_name).serialize()]
+            resp = self.client.post(BASE_URL, json=order)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            orders.append(resp.get_json())
+        return orders
+
+    def test_search_orders(self):
+        """It should search the names of the customers and products, ignoring case"""
+        self._create_named_orders("Joanna Smith", "ANN", "Bob")
+        self._create_named_orders("Carl", product_name="Annatto seeds")
+
+        def search(**args):
+            response = self.client.get(BASE_URL, query_string=args)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return [order["customer_name"] for order in response.get_json()]
+
+        self.assertEqual(sorted(search(name_contains="ann")), ["ANN", "Joanna Smith"])
+        self.assertEqual(search(name_contains="SMITH"), ["Joanna Smith"])
+        self.assertEqual(search(product_contains="NATTO"), ["Carl"])
+        self.assertEqual(search(product_contains="dget", name_contains="b"), ["Bob"])
+        # the wildcards of LIKE are searched for as they are
+        self.assertEqual(search(name_contains="%"), [])
+        self.assertEqual(search(name_contains="_"), [])
+        # q ranks the exact customer name, then the ones containing it, then the products
+        self.assertEqual(search(q="ann"), ["ANN", "Joanna Smith", "Carl"])
+
+    def test_search_orders_paginated(self):
+        """It should page through the ranked results of a search"""
+        self._create_named_orders("Ann", "Annie", "Anna", "Hanna", "Joanna", "Bob")
+        self._create_named_orders("Carl", "Dave", product_name="Annatto")
+        expected = self.client.get(BASE_URL, query_string={"q": "ann", "sort": "-created_at"}).get_json()
+        self.assertEqual(len(expected), 7)
+        seen = []
+        query_string = {"q": "ann", "sort": "-created_at", "limit": 2}
+        while True:
+            response = self.client.get(BASE_URL, query_string=query_string)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(response.get_json())
+            cursor = self._next_cursor(response)
+            if not cursor:
+                break
+            query_string["cursor"] = cursor
+        self.assertEqual(seen, expected)
+        names = [order["customer_name"] for order in seen]
+        self.assertEqual(names[0], "Ann")
+        self.assertEqual(names[1:3], ["Anna", "Annie"])
+        self.assertEqual(sorted(names[5:]), ["Carl", "Dave"])
+
+        cursor = encode_cursor("2024-01-01T00:00:00", 1)
+        response = self.client.get(BASE_URL, query_string={"q": "ann", "cursor": cursor})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_orders_by_search(self):
+        """It should stream only the Orders matching a search"""
+        self._create_named_orders("Ann", "Bob")
+        response = self.client.get(f"{BASE_URL}/export", query_string="name_contains=AN")
+        exported = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([order["customer_name"] for order in exported], ["Ann"])
+
+    # ----------------------------------------------------------
+    # TEST EXPORT
+    # ----------------------------------------------------------
+    def test_export_orders(self):
+        """It should stream all Orders as newline delimited JSON"""
+        orders = self._create_orders(5)
+        item = ItemFactory()
+        resp = self.client.post(f"{BASE_URL}/{orders[0].id}/items", json=item.serialize())
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        batch_size = app.config["EXPORT_BATCH_SIZE"]
+        app.config["EXPORT_BATCH_SIZE"] = 2
+        try:
+            response = self.client.get(
+                f"{BASE_URL}/export", headers={"Accept": "application/x-ndjson"}
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.is_streamed)
+            self.assertEqual(response.mimetype, "application/x-ndjson")
+            lines = response.get_data(as_text=True).splitlines()
+        finally:
+            app.config["EXPORT_BATCH_SIZE"] = batch_size
+        exported = [json.loads(line) for line in lines]
+        self.assertEqual([order["id"] for order in exported], [order.id for order in orders])
+        self.assertEqual(exported[0]["items"][0]["product_name"], item.product_name)
+        for order in exported[1:]:
+            self.assertEqual(order["items"], [])
+
+    def test_export_orders_by_filter(self):
+        """It should stream only the Orders matching the filters"""
+        orders = self._create_orders(5)
+        name = orders[2].customer_name
+        response = self.client.get(f"{BASE_URL}/export", query_string=f"name={name}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        exported = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(exported), len([o for o in orders if o.customer_name == name]))
+        for order in exported:
+            self.assertEqual(order["customer_name"], name)
+
+    def test_export_orders_not_acceptable(self):
+        """It should not export Orders to a client that does not accept NDJSON"""
+        response = self.client.get(f"{BASE_URL}/export", headers={"Accept": "text/html"})
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+
+    # ----------------------------------------------------------
+    # TEST PROJECTIONS
+    # ----------------------------------------------------------
+    def test_list_orders_projection(self):
+        """It should only return and load the fields asked for"""
+        orders = self._create_orders(3)
+        self.client.post(f"{BASE_URL}/{orders[0].id}/items", json=ItemFactory().serialize())
+        with self._count_queries() as statements:
+            response = self.client.get(BASE_URL, query_string="fields=status")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.get_json(),
+            [{"id": order.id, "status": order.status.value} for order in orders],
+        )
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn("customer_name", statements[0])
+        self.assertNotIn("FROM item", statements[0])
+
+        response = self.client.get(BASE_URL, query_string="fields=customer_name, items")
+        data = response.get_json()
+        self.assertEqual(set(data[0]), {"id", "customer_name", "items"})
+        self.assertEqual(len(data[0]["items"]), 1)
+
+    def test_list_orders_projection_paginated(self):
+        """It should page through a projection"""
+        orders = self._create_orders(3)
+        response = self.client.get(BASE_URL, query_string="fields=id&limit=2")
+        self.assertEqual(response.get_json(), [{"id": order.id} for order in orders[:2]])
+        response = self.client.get(
+            BASE_URL, query_string={"fields": "id", "cursor": self._next_cursor(response)}
+        )
+        self.assertEqual(response.get_json(), [{"id": orders[2].id}])
+
+    def test_get_order_projection(self):
+        """It should only return the fields of an Order asked for"""
+        order = self._create_orders(1)[0]
+        url = f"{BASE_URL}/{order.id}"
+        with self._count_queries() as statements:
+            response = self.client.get(url, query_string="fields=customer_name")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.get_json(), {"id": order.id, "customer_name": order.customer_name}
+        )
+        self.assertEqual(len(statements), 1)
+        response = self.client.get(url, query_string="fields=items,status")
+        self.assertEqual(
+            response.get_json(), {"id": order.id, "status": order.status.value, "items": []}
+        )
+        response = self.client.get(f"{BASE_URL}/0", query_string="fields=status")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_projection_unknown_field(self):
+        """It should not project fields an Order does not have"""
+        order = self._create_orders(1)[0]
+        response = self.client.get(BASE_URL, query_string="fields=status,password")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("password", response.get_json()["message"])
+        response = self.client.get(f"{BASE_URL}/{order.id}", query_string="fields=price")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_order_status(self):
+        """It should read the status of an Order with a single column query"""
+        order = self._create_orders(1)[0]
+        with self._count_queries() as statements:
+            response = self.client.get(f"{BASE_URL}/{order.id}/status")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), {"id": order.id, "status": order.status.value})
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn("customer_name", statements[0])
+        response = self.client.get(f"{BASE_URL}/0/status")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
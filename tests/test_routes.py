@@ -21,7 +21,8 @@ TestOrder API Service Test Suite
 from factory import Faker
 
 from service.common import status
-from tests.factories import OrderFactory
+from service.models import db
+from tests.factories import ItemFactory, OrderFactory
 from tests.test_base import TestBase
 
 BASE_URL = "/api/orders"
@@ -197,3 +198,71 @@ class TestOrderService(TestBase):
             f"{BASE_URL}/{test_order.id}", json={"bad_key": "bad_value"}
         )
         self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_order_list_query_count(self):
+        """It should List Orders with a constant number of queries"""
+        self._create_orders(2)
+        with self._count_queries() as statements:
+            resp = self.client.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+        few_queries = len(statements)
+
+        self._create_orders(8)
+        with self._count_queries() as statements:
+            resp = self.client.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 10)
+        self.assertEqual(len(statements), few_queries)
+
+    def test_create_order_query_count(self):
+        """It should Create an Order and answer it without reading it back"""
+        for count in (1, 5):
+            order = OrderFactory().serialize()
+            order["items"] = [ItemFactory().serialize() for _ in range(count)]
+            # a request starts from an empty session
+            db.session.remove()
+            with self._count_queries() as statements:
+                resp = self.client.post(BASE_URL, json=order)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            # only PostgreSQL batches the INSERT ... RETURNING of the items
+            # the INSERT of all their changes into the change log and of the event
+            inserts = 4 if db.engine.dialect.name == "postgresql" else 3 + count
+            self.assertEqual([statement.split()[0].upper() for statement in statements], ["INSERT"] * inserts)
+            created = resp.get_json()
+            self.assertEqual(len(created["items"]), count)
+            # the same as the Order loaded again
+            db.session.expire_all()
+            self.assertEqual(self.client.get(resp.headers["Location"]).get_json(), created)
+
+    def test_update_order_query_count(self):
+        """It should Update an Order and answer it without reading it back"""
+        order = self._create_orders(1)[0]
+        url = f"{BASE_URL}/{order.id}"
+        self.client.post(f"{url}/items", json=ItemFactory().serialize())
+        data = self.client.get(url).get_json()
+        del data["items"]
+        data["customer_name"] = "John Doe"
+        db.session.remove()
+        with self._count_queries() as statements:
+            resp = self.client.put(url, json=data)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # the Order, the UPDATE, its change and the items of the response
+        self.assertEqual(
+            [statement.split()[0].upper() for statement in statements], ["SELECT", "UPDATE", "INSERT", "SELECT"]
+        )
+        db.session.expire_all()
+        resp_get = self.client.get(url)
+        self.assertEqual(resp_get.get_json(), resp.get_json())
+        self.assertEqual(resp_get.headers["ETag"], resp.headers["ETag"])
+
+    def test_diagnostics(self):
+        """It should report the statistics of the connection pool"""
+        self._create_orders(1)
+        resp = self.client.get("/diagnostics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        pool = resp.get_json()["pool"]
+        self.assertEqual(pool["pool_class"], "InstrumentedQueuePool")
+        self.assertGreaterEqual(pool["checkouts"], 1)
+        self.assertIn("checked_out", pool)
+        self.assertIn("overflow", pool)
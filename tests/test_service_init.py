@@ -2,21 +2,69 @@
 Initializing test service
 """
 
+import logging
+import time
 from unittest.mock import patch
 
 import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 from service import create_app
+from service.models import db, migrations
+from wsgi import app
 
 
 def test_create_app_exception_handling(capfd):
     """Test if exception handling is triggered during app initialization"""
 
-    # Mock db.create_all to raise an exception
-    with patch("service.models.db.create_all", side_effect=Exception("DB Error")):
+    # Mock the schema check to raise an exception
+    with patch("service.models.migrations.verify", side_effect=Exception("DB Error")):
         with pytest.raises(SystemExit):  # Expect sys.exit(4) to be called
             create_app()
 
     # Capture stderr and check if the critical log message is present
     captured = capfd.readouterr()
     assert "DB Error: Cannot continue" in captured.err
+
+
+def test_create_app_startup_time(caplog):
+    """It should only read the schema version at startup"""
+    with app.app_context():
+        migrations.upgrade(db.engine)
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):  # pylint: disable=unused-argument
+        statements.append(statement)
+
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        start = time.perf_counter()
+        # whatever the environment of the tests sets
+        with patch("service.config.SCHEMA_AUTO_UPGRADE", False):
+            create_app()
+        elapsed = time.perf_counter() - start
+    finally:
+        event.remove(Engine, "before_cursor_execute", before_cursor_execute)
+
+    logging.getLogger(__name__).info("create_app took %.1f ms", elapsed * 1000)
+    assert len(statements) == 1
+    assert "schema_version" in statements[0]
+    assert "is behind" not in caplog.text
+
+
+def test_create_app_schema_behind(capfd):
+    """It should not start on a schema behind the code without SCHEMA_AUTO_UPGRADE"""
+    with patch("service.config.SCHEMA_AUTO_UPGRADE", False):
+        with patch("service.models.migrations.current_version", return_value=migrations.HEAD - 1):
+            with pytest.raises(SystemExit):
+                create_app()
+    assert "run flask db-upgrade: Cannot continue" in capfd.readouterr().err
+
+
+def test_create_app_auto_upgrade():
+    """It should apply the migrations at startup when SCHEMA_AUTO_UPGRADE is set"""
+    with patch("service.config.SCHEMA_AUTO_UPGRADE", True):
+        with patch("service.models.migrations.upgrade") as upgrade:
+            create_app()
+    upgrade.assert_called_once()
@@ -0,0 +1,130 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the Order stats
+"""
+
+from datetime import datetime
+
+from service.common import status
+from service.models import Order, OrderStatus, db
+from tests.factories import ItemFactory, OrderFactory
+from tests.test_base import TestBase
+
+BASE_URL = "/api/orders/stats"
+
+
+######################################################################
+#  S T A T S   T E S T   C A S E S
+######################################################################
+class TestStats(TestBase):
+    """Order Stats Tests"""
+
+    def setUp(self):
+        super().setUp()
+        self.orders = [
+            self._order("Ann", OrderStatus.CREATED, 1, [("foo", 2, 10), ("bar", 1, 5)]),
+            self._order("Ann", OrderStatus.SHIPPED, 2, [("foo", 1, 10)]),
+            self._order("Bob", OrderStatus.SHIPPED, 3, [("bar", 4, 5)]),
+            self._order("Bob", OrderStatus.CANCELLED, 4, [("foo", 9, 10)]),
+            self._order("Cid", OrderStatus.CREATED, 5, []),
+        ]
+        db.session.add_all(self.orders)
+        db.session.commit()
+
+    @staticmethod
+    def _order(customer_name, order_status, day, items):
+        """Builds an Order created on a day of January 2024 with its Items"""
+        order = OrderFactory.build(
+            id=None,
+            customer_name=customer_name,
+            status=order_status,
+            created_at=datetime(2024, 1, day, 12),
+        )
+        for product_name, quantity, price in items:
+            ItemFactory.build(
+                id=None,
+                order=order,
+                product_name=product_name,
+                quantity=quantity,
+                price=price,
+            )
+        return order
+
+    def test_stats(self):
+        """It should aggregate the Orders by status, product and customer"""
+        resp = self.client.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["orders"], 5)
+        self.assertEqual(data["revenue"], 55.0)
+        by_status = {row["status"]: row for row in data["by_status"]}
+        self.assertEqual(by_status["CREATED"], {"status": "CREATED", "orders": 2, "revenue": 25.0})
+        self.assertEqual(by_status["SHIPPED"], {"status": "SHIPPED", "orders": 2, "revenue": 30.0})
+        self.assertEqual(by_status["CANCELLED"]["revenue"], 90.0)
+        self.assertNotIn("COMPLETED", by_status)
+        self.assertEqual(
+            data["by_product"],
+            [
+                {"product_name": "foo", "quantity": 3, "revenue": 30.0},
+                {"product_name": "bar", "quantity": 5, "revenue": 25.0},
+            ],
+        )
+        self.assertEqual(
+            data["top_customers"],
+            [
+                {"customer_name": "Ann", "orders": 2, "revenue": 35.0},
+                {"customer_name": "Bob", "orders": 1, "revenue": 20.0},
+                {"customer_name": "Cid", "orders": 1, "revenue": 0.0},
+            ],
+        )
+
+    def test_stats_window(self):
+        """It should only aggregate the Orders created in a time window"""
+        resp = self.client.get(
+            BASE_URL,
+            query_string={
+                "created_after": "2024-01-02T00:00:00Z",
+                "created_before": "2024-01-04T00:00:00",
+                "top": 1,
+            },
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["orders"], 2)
+        self.assertEqual(data["revenue"], 30.0)
+        self.assertEqual(len(data["by_product"]), 1)
+        self.assertEqual(data["top_customers"], [{"customer_name": "Bob", "orders": 1, "revenue": 20.0}])
+
+        resp = self.client.get(BASE_URL, query_string={"created_after": "2025-01-01T00:00:00+05:00"})
+        self.assertEqual(resp.get_json()["orders"], 0)
+        self.assertEqual(resp.get_json()["by_status"], [])
+
+    def test_stats_bad_request(self):
+        """It should not aggregate with arguments that are not valid"""
+        resp = self.client.get(BASE_URL, query_string={"created_after": "yesterday"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get(BASE_URL, query_string={"top": 0})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stats_query_count(self):
+        """It should aggregate with three queries and no ORM objects"""
+        db.session.expunge_all()
+        with self._count_queries() as statements:
+            Order.stats()
+        self.assertEqual(len(statements), 3)
+        self.assertEqual(list(db.session.identity_map.values()), [])
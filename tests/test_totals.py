@@ -0,0 +1,185 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the denormalized Order totals
+"""
+
+from decimal import Decimal
+from urllib.parse import parse_qs, urlparse
+
+from sqlalchemy import update
+
+from service.common import status
+from service.models import DataValidationError, Item, Order, db
+from tests.factories import ItemFactory, OrderFactory
+from tests.test_base import TestBase
+
+BASE_URL = "/api/orders"
+
+
+######################################################################
+#  T O T A L S   T E S T   C A S E S
+######################################################################
+class TestTotals(TestBase):
+    """Order Totals Tests"""
+
+    def _totals(self, order_id):
+        """Returns the stored total_amount and item_count of an Order"""
+        db.session.expire_all()
+        order = Order.find(order_id)
+        return order.total_amount, order.item_count
+
+    def _create_order(self, *amounts):
+        """Creates an Order with an Item of quantity 1 for each price"""
+        order = OrderFactory()
+        data = order.serialize()
+        data["items"] = [
+            {"product_name": "foo", "quantity": 1, "price": price} for price in amounts
+        ]
+        resp = self.client.post(BASE_URL, json=data)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        return resp.get_json()
+
+    def test_totals_of_new_order(self):
+        """It should compute the totals of an Order created with Items"""
+        data = self._create_order(10, 2.5)
+        self.assertEqual(data["total_amount"], 12.5)
+        self.assertEqual(data["item_count"], 2)
+        self.assertEqual(self._totals(data["id"]), (Decimal("12.50"), 2))
+
+        data = self._create_order()
+        self.assertEqual(self._totals(data["id"]), (Decimal("0"), 0))
+
+    def test_totals_follow_item_changes(self):
+        """It should update the totals when Items are added, changed and removed"""
+        order_id = self._create_order(10)["id"]
+        url = f"{BASE_URL}/{order_id}/items"
+
+        resp = self.client.post(url, json={"product_name": "bar", "quantity": 3, "price": 4})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        item = resp.get_json()
+        self.assertEqual(self._totals(order_id), (Decimal("22.00"), 2))
+
+        item["quantity"] = 1
+        item["price"] = 7.25
+        resp = self.client.put(f"{url}/{item['id']}", json=item)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self._totals(order_id), (Decimal("17.25"), 2))
+
+        resp = self.client.post(f"{url}/batch", json=[ItemFactory().serialize() for _ in range(3)])
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self._totals(order_id)[1], 5)
+
+        for item_id in resp.get_json()["ids"] + [item["id"]]:
+            resp = self.client.delete(f"{url}/{item_id}")
+            self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self._totals(order_id), (Decimal("10.00"), 1))
+
+        resp = self.client.get(f"{BASE_URL}/{order_id}")
+        self.assertEqual(resp.get_json()["total_amount"], 10.0)
+
+    def test_totals_of_batch_orders(self):
+        """It should compute the totals of a batch of Orders"""
+        payload = []
+        for count in range(1, 4):
+            data = OrderFactory().serialize()
+            data["items"] = [ItemFactory().serialize() for _ in range(count)]
+            payload.append(data)
+        resp = self.client.post(f"{BASE_URL}/batch", json=payload)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        for data, result in zip(payload, resp.get_json()["results"]):
+            expected = sum(Decimal(item["price"]) * item["quantity"] for item in data["items"])
+            self.assertEqual(self._totals(result["id"]), (expected, len(data["items"])))
+
+    def test_totals_of_unloaded_item(self):
+        """It should read the stored amount of an Item changed without loading it"""
+        order_id = self._create_order(10, 20)["id"]
+        db.session.expire_all()
+        item = Order.find(order_id).items[0]
+        db.session.expire(item, ["price"])
+        item.price = 5
+        item.update()
+        self.assertEqual(self._totals(order_id), (Decimal("25.00"), 2))
+
+    def test_refresh_totals(self):
+        """It should rebuild the totals of Orders from their Items"""
+        first = self._create_order(10, 20)["id"]
+        second = self._create_order(5)["id"]
+        db.session.execute(update(Order).values(total_amount=0, item_count=0))
+        db.session.execute(update(Item).where(Item.order_id == second).values(quantity=2))
+        db.session.commit()
+        self.assertEqual(Order.refresh_totals([second]), 1)
+        self.assertEqual(self._totals(second), (Decimal("10.00"), 1))
+        self.assertEqual(self._totals(first), (Decimal("0"), 0))
+        self.assertEqual(Order.refresh_totals(), 1)
+        self.assertEqual(self._totals(first), (Decimal("30.00"), 2))
+        self.assertEqual(Order.refresh_totals(), 0)
+
+    def test_totals_match_sql(self):
+        """It should keep the same totals as the SQL that rebuilds them"""
+        data = self._create_order(19.99, 0.125, 1.005)
+        url = f"{BASE_URL}/{data['id']}/items"
+        item = self.client.post(url, json={"product_name": "bar", "quantity": 3, "price": 33.335}).get_json()
+        self.assertEqual(item["price"], 33.34)
+        item["quantity"] = 7
+        self.client.put(f"{url}/{item['id']}", json=item)
+        totals = self._totals(data["id"])
+        self.assertEqual(totals, (Decimal("254.51"), 4))
+        self.assertEqual(Order.refresh_totals([data["id"]]), 0)
+        self.assertEqual(self._totals(data["id"]), totals)
+
+    def test_fractional_quantity(self):
+        """It should not truncate a quantity that is not an integer"""
+        order_id = self._create_order(10)["id"]
+        resp = self.client.post(f"{BASE_URL}/{order_id}/items", json={"product_name": "bar", "quantity": 2.5, "price": 4})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self._totals(order_id), (Decimal("10.00"), 1))
+
+    def test_filter_by_total(self):
+        """It should list the Orders with totals in a range"""
+        amounts = [5, 15, 25, 35]
+        ids = [self._create_order(amount)["id"] for amount in amounts]
+        resp = self.client.get(BASE_URL, query_string={"min_total": 15, "max_total": 25})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([order["id"] for order in resp.get_json()], ids[1:3])
+
+        resp = self.client.get(f"{BASE_URL}/export", query_string={"min_total": 30})
+        self.assertEqual(resp.get_data(as_text=True).count("\n"), 1)
+
+        resp = self.client.get(BASE_URL, query_string={"min_total": "lots"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_sort_by_total(self):
+        """It should page through the Orders sorted by total"""
+        amounts = [25, 5, 35, 15, 15]
+        ids = [self._create_order(amount)["id"] for amount in amounts]
+        expected = [order_id for _, order_id in sorted(zip(amounts, ids), reverse=True)]
+        listed = []
+        query = {"sort": "-total_amount", "limit": 2, "fields": "total_amount"}
+        while query:
+            resp = self.client.get(BASE_URL, query_string=query)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            listed += [order["id"] for order in resp.get_json()]
+            link = resp.headers.get("Link")
+            query = link and parse_qs(urlparse(link[1:link.index(">")]).query)
+        self.assertEqual(listed, expected)
+
+        resp = self.client.get(BASE_URL, query_string={"sort": "total_amount"})
+        self.assertEqual([order["id"] for order in resp.get_json()], expected[::-1])
+        resp = self.client.get(BASE_URL, query_string={"sort": "status"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertRaises(DataValidationError, Order.find_by_filters, sort="price")